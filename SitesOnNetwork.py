@@ -2,22 +2,48 @@ import argparse
 import sys
 import os
 import re
-import json
 import csv
-from lib.shapefileloader import Shapefile
+from lib.shapefileloader import Shapefile, OUTPUT_FORMATS, outputFormat
+from lib.visittable import VisitTable, REAL, INTEGER, STRING
 from lib.sitkaAPI import *
 import ogr
-from shapely.geometry import Point, mapping
 from lib.env import setEnvFromFile
+from lib.fieldregistry import FieldRegistry, registryPath
+from lib.profiler import PROFILER
+from lib.checkpoint import Checkpoint
+from lib.prefetchplan import PrefetchPlan
 import xml.etree.ElementTree as ET
 import xml.dom.minidom
 import datetime
-
-def CreateSiteMetricsProject(dirPath, metricSchemaName):
+from concurrent.futures import ThreadPoolExecutor
+
+# Site and visit columns that come before the metrics
+visitColumns = [
+    ('SiteName', STRING),
+    ('StreamName', STRING),
+    ('Watershed', STRING),
+    ('Latitude', REAL),
+    ('Longitude', REAL),
+    ('Year', INTEGER),
+    ('VisitID', INTEGER),
+]
+
+def CreateSiteMetricsProject(dirPath, metricSchemaName, workers=1, rateLimit=None, streamMetrics=False, vectorFormat='shp', registryDir=None, envPath=None, retries=None, checkpointPath=None, resume=False, prefetch=False):
     """
     Create a CHaMP Site Metrics project, including the point ShapeFile and project file
     :param dirPath: Directory where the project will be placed. Must exist already.
     :param metricSchemaName: Name of the metric schema that will be downloaded and used.
+    :param workers: Number of site detail calls to make at the same time.
+    :param rateLimit: Maximum number of API calls per second to any one host. None means no limit.
+    :param streamMetrics: Parse the metrics API call as it downloads instead of loading it all into memory.
+    :param vectorFormat: Key of the point output format in OUTPUT_FORMATS ('shp', 'gpkg' or 'fgb').
+    :param registryDir: Optional folder of field name registries. See SitesOnANetwork.
+    :param envPath: Optional file of API settings. See SitesOnANetwork.
+    :param retries: Number of times to try each API call. See SitesOnANetwork.
+    :param checkpointPath: SQLite file where the downloaded data is saved as it arrives. Defaults to checkpoint.sqlite
+    in dirPath. It is deleted once the project has been written.
+    :param resume: Carry on from the checkpoint of an earlier run that didn't finish instead of starting again.
+    :param prefetch: Build the sites and visits from the bulk API calls. See SitesOnANetwork.
     :return: None
     """
 
@@ -28,26 +54,53 @@ def CreateSiteMetricsProject(dirPath, metricSchemaName):
     if not os.path.isdir(realizationDir):
         os.makedirs(realizationDir)
 
-    metricsShp = os.path.join(realizationDir, 'TopoMetrics.shp')
+    metricsShp = os.path.join(realizationDir, 'TopoMetrics' + OUTPUT_FORMATS[vectorFormat]['extension'])
     metricsCSV = os.path.join(realizationDir, 'Metrics.csv')
 
+    if checkpointPath is None:
+        checkpointPath = os.path.join(dirPath, 'checkpoint.sqlite')
+    checkpoint = Checkpoint(checkpointPath, metricSchemaName, resume)
+
     # Download the metric values and generate the shapefile and CSV file
-    SitesOnANetwork(metricsShp, metricsCSV, metricSchemaName)
+    try:
+        SitesOnANetwork(metricsShp, metricsCSV, metricSchemaName, workers, rateLimit, streamMetrics, registryDir, envPath, retries, checkpoint, prefetch)
+    except BaseException:
+        checkpoint.close()
+        print "Progress saved to {}. Run again with --resume to carry on from there.".format(checkpointPath)
+        raise
+    checkpoint.remove()
 
     # Create a project.rs.xml file for the project
-    SitesOnNetworkProject(dirPath, metricSchemaName, metricsShp, metricsCSV)
+    with PROFILER.stage('project XML'):
+        SitesOnNetworkProject(dirPath, metricSchemaName, metricsShp, metricsCSV)
 
-def SitesOnANetwork(shpPath, metricCSVPath, metricSchemaName):
+def SitesOnANetwork(shpPath, metricCSVPath, metricSchemaName, workers=1, rateLimit=None, streamMetrics=False, registryDir=None, envPath=None, retries=None, checkpoint=None, prefetch=False):
     """
     Download metric values for a schema and write them to a ShapeFile and CSV file
     :param shpPath: Absolute path where the ShapeFile will get put. Must not exist already.
+    The extension picks the format from OUTPUT_FORMATS, e.g. .gpkg for a GeoPackage.
     :param metricCSVPath: Absolute path where the metrics will get written as a CSV
     :param metricSchemaName: Name of the metric schema to download
+    :param workers: Number of site detail calls to make at the same time.
+    :param rateLimit: Maximum number of API calls per second to any one host. None means no limit.
+    :param streamMetrics: Parse the metrics API call as it downloads instead of loading it all into memory.
+    :param registryDir: Optional folder of field name registries that keep the metric field names the same from run to run.
+    :param envPath: File of the API settings, e.g. one written by benchmarks/mocksitka.py. Defaults to the .env file beside this script.
+    :param retries: Number of times to try each API call before giving up. Defaults to API_RETRIES from the settings, or 6.
+    :param checkpoint: Optional Checkpoint. Responses already in it are not downloaded again and new ones are added to it.
+    :param prefetch: Get all the visits in one call and only call for the details of sites that the bulk calls
+    don't say enough about, instead of calling for every site.
     :return: None
     """
 
     featuredict = {}
-    setEnvFromFile(os.path.join(os.path.dirname(__file__), '.env'))
+    setEnvFromFile(envPath if envPath else os.path.join(os.path.dirname(__file__), '.env'))
+    setRateLimit(rateLimit)
+
+    # Make sure there is a keep-alive connection available for each worker
+    poolSize = int(os.environ.get('API_POOL_SIZE', 10))
+    configureClient(poolSize=max(poolSize, workers))
+    configureRetry(maxAttempts=retries)
 
     # Retrieve the WGS84 spatial reference for geographic coordinates (lat/long)
     # http://spatialreference.org/ref/epsg/wgs-84/
@@ -57,19 +110,15 @@ def SitesOnANetwork(shpPath, metricCSVPath, metricSchemaName):
     outShape = Shapefile()
     outShape.create(shpPath, dest_srs, geoType=ogr.wkbPoint)
 
-    # Get all the metrics. Using this call get the structure and data in one fell swoop
-    metrics = rawCall('Visit/metricschemas/' + metricSchemaName + '/metrics')
-
-    # Make shp fields for each metric in our schema
-    namevalmap = {
-        'SiteName': 'SiteName',
-        'StreamName': 'StreamName',
-        'Watershed': 'Watershed',
-        'Latitude': 'Latitude',
-        'Longitude': 'Longitude',
-        'Year': 'Year',
-        'VisitID': 'VisitID',
-    }
+    fieldCSV = os.path.splitext(shpPath)[0] + "_fields.csv"
+    maxFieldLength = outputFormat(shpPath)['maxFieldLength']
+    registry = FieldRegistry(registryPath(registryDir, 'api', metricSchemaName, maxFieldLength) if registryDir else None,
+                             metricSchemaName, maxFieldLength)
+
+    # Make shp fields for each metric in our schema. The site fields keep their own names.
+    for name, kind in visitColumns:
+        registry.fieldName(name, [name])
+
     outShape.createField('ID', ogr.OFTInteger)
     outShape.createField('SiteName', ogr.OFTString)
     outShape.createField('StreamName', ogr.OFTString)
@@ -79,20 +128,135 @@ def SitesOnANetwork(shpPath, metricCSVPath, metricSchemaName):
     outShape.createField('Year', ogr.OFTInteger)
     outShape.createField('VisitID', ogr.OFTInteger)
 
+    metricsUrl = 'Visit/metricschemas/' + metricSchemaName + '/metrics'
+    if streamMetrics:
+        # The metrics get streamed after the sites are loaded. Fields are created from the first one
+        metrics = None
+    else:
+        # Get all the metrics. Using this call get the structure and data in one fell swoop
+        with PROFILER.stage('metric load') as stage:
+            metrics = checkpointedCall(checkpoint, metricsUrl)
+            createMetricFields(outShape, registry, metrics[0]['values'], fieldCSV, maxFieldLength)
+            stage.rows = len(metrics)
+
+    with PROFILER.stage('visit load') as stage:
+        # All watershes gives us waterhsed name and watershed url
+        print "Getting all watersheds..."
+        watersheds = checkpointedCall(checkpoint, "watersheds")
+        shedurl = { ws['url']: ws['name'] for ws in watersheds }
+
+        # Get all the sites
+        print "Getting all Sites..."
+        sites = checkpointedCall(checkpoint, "sites")
+
+        if prefetch:
+            # Only the sites the bulk calls don't cover need their own call
+            print "Getting all Visits..."
+            plan = PrefetchPlan(sites, checkpointedCall(checkpoint, "visits"), watersheds)
+            print "  {} of {} sites need their detail call".format(len(plan.detailSites), len(sites))
+            for site, siteobj in fetchSites(plan.detailSites, workers, checkpoint):
+                plan.addDetail(site, siteobj)
+            siteObjects = plan.siteObjects()
+        else:
+            siteObjects = fetchSites(sites, workers, checkpoint)
+
+        # Each site give us year and watershed url
+        # TODO: For testing I'm just going to process 5 dots on the map. REMOVE "DEBUGCOUNTER" Lines when you're ready for a full run
+        # DEBUGCOUNTER = 0 # REMOVE ME
+        for site, siteobj in siteObjects:
+            if not 'visits' in siteobj:
+                print "    Skipping site {0} in watershed {1}".format(site['name'], site['watershedUrl'])
+            else:
+                for visit in siteobj['visits']:
+                    # Some visits have no sample year. Either because they haven't been sampled or the iPad not uploaded
+                    if visit['sampleYear']:
+                        try:
+                            featuredict[visit['id']] = {
+                                'fields': {
+                                    'SiteName': siteobj['name'],
+                                    'StreamName' : siteobj['locale'],
+                                    'Watershed': shedurl[siteobj['watershedUrl']] if siteobj['watershedUrl'] in shedurl else "",
+                                    'Latitude': float(siteobj['latitude']),
+                                    'Longitude': float(siteobj['longitude']),
+                                    'Year': int(visit['sampleYear']),
+                                    'VisitID': int(visit['id']),
+                                }
+                            }
+                        except Exception, e:
+                            # TODO: Right now this throws out a lot of exceptions. Probably related to missing sampleYear
+                            print "ERROR: Problem with site object: {}".format(e.message)
+                            print visit
+                            print siteobj
+                    else:
+                        print "    Skipping Visit without sample year: {}".format(visit['id'])
+
+            #     DEBUGCOUNTER += 1 # REMOVE ME
+            # if DEBUGCOUNTER > 5: # REMOVE ME
+            #     break # REMOVE ME
+
+        # Move the visits into a columnar table so that the metric values are stored compactly
+        vids = featuredict.keys()
+        table = VisitTable(vids)
+        for name, kind in visitColumns:
+            table.addColumnFromValues(name, [featuredict[vid]['fields'][name] for vid in vids], kind)
+        featuredict = None
+        stage.rows = len(table)
+        print "  -- Loaded {} visits".format(len(table))
+
+    # In stream mode this includes downloading the metrics
+    with PROFILER.stage('metric merge') as stage:
+        if streamMetrics:
+            metrics = checkpointedStream(checkpoint, metricsUrl)
+
+        # Store all the visit metrics in the table
+        for idx, mobj in enumerate(metrics):
+            stage.rows += 1
+            if streamMetrics and idx == 0:
+                createMetricFields(outShape, registry, mobj['values'], fieldCSV, maxFieldLength)
+
+            vid = mobj['itemUrl'].split('/')[-1]
+            if len(vid) > 0 and vid.isdigit():
+                for met in mobj['values']:
+                    if not table.setValue(int(vid), met['name'], met['value'], STRING if met['type'] == 'String' else REAL):
+                        # Not one of the visits we are writing
+                        break
+
+    # Now it's time to write the shapefile:
+    def featurePoints():
+        for id, record in enumerate(table.records(), 1):
+            fields = {registry.fields[fieldName]: fieldValue for fieldName, fieldValue in record.iteritems()}
+            fields['ID'] = id
+            yield record['Longitude'], record['Latitude'], fields
+
+    with PROFILER.stage('shapefile write') as stage:
+        stage.rows = outShape.writePointFeatures(featurePoints())
+
+    # Now it's time to write the CSV file with metric values
+    metricCSV = metricCSVPath
+    with PROFILER.stage('CSV write') as stage, open(metricCSV, 'wb') as metricCSVFile:
+        csvwriter = csv.DictWriter(metricCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL, fieldnames=table.columnNames)
+        csvwriter.writeheader()
+
+        for record in table.records():
+            csvwriter.writerow(record)
+            stage.rows += 1
+
+def createMetricFields(outShape, registry, metricValues, fieldCSV, maxFieldLength=10):
+    """
+    Create a ShapeFile field for each metric and write the field names to a CSV file
+    :param outShape: Shapefile being written
+    :param registry: FieldRegistry of metric name to ShapeFile field name. New metrics get added to it.
+    :param metricValues: The "values" list of any one object from the metrics API call
+    :param fieldCSV: Absolute path to the CSV file where the field names get written
+    :param maxFieldLength: Longest field name the output format can store. None for no limit.
+    :return: None
+    """
+
     # Now let's pull the metric definition out of the massive "metrics" API call
-    for attr in metrics[0]['values']:
+    for attr in metricValues:
         # We need to handle the 10 character limit explicitly because OGR does it automatically but
         # Doesn't return what it does. Thanks OGR!!!!
-
-        fieldname = str(attr['name'][:10])
-        counter = 1
-        while fieldname in namevalmap.itervalues():
-            nchars = len(str(counter))
-            fieldlen = 9 - nchars
-            fieldname = "{}_{}".format(fieldname[:fieldlen], counter)
-            counter += 1
-
-        namevalmap[attr['name']] = fieldname
+        fieldname = str(registry.fieldName(attr['name'], metricFieldCandidates(attr['name'], maxFieldLength)))
 
         if attr['type'] == 'String':
             type = ogr.OFTString
@@ -102,92 +266,109 @@ def SitesOnANetwork(shpPath, metricCSVPath, metricSchemaName):
         # Create a field in the shapefile with the right type
         outShape.createField(fieldname, type)
 
+    registry.save()
+
     # Output the names to a CSV file so we can find them later
-    fieldCSV = os.path.splitext(shpPath)[0] + "_fields.csv"
     with open(fieldCSV, 'wb') as fieldCSVFile:
         csvwriter = csv.writer(fieldCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
         csvwriter.writerow(["METRICNAME", "SHPNAME"])
-        for k,v in namevalmap.iteritems():
+        for k,v in registry.activeFields():
             csvwriter.writerow([k,v])
 
-    # All watershes gives us waterhsed name and watershed url
-    print "Getting all watersheds..."
-    watersheds = rawCall("watersheds")
-    shedurl = { ws['url']: ws['name'] for ws in watersheds }
-
-    # Get all the sites
-    print "Getting all Sites..."
-    sites = rawCall("sites")
-
-    # Each site give us year and watershed url
-    # TODO: For testing I'm just going to process 5 dots on the map. REMOVE "DEBUGCOUNTER" Lines when you're ready for a full run
-    # DEBUGCOUNTER = 0 # REMOVE ME
-    for site in sites:
-        siteobj = rawCall(site['url'], absolute=True)
-        if not 'visits' in siteobj:
-            print "    Skipping site {0} in watershed {1}".format(site['name'], site['watershedUrl'])
-        else:
-            for visit in siteobj['visits']:
-                # Some visits have no sample year. Either because they haven't been sampled or the iPad not uploaded
-                if visit['sampleYear']:
-                    print "    Processing Visit: {}".format(visit['id'])
-                    try:
-                        featuredict[visit['id']] = {
-                            'geometry': Point(float(siteobj['longitude']), float(siteobj['latitude'])),
-                            'fields': {
-                                'SiteName': siteobj['name'],
-                                'StreamName' : siteobj['locale'],
-                                'Watershed': shedurl[siteobj['watershedUrl']] if siteobj['watershedUrl'] in shedurl else "",
-                                'Latitude': float(siteobj['latitude']),
-                                'Longitude': float(siteobj['longitude']),
-                                'Year': int(visit['sampleYear']),
-                                'VisitID': int(visit['id']),
-                            }
-                        }
-                    except Exception, e:
-                        # TODO: Right now this throws out a lot of exceptions. Probably related to missing sampleYear
-                        print "ERROR: Problem with site object: {}".format(e.message)
-                        print visit
-                        print siteobj
-                else:
-                    print "    Skipping Visit without sample year: {}".format(visit['id'])
-
-        #     DEBUGCOUNTER += 1 # REMOVE ME
-        # if DEBUGCOUNTER > 5: # REMOVE ME
-        #     break # REMOVE ME
-
-    # Store all the visit metrics in an easy-to-find dictionary
-    for mobj in metrics:
-        vid = mobj['itemUrl'].split('/')[-1]
-        if len(vid) > 0 and vid.isdigit():
-            if int(vid) in featuredict:
-                for met in mobj['values']:
-                    featuredict[int(vid)]['fields'][met['name']] = met['value']
-
-    # Now it's time to write the shapefile:
-    id = 1
-    for vid, featObj in featuredict.iteritems():
+def metricFieldCandidates(name, maxFieldLength=10):
+    """
+    The field names to try for a metric, best first
+    :param name: Metric name
+    :param maxFieldLength: Longest field name the output format can store. None for no limit.
+    :return: Endless generator of field names
+    """
+    fieldname = str(name[:maxFieldLength])
+    yield fieldname
 
-        featureDefn = outShape.layer.GetLayerDefn()
-        outFeature = ogr.Feature(featureDefn)
-        ogrPolygon = ogr.CreateGeometryFromJson(json.dumps(mapping(featObj['geometry'])))
-        outFeature.SetGeometry(ogrPolygon)
-        outFeature.SetField('ID', id)
+    counter = 1
+    while True:
+        if maxFieldLength:
+            nchars = len(str(counter))
+            fieldlen = maxFieldLength - 1 - nchars
+            fieldname = "{}_{}".format(fieldname[:fieldlen], counter)
+        else:
+            fieldname = "{}_{}".format(name, counter)
+        yield fieldname
+        counter += 1
 
-        for fieldName, fieldValue in featObj['fields'].iteritems():
-            outFeature.SetField(namevalmap[fieldName], fieldValue)
+def checkpointedCall(checkpoint, url):
+    """
+    rawCall that saves the response in the checkpoint, or takes it from there if an earlier run already got it
+    :param checkpoint: Checkpoint or None
+    :param url: Url relative to the API
+    :return: The parsed response
+    """
+    if checkpoint is None:
+        return rawCall(url)
 
-        outShape.layer.CreateFeature(outFeature)
-        id += 1
+    obj = checkpoint.call(url)
+    if obj is None:
+        obj = rawCall(url)
+        checkpoint.saveCall(url, obj)
+    return obj
 
-    # Now it's time to write the CSV file with metric values
-    metricCSV = metricCSVPath
-    with open(metricCSV, 'wb') as metricCSVFile:
-        csvwriter = csv.DictWriter(metricCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL, fieldnames=featuredict[featuredict.keys()[0]]['fields'].keys())
-        csvwriter.writeheader()
+def checkpointedStream(checkpoint, url):
+    """
+    streamCall that saves each item in the checkpoint. Items an earlier run already saved come
+    from the checkpoint and are skipped when the call is streamed again.
+    :param checkpoint: Checkpoint or None
+    :param url: Url relative to the API
+    :return: Generator of the items in the JSON array
+    """
+    if checkpoint is None:
+        for item in streamCall(url):
+            yield item
+        return
+
+    saved = checkpoint.itemCount(url)
+    for item in checkpoint.items(url):
+        yield item
+    if checkpoint.itemsComplete(url):
+        return
+
+    for idx, item in enumerate(streamCall(url)):
+        if idx >= saved:
+            checkpoint.saveItem(url, idx, item)
+            yield item
+    checkpoint.completeItems(url)
+
+def fetchSites(sites, workers=1, checkpoint=None):
+    """
+    Fetch the detail object for each site using a pool of worker threads
+    :param sites: List of site objects from the "sites" API call
+    :param workers: Number of site detail calls to make at the same time.
+    :param checkpoint: Optional Checkpoint. Sites already in it are not fetched again and new ones are added to it.
+    :return: Generator of (site, siteobj) tuples in the same order as sites
+    """
+    done = checkpoint.siteUrls() if checkpoint else set()
+    todo = [site for site in sites if site['url'] not in done]
+    if done:
+        print "  {} of {} sites already fetched".format(len(sites) - len(todo), len(sites))
+
+    executor = None
+    if workers <= 1:
+        fetched = (rawCall(site['url'], absolute=True) for site in todo)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        fetched = executor.map(lambda site: rawCall(site['url'], absolute=True), todo)
 
-        for vid, featObj in featuredict.iteritems():
-            csvwriter.writerow(featObj['fields'])
+    try:
+        for site in sites:
+            if site['url'] in done:
+                yield site, checkpoint.site(site['url'])
+            else:
+                siteobj = next(fetched)
+                if checkpoint:
+                    checkpoint.saveSite(site['url'], siteobj)
+                yield site, siteobj
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
 
 def SitesOnNetworkProject(dirPath, metricSchemaName, shpPath, csvPath):
     """
@@ -227,7 +408,7 @@ def SitesOnNetworkProject(dirPath, metricSchemaName, shpPath, csvPath):
 
     nodOutputs = ET.SubElement(nodAnalysis, 'Outputs')
     nodVector = ET.SubElement(nodOutputs, 'Vector')
-    ET.SubElement(nodVector, 'Name').text = 'Topo Metrics ShapeFile'
+    ET.SubElement(nodVector, 'Name').text = 'Topo Metrics ' + outputFormat(shpPath)['name']
     ET.SubElement(nodVector, 'Path').text = shpPath.replace(dirPath + os.sep,'')
 
     nodCSV = ET.SubElement(nodOutputs, 'CSV')
@@ -254,10 +435,91 @@ def main():
     parser.add_argument('--logfile',
                         type=str,
                         help='write the output of this script to a file')
+
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='number of site API calls to make at the same time')
+
+    parser.add_argument('--ratelimit',
+                        type=float,
+                        help='maximum number of API calls per second to any one host')
+
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        help='folder for caching API responses between runs')
+
+    parser.add_argument('--cache-ttl',
+                        type=float,
+                        default=24,
+                        help='hours a cached API response is used before revalidating it with the server')
+
+    parser.add_argument('--cache-size',
+                        type=float,
+                        help='maximum size of the API response cache in MB')
+
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help='do not call the API. Everything must come from the --cache-dir')
+
+    parser.add_argument('--format',
+                        choices=sorted(OUTPUT_FORMATS.keys()),
+                        default='shp',
+                        help='point output format')
+
+    parser.add_argument('--stream-metrics',
+                        action='store_true',
+                        help='parse the metric values as they download to keep memory use low')
+
+    parser.add_argument('--field-registry',
+                        type=str,
+                        help='folder of field name registries that keep metric field names the same from run to run')
+
+    parser.add_argument('--profile',
+                        type=str,
+                        help='write the time, rows and memory of each stage and the API call statistics to this JSON file')
+
+    parser.add_argument('--cprofile',
+                        action='store_true',
+                        help='with --profile, also run cProfile and include the slowest functions')
+
+    parser.add_argument('--retries',
+                        type=int,
+                        help='number of times to try each API call before giving up. Defaults to API_RETRIES or 6')
+
+    parser.add_argument('--checkpoint',
+                        type=str,
+                        help='SQLite file where downloaded data is saved as it arrives. Defaults to checkpoint.sqlite in outdir')
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='carry on from the checkpoint of an earlier run that did not finish')
+
+    parser.add_argument('--env',
+                        type=str,
+                        help='file of API settings to use instead of the .env file beside this script')
+
+    parser.add_argument('--prefetch',
+                        action='store_true',
+                        help='build the sites and visits from the bulk API calls and only call for the sites they leave out')
+
+    parser.add_argument('--token-cache',
+                        type=str,
+                        help='file where the API token is kept so parallel and later runs can share it. Defaults to KEYSTONE_TOKEN_CACHE')
     args = parser.parse_args()
 
     try:
-        CreateSiteMetricsProject(args.outdir, args.metricschema)
+        if args.cprofile:
+            PROFILER.enableCProfile()
+
+        configureCache(args.cache_dir,
+                       ttl=args.cache_ttl * 3600,
+                       maxBytes=int(args.cache_size * 1024 * 1024) if args.cache_size else None,
+                       offline=args.offline)
+        if args.token_cache:
+            configureTokenCache(args.token_cache)
+        CreateSiteMetricsProject(args.outdir, args.metricschema, args.workers, args.ratelimit, args.stream_metrics, args.format, args.field_registry, args.env, args.retries,
+                                 args.checkpoint, args.resume, args.prefetch)
 
     except AssertionError as e:
         print "Assertion Error", e
@@ -266,6 +528,10 @@ def main():
         print 'Unexpected error: {0}'.format(sys.exc_info()[0]), e
         raise
         sys.exit(1)
+    finally:
+        # A failed or interrupted run is the one most worth profiling
+        if args.profile:
+            PROFILER.write(args.profile)
 
 """
 This handles the argument parsing and calls our main function
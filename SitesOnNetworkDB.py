@@ -2,15 +2,26 @@ import argparse
 import sys
 import os
 import re
-import json
 import csv
-from lib.shapefileloader import Shapefile
+import io
+import json
+import hashlib
+import collections
+import functools
+import concurrent.futures
+from lib.shapefileloader import Shapefile, OUTPUT_FORMATS, outputFormat
+from lib.visittable import VisitTable, REAL, INTEGER, STRING
+from lib.parquetwriter import writeParquet, ParquetRecordWriter
 import ogr
-from shapely.geometry import Point, mapping
 import xml.etree.ElementTree as ET
 import xml.dom.minidom
 import datetime
 import sqlite3
+import shutil
+from lib.userinput import query_yes_no
+from lib.filefolderutil import sanitizeFolderName
+from lib.fieldregistry import FieldRegistry, registryPath
+from lib.profiler import PROFILER
 
 site_fields = {
     'Watershed': 'WatershedName',
@@ -68,12 +79,21 @@ site_fields = {
     'CUMDRAINAG':  None
 }
 
-def CreateSiteMetricsProject(dirPath, database, metricSchemaName):
+ogr_types = {REAL: ogr.OFTReal, INTEGER: ogr.OFTInteger, STRING: ogr.OFTString}
+
+def CreateSiteMetricsProject(dirPath, database, metricSchemaName, engine='python', vectorFormat='shp', parquet=False, incremental=False, sites=None, workers=None, registryDir=None):
     """
     Create a CHaMP Site Metrics project, including the point ShapeFile and project file
     :param dirPath: Directory where the project will be placed. Must exist already.
     :param database: CHaMP Workbench SQLite database containing the metric values.
     :param metricSchemaName: Name of the metric schema that will be downloaded and used.
+    :param engine: 'python' or 'sql'. See SitesOnANetwork.
+    :param vectorFormat: Key of the point output format in OUTPUT_FORMATS ('shp', 'gpkg' or 'fgb').
+    :param parquet: Also write the visit metrics table as a Parquet file.
+    :param incremental: Only update what changed since the last incremental export. See SitesOnANetwork.
+    :param sites: Optional VisitTable of the site information already loaded with load_site_table.
+    :param workers: Number of worker processes for the partitioned engine.
+    :param registryDir: Optional folder of field name registries. See SitesOnANetwork.
     :return: None
     """
 
@@ -84,58 +104,287 @@ def CreateSiteMetricsProject(dirPath, database, metricSchemaName):
     if not os.path.isdir(realizationDir):
         os.makedirs(realizationDir)
 
-    metricsShp = os.path.join(realizationDir, 'TopoMetrics.shp')
+    metricsShp = os.path.join(realizationDir, 'TopoMetrics' + OUTPUT_FORMATS[vectorFormat]['extension'])
     metricsCSV = os.path.join(realizationDir, 'Metrics.csv')
+    metricsParquet = os.path.join(realizationDir, 'Metrics.parquet') if parquet else None
 
     # Download the metric values and generate the shapefile and CSV file
-    SitesOnANetwork(metricsShp, metricsCSV, database, metricSchemaName)
+    SitesOnANetwork(metricsShp, metricsCSV, database, metricSchemaName, engine, metricsParquet, incremental, sites, workers, registryDir)
 
     # Create a project.rs.xml file for the project
-    SitesOnNetworkProject(dirPath, metricSchemaName, metricsShp, metricsCSV)
+    with PROFILER.stage('project XML'):
+        SitesOnNetworkProject(dirPath, metricSchemaName, metricsShp, metricsCSV, metricsParquet)
+
+
+def CreateSiteMetricsProjects(dirPath, database, metricSchemaNames, vectorFormat='shp', parquet=False, incremental=False, workers=None, registryDir=None):
+    """
+    Create a CHaMP Site Metrics project for each of several metric schemas. The site and visit
+    information is loaded from the database once and shared with a pool of worker processes
+    that each export one schema with the python engine.
+    :param dirPath: Directory where a project folder is created for each schema. Must exist already.
+    :param database: CHaMP Workbench SQLite database containing the metric values.
+    :param metricSchemaNames: List of metric schema names. ['all'] exports every schema in the database.
+    :param vectorFormat: Key of the point output format in OUTPUT_FORMATS ('shp', 'gpkg' or 'fgb').
+    :param parquet: Also write the visit metrics table as a Parquet file.
+    :param incremental: Only update what changed since the last incremental export. See SitesOnANetwork.
+    :param workers: Number of worker processes. Defaults to the number of CPUs.
+    :param registryDir: Optional folder of field name registries. See SitesOnANetwork.
+    :return: Dictionary of metric schema name to project folder
+    """
+
+    if not os.path.isdir(dirPath):
+        raise Exception('The output directory path does not exist')
+
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    if metricSchemaNames == ['all']:
+        metricSchemaNames = [row['Title'] for row in conn.execute('SELECT Title FROM Metric_Schemas ORDER BY Title')]
+    sites = load_site_table(conn.cursor())
+    conn.close()
+
+    projects = collections.OrderedDict((name, os.path.join(dirPath, sanitizeFolderName(name))) for name in metricSchemaNames)
+    if len(set(projects.values())) != len(projects):
+        raise Exception('Metric schema names must give unique project folder names')
+
+    for projectDir in projects.values():
+        if not os.path.isdir(projectDir):
+            os.makedirs(projectDir)
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(sites,)) as executor:
+        futures = {executor.submit(batch_export_schema, projectDir, database, name, vectorFormat, parquet, incremental, registryDir): name
+                   for name, projectDir in projects.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                print('Project for', name, 'written to', projects[name])
+            except Exception as e:
+                print('Error exporting metric schema', name, e)
+                failed.append(name)
+
+    if failed:
+        raise Exception('Failed to export metric schemas: {}'.format(', '.join(failed)))
+
+    return projects
 
-def SitesOnANetwork(shpPath, metricCSVPath, database, metricSchemaName):
+
+# Site information loaded by CreateSiteMetricsProjects and shared with each worker process
+batch_sites = None
+
+
+def init_batch_worker(sites):
+    global batch_sites
+    batch_sites = sites
+
+
+def batch_export_schema(dirPath, database, metricSchemaName, vectorFormat, parquet, incremental, registryDir):
+    CreateSiteMetricsProject(dirPath, database, metricSchemaName, 'python', vectorFormat, parquet, incremental, batch_sites, registryDir=registryDir)
+
+# Visits with their site and watershed information that have a location and are not in the excluded watersheds
+visits_join = ' FROM CHaMP_Visits V' + \
+    ' INNER JOIN CHaMP_Sites S ON V.SiteID = S.SiteID' + \
+    ' INNER JOIN CHaMP_Watersheds W ON S.WatershedID = W.WatershedID'
+visits_where = ' WHERE (Latitude IS NOT NULL) AND (Longitude IS NOT NULL) AND W.WatershedID NOT IN (99, 102, 104, 27)'
+visits_from = visits_join + visits_where
+
+# Rows return the first column with a given name so the watershed columns come first.
+# They win over duplicate column names in the site and visit tables.
+visits_columns = 'W.*, S.*, V.*'
+
+# Metric definitions for a schema
+metric_definitions_query = 'SELECT MD.MetricID, MD.Title, DisplayNameShort, DataTypeID' + \
+    ' FROM Metric_Definitions MD' + \
+    ' INNER JOIN Metric_Schema_Definitions MSD ON MD.MetricID = MSD.MetricID' + \
+    ' INNER JOIN Metric_Schemas S ON MSD.SchemaID = S.SchemaID' + \
+    ' WHERE S.Title = ?'
+
+# Metric instances, one per visit and batch, for all visits in a schema
+metric_instances_from = ' FROM Metric_Schemas S' + \
+    ' INNER JOIN Metric_Batches B ON S.SchemaID = B.SchemaID' + \
+    ' INNER JOIN Metric_Instances I ON B.BatchID = I.BatchID' + \
+    ' WHERE S.Title = ?'
+
+# Metric values for all visits in a schema
+metric_values_from = ' FROM Metric_Schemas S' + \
+    ' INNER JOIN Metric_Batches B ON S.SchemaID = B.SchemaID' + \
+    ' INNER JOIN Metric_Instances I ON B.BatchID = I.BatchID' + \
+    ' INNER JOIN Metric_VisitMetrics VM ON I.InstanceID = VM.InstanceID' + \
+    ' WHERE S.Title = ?'
+
+
+def SitesOnANetwork(shpPath, metricCSVPath, database, metricSchemaName, engine='python', parquetPath=None, incremental=False, sites=None, workers=None, registryDir=None):
     """
     Download metric values for a schema and write them to a ShapeFile and CSV file
     :param shpPath: Absolute path where the ShapeFile will get put. Must not exist already.
+    The extension picks the format from OUTPUT_FORMATS, e.g. .gpkg for a GeoPackage.
     :param metricCSVPath: Absolute path where the metrics will get written as a CSV
     :param database: CHaMP Workbench SQLite database that contains the metrics.
     :param metricSchemaName: Name of the metric schema to download.
+    :param engine: 'python' loads everything into a columnar VisitTable and pivots the metrics in Python.
+    'sql' has SQLite join and order the visits and metrics and streams one visit at a time to the outputs.
+    'partitioned' splits the export by watershed across worker processes. See partitioned_export.
+    :param parquetPath: Optional absolute path where the visit metrics get written as a Parquet file.
+    :param incremental: Only update the visits that changed since the last incremental export, using the
+    manifest written beside the ShapeFile. Falls back to a full export when that is not possible.
+    :param sites: Optional VisitTable of the site information already loaded with load_site_table.
+    Only used by the python engine.
+    :param workers: Number of worker processes for the partitioned engine. Defaults to the number of CPUs.
+    :param registryDir: Optional folder of field name registries that keep the metric field names the same from run to run.
     :return: None
     """
 
-    visits = {}
-    shp_fields = {}
-    metric_names = {}
-
     conn = sqlite3.connect(database)
-    conn.row_factory = dict_factory
-    curs = conn.cursor()
-
+    # sqlite3.Row is a compact tuple that also allows lookup by column name
+    conn.row_factory = sqlite3.Row
     # Load all the metric definitions for the specified schema
+    maxFieldLength = outputFormat(shpPath)['maxFieldLength']
+    registry = None
+    if registryDir:
+        registry = FieldRegistry(registryPath(registryDir, 'workbench', metricSchemaName, maxFieldLength), metricSchemaName, maxFieldLength)
+    with PROFILER.stage('metric load') as stage:
+        metrics = load_metric_definitions(conn.cursor(), metricSchemaName, maxFieldLength, registry)
+        write_fields_csv(shpPath, metrics)
+        stage.rows = len(metrics)
+
+    if incremental:
+        with PROFILER.stage('incremental export'):
+            if incremental_export(conn, shpPath, metrics, metricSchemaName, parquetPath):
+                return
+
+    if engine == 'sql':
+        sql_pivot_export(conn, shpPath, metrics, metricSchemaName, parquetPath)
+    elif engine == 'partitioned':
+        partitioned_export(conn, database, shpPath, metrics, metricSchemaName, parquetPath, workers)
+    else:
+        python_pivot_export(conn, shpPath, metrics, metricSchemaName, parquetPath, sites)
+
+    if incremental:
+        with PROFILER.stage('manifest write'):
+            visits, batches = export_state(conn, metricSchemaName)
+            fields = manifest_fields(site_field_types(conn.cursor()), metrics)
+            write_manifest(manifest_path(shpPath), metricSchemaName, fields, visits, batches)
+
+
+def python_pivot_export(conn, shpPath, metrics, metricSchemaName, parquetPath=None, sites=None):
+    """
+    Load the visits and metric values into a columnar VisitTable, pivoting the metric values
+    in Python, then write the CSV and ShapeFile from the table.
+    :param conn: Connection to the CHaMP Workbench database
+    :param shpPath: Absolute path where the ShapeFile will get put.
+    :param metrics: Dictionary of MetricID to metric definition
+    :param metricSchemaName: Name of the metric schema
+    :param parquetPath: Optional absolute path where the visit metrics get written as a Parquet file.
+    :param sites: Optional VisitTable of the site information already loaded with load_site_table
+    :return: None
+    """
+
+    table = load_visit_table(conn.cursor(), metrics, metricSchemaName, sites)
+    shp_fields = {name: ogr_types[table.kind(name)] for name in table.columnNames if name in site_fields}
+
+    outShape = create_shapefile(shpPath, shp_fields, metrics)
+ 
+    fieldCSV = os.path.splitext(shpPath)[0] + ".csv"
+    with PROFILER.stage('CSV write') as stage, open(fieldCSV, 'w') as fieldCSVFile:
+        csvwriter = csv.writer(fieldCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        fields = list(shp_fields.keys())
+        csvwriter.writerow(fields)
+        for values in table.records(fields):
+            csvwriter.writerow([values[field] for field in fields])
+        stage.rows = len(table)
+            
+    print('CSV file written to', fieldCSV)
+
+    with PROFILER.stage('shapefile write') as stage:
+        stage.rows = outShape.writePointFeatures((visit['Longitude'], visit['Latitude'], shapefile_values(visit)) for visit in table.records())
+
+    if parquetPath:
+        with PROFILER.stage('parquet write') as stage:
+            writeParquet(table, parquetPath)
+            stage.rows = len(table)
+        print('Parquet file written to', parquetPath)
+
+
+def load_site_table(curs):
+    """
+    Load the visits with their site information into a columnar VisitTable.
+    Site fields that never have a value are left out.
+    :param curs: Cursor on the CHaMP Workbench database
+    :return: VisitTable with a column for each site field
+    """
+
+    curs.execute('SELECT ' + visits_columns + visits_from)
+    field_indexes = site_field_indexes(curs)
+    visitids = []
+    values = {shpfield: [] for shpfield, index in field_indexes}
+    for row in curs:
+        visitids.append(row['VisitID'])
+        for shpfield, index in field_indexes:
+            values[shpfield].append(row[index])
+
+    table = VisitTable(visitids)
+    for shpfield, index in field_indexes:
+        table.addColumnFromValues(shpfield, values.pop(shpfield))
+
+    print(len(table), 'visits retrieved from the database')        
+    return table
+
+
+def load_visit_table(curs, metrics, metricSchemaName, sites=None):
+    """
+    Load the visits with their site information and metric values into a columnar VisitTable.
+    Site fields that never have a value are left out.
+    :param curs: Cursor on the CHaMP Workbench database
+    :param metrics: Dictionary of MetricID to metric definition
+    :param metricSchemaName: Name of the metric schema
+    :param sites: Optional VisitTable from load_site_table. It is copied rather than loading the visits again.
+    :return: VisitTable with a column for each site field and each metric ShapeFile field name
+    """
+
+    with PROFILER.stage('visit load') as stage:
+        table = sites.copy() if sites is not None else load_site_table(curs)
+        stage.rows = len(table)
+
+    # Load all the metric values
+    with PROFILER.stage('metric merge') as stage:
+        for metric in metrics.values():
+            table.addColumn(metric['ShapeFile'], metric_kind(metric))
+
+        curs.execute('SELECT I.VisitID, MetricID, MetricValue' + metric_values_from, [metricSchemaName])
+        for row in curs:
+            # Visits without a location or in one of the excluded watersheds are not in the table
+            table.setValue(row['VisitID'], metrics[row['MetricID']]['ShapeFile'], row['MetricValue'])
+            stage.rows += 1
+
+    print('Metric values loaded from the database')
+    return table
+
+
+def load_metric_definitions(curs, metricSchemaName, maxFieldLength=10, registry=None):
+    """
+    Load the metric definitions for a schema and assign each a unique ShapeFile field name
+    :param curs: Cursor on the CHaMP Workbench database
+    :param metricSchemaName: Name of the metric schema
+    :param maxFieldLength: Longest field name the output format can store. None for no limit.
+    :param registry: Optional FieldRegistry that keeps the field names the same from run to run.
+    Without one the names depend on the order of the metrics.
+    :return: Dictionary of MetricID to metric definition
+    """
+
+    if registry is None:
+        registry = FieldRegistry(maxFieldLength=maxFieldLength)
+
     metrics = {}
-    unique_metrics = []
-    curs.execute('SELECT MD.MetricID, MD.Title, DisplayNameShort, DataTypeID' +
-        ' FROM Metric_Definitions MD' +
-        ' INNER JOIN Metric_Schema_Definitions MSD ON MD.MetricID = MSD.MetricID' +
-        ' INNER JOIN Metric_Schemas S ON MSD.SchemaID = S.SchemaID' +
-        ' WHERE S.Title = ?', [metricSchemaName])
+    curs.execute(metric_definitions_query, [metricSchemaName])
     for row in curs.fetchall():
         name = row['DisplayNameShort']
-        shp = name.replace('_', '')[0:min(10, len(name))]
-        
-        # Attempt to build a unique 10 character version of each metric display name short
-        attempt = 1
-        while shp in unique_metrics:
-            shp = shp[:-len(str(attempt))] + str(attempt)
-            attempt += 1
-        unique_metrics.append(shp)
-
         metrics[row['MetricID']] = {
             'Name': name,
             'FullName': row['Title'],
-            'ShapeFile': shp,
+            'ShapeFile': registry.fieldName(row['MetricID'], shapefile_field_candidates(name, maxFieldLength)),
             'DataType' : ogr.OFTReal if row['DataTypeID'] == 10023 else ogr.OFTString
         }
+    registry.save()
     
     # Verify that the ShapeFile field names are unique
     shpfields = [metric['ShapeFile'] for id, metric in metrics.items()]
@@ -143,7 +392,42 @@ def SitesOnANetwork(shpPath, metricCSVPath, database, metricSchemaName):
     if len(shpfields) != len(set(shpfields)):
         raise 'Metric field names for the Shapefile are not unique'
 
-    # Output the metric names to a CSV file for reference
+    return metrics
+
+
+def shapefile_field_candidates(name, maxFieldLength=10):
+    """
+    The field names to try for a metric, best first
+    :param name: Metric display name short
+    :param maxFieldLength: Longest field name the output format can store. None for no limit.
+    :return: Endless generator of field names
+    """
+
+    if maxFieldLength:
+        shp = name.replace('_', '')[0:min(maxFieldLength, len(name))]
+    else:
+        shp = name
+    yield shp
+
+    # Attempt to build a unique 10 character version of each metric display name short
+    attempt = 1
+    while True:
+        if maxFieldLength:
+            shp = shp[:-len(str(attempt))] + str(attempt)
+        else:
+            shp = '{}_{}'.format(name, attempt)
+        yield shp
+        attempt += 1
+
+
+def write_fields_csv(shpPath, metrics):
+    """
+    Output the metric names to a CSV file beside the ShapeFile for reference
+    :param shpPath: Absolute path to the ShapeFile
+    :param metrics: Dictionary of MetricID to metric definition
+    :return: None
+    """
+
     fieldCSV = os.path.splitext(shpPath)[0] + "_fields.csv"
     with open(fieldCSV, 'w') as fieldCSVFile:
         csvwriter = csv.writer(fieldCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
@@ -151,43 +435,15 @@ def SitesOnANetwork(shpPath, metricCSVPath, database, metricSchemaName):
         for metricid, metric in metrics.items():
             csvwriter.writerow([metricid, metric['FullName'], metric['Name'], metric['ShapeFile']])
 
-    # Load all the visits with their site information
-    curs.execute('SELECT *' +
-        ' FROM CHaMP_Visits V' +
-        ' INNER JOIN CHaMP_Sites S ON V.SiteID = S.SiteID' +
-        ' INNER JOIN CHaMP_Watersheds W ON S.WatershedID = W.WatershedID'
-        ' WHERE (Latitude IS NOT NULL) AND (Longitude IS NOT NULL) AND W.WatershedID NOT IN (99, 102, 104, 27)')
-    for row in curs.fetchall():
-        visitid = row['VisitID']
-        visits[visitid] = {}
-        for shpfield, dbfield in site_fields.items():
-            if not dbfield:
-                dbfield = shpfield
-            visits[visitid][shpfield] = row[dbfield]
-
-            if shpfield not in shp_fields and row[dbfield]:
-                if isinstance(row[dbfield], str):
-                    shp_fields[shpfield] = ogr.OFTString
-                elif isinstance(row[dbfield], int):
-                    shp_fields[shpfield] = ogr.OFTInteger
-                else:
-                    shp_fields[shpfield] = ogr.OFTReal
-
-    print(len(visits), 'visits retrieved from the database')        
 
-    # Load all the metric values
-    curs.execute('SELECT I.VisitID, MetricID, MetricValue' +
-        ' FROM Metric_Schemas S' +
-        ' INNER JOIN Metric_Batches B ON S.SchemaID = B.SchemaID' +
-        ' INNER JOIN Metric_Instances I ON B.BatchID = I.BatchID' +
-        ' INNER JOIN Metric_VisitMetrics VM ON I.InstanceID = VM.InstanceID'
-        ' WHERE S.Title = "Final - Visit Metrics 2018_02_16"')
-    for row in curs.fetchall():
-        visitid = row['VisitID']
-        metric  = metrics[row['MetricID']]
-        visits[visitid][metric['ShapeFile']] = row['MetricValue']
-
-    print('Metric values loaded from the database')
+def create_shapefile(shpPath, shp_fields, metrics):
+    """
+    Create the point ShapeFile with the site fields followed by the metric fields
+    :param shpPath: Absolute path where the ShapeFile will get put.
+    :param shp_fields: Dictionary of site field name to OGR field type
+    :param metrics: Dictionary of MetricID to metric definition
+    :return: Shapefile
+    """
 
     # Retrieve the WGS84 spatial reference for geographic coordinates (lat/long)
     # http://spatialreference.org/ref/epsg/wgs-84/
@@ -198,39 +454,574 @@ def SitesOnANetwork(shpPath, metricCSVPath, database, metricSchemaName):
     outShape.create(shpPath, dest_srs, geoType=ogr.wkbPoint)
     [outShape.createField(field_name, field_type) for field_name, field_type in shp_fields.items()]
     [outShape.createField(metric['ShapeFile'], metric['DataType']) for metric in metrics.values()]
+    return outShape
+
+
+def metric_kind(metric):
+    """
+    The VisitTable column kind for a metric, following its Workbench DataTypeID
+    :param metric: Metric definition
+    :return: REAL or STRING
+    """
+
+    return REAL if metric['DataType'] == ogr.OFTReal else STRING
+
+
+def shapefile_values(visit):
+    """
+    The values of a visit that get written to the ShapeFile. Empty and zero values are left unset.
+    :param visit: Dictionary of field name to value
+    :return: Dictionary of field name to value
+    """
+
+    return {fieldName: fieldValue for fieldName, fieldValue in visit.items() if fieldValue}
+
+
+def site_field_indexes(curs):
+    """
+    Resolve the position of each site field in the result set once, rather than
+    looking every value up by column name
+    :param curs: Cursor that has executed the visits query
+    :return: List of (site field name, column index) tuples
+    """
+
+    columns = [col[0].lower() for col in curs.description]
+    return [(shpfield, columns.index((dbfield if dbfield else shpfield).lower())) for shpfield, dbfield in site_fields.items()]
+
+
+def site_field_types(curs):
+    """
+    Determine the ShapeFile field type of each site field with a single aggregate query.
+    Fields that never have a value are left out, the same as loading the visits in Python.
+    :param curs: Cursor on the CHaMP Workbench database
+    :return: Dictionary of site field name to OGR field type
+    """
+
+    # 3 = text, 2 = real, 1 = integer, 0 = no values. The widest type present wins.
+    rank = 'MAX(CASE' + \
+        ' WHEN typeof({0}) = \'text\' AND {0} != \'\' THEN 3' + \
+        ' WHEN typeof({0}) = \'real\' AND {0} != 0 THEN 2' + \
+        ' WHEN typeof({0}) = \'integer\' AND {0} != 0 THEN 1' + \
+        ' ELSE 0 END) AS "{1}"'
+
+    columns = [rank.format('"{}"'.format(dbfield if dbfield else shpfield), shpfield) for shpfield, dbfield in site_fields.items()]
+
+    curs.execute('SELECT ' + ', '.join(columns) +
+        ' FROM (SELECT ' + visits_columns + visits_from + ')')
+    row = curs.fetchone()
+
+    types = {3: ogr.OFTString, 2: ogr.OFTReal, 1: ogr.OFTInteger}
+    return {shpfield: types[row[shpfield]] for shpfield in site_fields if row[shpfield]}
+
+
+def sql_pivot_export(conn, shpPath, metrics, metricSchemaName, parquetPath=None):
+    """
+    Let SQLite join and order the visits and the metric values by VisitID, then pivot the
+    metric values onto each visit with a single pass over both result sets. Each visit is
+    written to the CSV and ShapeFile as it is read so that no copy of the visits or metric
+    values is ever held in memory.
+    :param conn: Connection to the CHaMP Workbench database
+    :param shpPath: Absolute path where the ShapeFile will get put.
+    :param metrics: Dictionary of MetricID to metric definition
+    :param metricSchemaName: Name of the metric schema
+    :param parquetPath: Optional absolute path where the visit metrics get written as a Parquet file.
+    :return: None
+    """
+
+    with PROFILER.stage('field types') as stage:
+        shp_fields = site_field_types(conn.cursor())
+        stage.rows = len(shp_fields)
+    outShape = create_shapefile(shpPath, shp_fields, metrics)
+
+    parquet = ParquetRecordWriter(parquetPath, parquet_columns(shp_fields, metrics)) if parquetPath else None
+
+    visit_curs = conn.cursor()
+    visit_curs.execute('SELECT ' + visits_columns + visits_from + ' ORDER BY V.VisitID')
+
+    metric_curs = conn.cursor()
+    metric_curs.execute('SELECT I.VisitID, MetricID, MetricValue' + metric_values_from + ' ORDER BY I.VisitID', [metricSchemaName])
 
- 
     fieldCSV = os.path.splitext(shpPath)[0] + ".csv"
     with open(fieldCSV, 'w') as fieldCSVFile:
         csvwriter = csv.writer(fieldCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
         fields = list(shp_fields.keys())
         csvwriter.writerow(fields)
-        for visitid, values in visits.items():
-            csv_values = []
-            for field in fields:
-                csv_values.append(values[field] if field in values else None)
-            csvwriter.writerow(csv_values)
-            
-    print('CSV file written to', fieldCSV)
 
-    featureDefn = outShape.layer.GetLayerDefn()
+        def visit_points():
+            for visit in pivot_visits(visit_curs, metric_curs, metrics):
+                csvwriter.writerow([visit[field] if field in visit else None for field in fields])
+                if parquet:
+                    parquet.write(visit)
+                yield visit['Longitude'], visit['Latitude'], shapefile_values(visit)
+
+        # Reading, merging and writing all happen together as the visits stream through
+        with PROFILER.stage('streamed export') as stage:
+            count = stage.rows = outShape.writePointFeatures(visit_points())
+
+    if parquet:
+        parquet.close()
+        print('Parquet file written to', parquetPath)
+
+    print(count, 'visits written to', fieldCSV, 'and', shpPath)
+
+
+def pivot_visits(visit_curs, metric_curs, metrics):
+    """
+    Merge the metric values onto their visits with a single pass over both result sets
+    :param visit_curs: Cursor that has executed the visits query ordered by VisitID
+    :param metric_curs: Cursor that has executed the metric values query ordered by VisitID
+    :param metrics: Dictionary of MetricID to metric definition
+    :return: Generator of dictionaries of field name to value, one per visit
+    """
+
+    field_indexes = site_field_indexes(visit_curs)
+    metric_row = metric_curs.fetchone()
+    for row in visit_curs:
+        visitid = row['VisitID']
+        visit = {shpfield: row[index] for shpfield, index in field_indexes}
+
+        # Skip metric values for visits that were filtered out, then take the ones for this visit
+        while metric_row and metric_row['VisitID'] < visitid:
+            metric_row = metric_curs.fetchone()
+        while metric_row and metric_row['VisitID'] == visitid:
+            visit[metrics[metric_row['MetricID']]['ShapeFile']] = metric_row['MetricValue']
+            metric_row = metric_curs.fetchone()
+
+        yield visit
+
+
+def parquet_columns(shp_fields, metrics):
+    """
+    :param shp_fields: Dictionary of site field name to OGR field type
+    :param metrics: Dictionary of MetricID to metric definition
+    :return: List of (column name, kind) tuples for a ParquetRecordWriter
+    """
+
+    kinds = {field_type: kind for kind, field_type in ogr_types.items()}
+    columns = [(field, kinds[field_type]) for field, field_type in shp_fields.items()]
+    columns.extend((metric['ShapeFile'], metric_kind(metric)) for metric in metrics.values())
+    return columns
+
+
+def partitioned_export(conn, database, shpPath, metrics, metricSchemaName, parquetPath=None, workers=None):
+    """
+    Split the export by watershed. Worker processes each read and pivot the visits of one
+    watershed and build its CSV rows, then the partitions are written to the CSV and ShapeFile
+    in WatershedID order. Visits are ordered by VisitID within each watershed. The field types
+    are worked out over all the visits first so every partition has the same fields.
+    :param conn: Connection to the CHaMP Workbench database
+    :param database: Path to the CHaMP Workbench database, opened separately by each worker
+    :param shpPath: Absolute path where the ShapeFile will get put.
+    :param metrics: Dictionary of MetricID to metric definition
+    :param metricSchemaName: Name of the metric schema
+    :param parquetPath: Optional absolute path where the visit metrics get written as a Parquet file.
+    :param workers: Number of worker processes. Defaults to the number of CPUs.
+    :return: None
+    """
+
+    with PROFILER.stage('field types') as stage:
+        shp_fields = site_field_types(conn.cursor())
+        stage.rows = len(shp_fields)
+    fields = list(shp_fields.keys())
+    outShape = create_shapefile(shpPath, shp_fields, metrics)
+    parquet = ParquetRecordWriter(parquetPath, parquet_columns(shp_fields, metrics)) if parquetPath else None
+
+    watersheds = [row[0] for row in conn.execute('SELECT DISTINCT W.WatershedID' + visits_from + ' ORDER BY W.WatershedID')]
+    print('Exporting', len(watersheds), 'watersheds')
+
+    fieldCSV = os.path.splitext(shpPath)[0] + ".csv"
+    with open(fieldCSV, 'w') as fieldCSVFile, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        csvwriter = csv.writer(fieldCSVFile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        csvwriter.writerow(fields)
+
+        # map hands back the partitions in the order they were submitted, whichever finishes first
+        partitions = executor.map(functools.partial(export_partition, database, metricSchemaName, metrics, fields), watersheds)
+
+        def visit_points():
+            for csvChunk, visits in partitions:
+                fieldCSVFile.write(csvChunk)
+                for visit in visits:
+                    if parquet:
+                        parquet.write(visit)
+                    yield visit['Longitude'], visit['Latitude'], shapefile_values(visit)
+
+        # The workers' time shows up in the childCpu total of the profile
+        with PROFILER.stage('partitioned export') as stage:
+            count = stage.rows = outShape.writePointFeatures(visit_points())
+
+    if parquet:
+        parquet.close()
+        print('Parquet file written to', parquetPath)
+
+    print(count, 'visits written to', fieldCSV, 'and', shpPath)
+
+
+def export_partition(database, metricSchemaName, metrics, fields, watershedID):
+    """
+    Read and pivot the visits of one watershed. Runs in a worker process.
+    :param database: Path to the CHaMP Workbench database
+    :param metricSchemaName: Name of the metric schema
+    :param metrics: Dictionary of MetricID to metric definition
+    :param fields: Site field names in CSV column order
+    :param watershedID: WatershedID of the partition
+    :return: Tuple of the CSV rows as text and the list of visit dictionaries, both ordered by VisitID
+    """
+
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+
+    visit_curs = conn.cursor()
+    visit_curs.execute('SELECT ' + visits_columns + visits_from + ' AND W.WatershedID = ? ORDER BY V.VisitID', [watershedID])
+
+    metric_curs = conn.cursor()
+    metric_curs.execute('SELECT I.VisitID, MetricID, MetricValue' + metric_values_from +
+        ' AND I.VisitID IN (SELECT PV.VisitID FROM CHaMP_Visits PV INNER JOIN CHaMP_Sites PS ON PV.SiteID = PS.SiteID WHERE PS.WatershedID = ?)' +
+        ' ORDER BY I.VisitID', [metricSchemaName, watershedID])
+
+    csvChunk = io.StringIO()
+    csvwriter = csv.writer(csvChunk, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    visits = []
+    for visit in pivot_visits(visit_curs, metric_curs, metrics):
+        csvwriter.writerow([visit[field] if field in visit else None for field in fields])
+        visits.append(visit)
+
+    conn.close()
+    return csvChunk.getvalue(), visits
+
+
+# Version of the incremental export manifest. Older manifests trigger a full export.
+manifest_version = 1
+
+
+def manifest_path(shpPath):
+    return os.path.splitext(shpPath)[0] + '_manifest.json'
+
+
+def manifest_fields(shp_fields, metrics):
+    """
+    The output fields and their types. A full export is needed whenever these change.
+    :param shp_fields: Dictionary of site field name to OGR field type
+    :param metrics: Dictionary of MetricID to metric definition
+    :return: Sorted list of [field name, OGR field type] lists
+    """
+
+    fields = [[field, field_type] for field, field_type in shp_fields.items()]
+    fields.extend([metric['ShapeFile'], metric['DataType']] for metric in metrics.values())
+    return sorted(fields)
+
+
+def export_state(conn, metricSchemaName):
+    """
+    Fingerprint every exported visit: a hash of its site and visit values and the metric
+    instances that hold its metric values. Metric instances are never edited once loaded
+    into the Workbench so a new batch or a removed instance is the only way metric values change.
+    :param conn: Connection to the CHaMP Workbench database
+    :param metricSchemaName: Name of the metric schema
+    :return: Tuple of a dictionary of VisitID to {'hash', 'instances'} and the sorted list of BatchIDs
+    """
+
+    curs = conn.cursor()
+    curs.execute('SELECT ' + visits_columns + visits_from)
+    field_indexes = site_field_indexes(curs)
+    visits = {}
+    for row in curs:
+        values = [row[index] for shpfield, index in field_indexes]
+        visits[row['VisitID']] = {'hash': hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest(), 'instances': []}
+
+    batches = set()
+    curs.execute('SELECT I.VisitID, I.InstanceID, B.BatchID' + metric_instances_from, [metricSchemaName])
+    for row in curs:
+        # Instances for visits that were filtered out are not part of the export
+        if row['VisitID'] in visits:
+            visits[row['VisitID']]['instances'].append(row['InstanceID'])
+            batches.add(row['BatchID'])
+
     for visit in visits.values():
+        visit['instances'].sort()
+
+    return visits, sorted(batches)
+
+
+def read_manifest(manifestPath):
+    """
+    :param manifestPath: Path to the manifest JSON file
+    :return: The manifest, with integer VisitIDs, or None if there isn't a readable one
+    """
+
+    try:
+        with open(manifestPath) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    manifest['visits'] = {int(visitid): visit for visitid, visit in manifest['visits'].items()}
+    return manifest
+
+
+def write_manifest(manifestPath, metricSchemaName, fields, visits, batches):
+    """
+    Record what was exported so that the next incremental export can work out what changed
+    :param manifestPath: Path to the manifest JSON file
+    :param metricSchemaName: Name of the metric schema
+    :param fields: Output fields from manifest_fields
+    :param visits: Dictionary of VisitID to fingerprint from export_state
+    :param batches: List of the BatchIDs that were exported
+    :return: None
+    """
+
+    manifest = {
+        'version': manifest_version,
+        'schema': metricSchemaName,
+        'exported': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'fields': fields,
+        'batches': batches,
+        'visits': {str(visitid): visit for visitid, visit in visits.items()}
+    }
+
+    # Replace the old manifest in one step so an interrupted run never leaves half a manifest
+    tmpPath = manifestPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmpPath, manifestPath)
+    print('Manifest written to', manifestPath)
+
+
+def incremental_export(conn, shpPath, metrics, metricSchemaName, parquetPath=None):
+    """
+    Update the existing ShapeFile and CSV with only the visits that were added, changed or
+    removed since the last export, as recorded in the manifest. Changed features are replaced
+    in place, new visits are appended to the end and removed visits are deleted.
+    :param conn: Connection to the CHaMP Workbench database
+    :param shpPath: Absolute path to the ShapeFile from the previous export
+    :param metrics: Dictionary of MetricID to metric definition
+    :param metricSchemaName: Name of the metric schema
+    :param parquetPath: Optional Parquet output. Parquet files can't be updated so this forces a full export.
+    :return: False if a full export is needed instead, True once the outputs are up to date
+    """
+
+    manifestPath = manifest_path(shpPath)
+    fieldCSV = os.path.splitext(shpPath)[0] + ".csv"
+    manifest = read_manifest(manifestPath)
+    shp_fields = site_field_types(conn.cursor())
+    fields = manifest_fields(shp_fields, metrics)
+
+    reason = None
+    if not outputFormat(shpPath)['updatable']:
+        reason = '{} files can\'t be updated'.format(outputFormat(shpPath)['name'])
+    elif parquetPath:
+        reason = 'Parquet files can\'t be updated'
+    elif not manifest or not os.path.isfile(shpPath) or not os.path.isfile(fieldCSV):
+        reason = 'there is no previous export'
+    elif manifest['version'] != manifest_version or manifest['schema'] != metricSchemaName:
+        reason = 'the previous export was for a different schema or manifest version'
+    elif manifest['fields'] != fields:
+        reason = 'the output fields have changed'
+
+    if reason:
+        print('Full export needed because', reason)
+        return False
+
+    visits, batches = export_state(conn, metricSchemaName)
+    changed = sorted(visitid for visitid, visit in visits.items() if manifest['visits'].get(visitid) != visit)
+    removed = sorted(set(manifest['visits']) - set(visits))
+    print(len(changed), 'visits added or changed and', len(removed), 'visits removed since', manifest['exported'],
+        'with', len(set(batches) - set(manifest['batches'])), 'new metric batches')
+
+    if changed or removed:
+        changed_visits = load_visits(conn, metrics, metricSchemaName, changed)
+
+        outShape = Shapefile()
+        outShape.openForUpdate(shpPath)
+        fids = outShape.findFeatures('VisitID', changed + removed)
+        count = outShape.updatePointFeatures(
+            [(fids.get(visitid), visit['Longitude'], visit['Latitude'], shapefile_values(visit)) for visitid, visit in changed_visits.items()],
+            [fids[visitid] for visitid in removed if visitid in fids])
+        print(count, 'features updated in', shpPath)
+
+        update_csv(fieldCSV, changed_visits, removed)
+
+    write_manifest(manifestPath, metricSchemaName, fields, visits, batches)
+    return True
+
+
+def load_visits(conn, metrics, metricSchemaName, visitids):
+    """
+    Load the site, visit and metric values for a set of visits. The VisitIDs go in a temporary
+    table so that SQLite only reads the metric values for these visits.
+    :param conn: Connection to the CHaMP Workbench database
+    :param metrics: Dictionary of MetricID to metric definition
+    :param metricSchemaName: Name of the metric schema
+    :param visitids: List of VisitIDs
+    :return: Ordered dictionary of VisitID to dictionary of field name to value
+    """
+
+    curs = conn.cursor()
+    curs.execute('CREATE TEMP TABLE IF NOT EXISTS export_visits (VisitID INTEGER PRIMARY KEY)')
+    curs.execute('DELETE FROM temp.export_visits')
+    curs.executemany('INSERT INTO temp.export_visits (VisitID) VALUES (?)', [(visitid,) for visitid in visitids])
+
+    visits = collections.OrderedDict()
+    curs.execute('SELECT ' + visits_columns + visits_from +
+        ' AND V.VisitID IN (SELECT VisitID FROM temp.export_visits) ORDER BY V.VisitID')
+    field_indexes = site_field_indexes(curs)
+    for row in curs:
+        visits[row['VisitID']] = {shpfield: row[index] for shpfield, index in field_indexes}
+
+    curs.execute('SELECT I.VisitID, MetricID, MetricValue' + metric_values_from +
+        ' AND I.VisitID IN (SELECT VisitID FROM temp.export_visits)', [metricSchemaName])
+    for row in curs:
+        visits[row['VisitID']][metrics[row['MetricID']]['ShapeFile']] = row['MetricValue']
+
+    return visits
+
+
+def update_csv(fieldCSV, visits, removed):
+    """
+    Rewrite the site CSV, replacing the rows of changed visits, dropping removed visits
+    and appending new ones. Unchanged rows are copied across as they are.
+    :param fieldCSV: Path to the CSV file
+    :param visits: Dictionary of VisitID to dictionary of field name to value for the changed visits
+    :param removed: VisitIDs of the visits to remove
+    :return: None
+    """
+
+    replacements = collections.OrderedDict((str(visitid), visit) for visitid, visit in visits.items())
+    removed = set(str(visitid) for visitid in removed)
+
+    tmpPath = fieldCSV + '.tmp'
+    with open(fieldCSV) as src, open(tmpPath, 'w') as dst:
+        csvreader = csv.reader(src)
+        csvwriter = csv.writer(dst, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        header = next(csvreader)
+        csvwriter.writerow(header)
+        visitidCol = header.index('VisitID')
 
-        outFeature = ogr.Feature(featureDefn)
-        geom = Point(float(visit['Longitude']), float(visit['Latitude']))
-        ogrPoint = ogr.CreateGeometryFromJson(json.dumps(mapping(geom)))
-        outFeature.SetGeometry(ogrPoint)
-        [outFeature.SetField(fieldName, fieldValue) for fieldName, fieldValue in visit.items() if fieldValue]
-        outShape.layer.CreateFeature(outFeature)
+        for row in csvreader:
+            visitid = row[visitidCol]
+            if visitid in removed:
+                continue
+            visit = replacements.pop(visitid, None)
+            csvwriter.writerow(row if visit is None else [visit.get(field) for field in header])
 
+        for visit in replacements.values():
+            csvwriter.writerow([visit.get(field) for field in header])
 
-def SitesOnNetworkProject(dirPath, metricSchemaName, shpPath, csvPath):
+    os.replace(tmpPath, fieldCSV)
+    print('CSV file updated', fieldCSV)
+
+
+# Indexes that let the exporter queries look rows up instead of scanning whole tables.
+# The metric value indexes include every column the queries need so they are covering.
+exporter_indexes = {
+    'Metric_Schemas': ('IX_Metric_Schemas_Title', 'Metric_Schemas (Title, SchemaID)'),
+    'Metric_Schema_Definitions': ('IX_Metric_Schema_Definitions_SchemaID', 'Metric_Schema_Definitions (SchemaID, MetricID)'),
+    'Metric_Batches': ('IX_Metric_Batches_SchemaID', 'Metric_Batches (SchemaID, BatchID)'),
+    'Metric_Instances': ('IX_Metric_Instances_BatchID', 'Metric_Instances (BatchID, InstanceID, VisitID)'),
+    'Metric_VisitMetrics': ('IX_Metric_VisitMetrics_InstanceID', 'Metric_VisitMetrics (InstanceID, MetricID, MetricValue)'),
+    'CHaMP_Sites': ('IX_CHaMP_Sites_WatershedID', 'CHaMP_Sites (WatershedID)')
+}
+
+
+def exporter_queries(metricSchemaName):
+    """
+    The queries that the exporter runs against the Workbench
+    :param metricSchemaName: Name of the metric schema
+    :return: List of (description, SQL, parameters, table aliases) tuples
+    """
+
+    return [
+        ('metric definitions', metric_definitions_query, [metricSchemaName],
+            {'MD': 'Metric_Definitions', 'MSD': 'Metric_Schema_Definitions', 'S': 'Metric_Schemas'}),
+        ('visits', 'SELECT ' + visits_columns + visits_from + ' ORDER BY V.VisitID', [],
+            {'V': 'CHaMP_Visits', 'S': 'CHaMP_Sites', 'W': 'CHaMP_Watersheds'}),
+        ('metric values', 'SELECT I.VisitID, MetricID, MetricValue' + metric_values_from + ' ORDER BY I.VisitID', [metricSchemaName],
+            {'S': 'Metric_Schemas', 'B': 'Metric_Batches', 'I': 'Metric_Instances', 'VM': 'Metric_VisitMetrics'}),
+        ('metric instances', 'SELECT I.VisitID, I.InstanceID, B.BatchID' + metric_instances_from, [metricSchemaName],
+            {'S': 'Metric_Schemas', 'B': 'Metric_Batches', 'I': 'Metric_Instances'})
+    ]
+
+
+def full_table_scans(conn, metricSchemaName):
+    """
+    Use EXPLAIN QUERY PLAN to find the tables that the exporter queries read from start to finish
+    :param conn: Connection to the CHaMP Workbench database
+    :param metricSchemaName: Name of the metric schema
+    :return: List of (query description, table name, plan detail) tuples
+    """
+
+    scans = []
+    curs = conn.cursor()
+    for description, sql, params, aliases in exporter_queries(metricSchemaName):
+        curs.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        for row in curs.fetchall():
+            detail = row[3]
+            words = detail.split()
+            # Older SQLite versions say "SCAN TABLE X", newer ones just "SCAN X"
+            if words[0] == 'SCAN' and 'USING' not in words:
+                table = words[2] if words[1] == 'TABLE' else words[1]
+                scans.append((description, aliases.get(table, table), detail))
+    return scans
+
+
+def ensure_indexes(database, metricSchemaName, copyPath=None):
+    """
+    Report the full table scans in the exporter queries and create the indexes that avoid them.
+    Indexes are created in a copy of the database if one is requested, otherwise only after the
+    user agrees to modify the Workbench.
+    :param database: CHaMP Workbench SQLite database
+    :param metricSchemaName: Name of the metric schema
+    :param copyPath: Optional path where a copy of the database is made and indexed.
+    :return: Path to the database that the export should use
+    """
+
+    conn = sqlite3.connect(database)
+    scans = full_table_scans(conn, metricSchemaName)
+    for description, table, detail in scans:
+        print('Full scan in {} query: {}'.format(description, detail))
+
+    # Indexing one table often just moves the scan to the next table in the join so
+    # create the whole set as soon as any table is being scanned without its index.
+    existing = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    missing = {table: index for table, index in exporter_indexes.items() if index[0] not in existing}
+    conn.close()
+
+    if not any(table in missing for description, table, detail in scans):
+        print('No indexes needed for the exporter queries')
+        return database
+    statements = ['CREATE INDEX IF NOT EXISTS {} ON {}'.format(name, columns) for name, columns in missing.values()]
+
+    if copyPath:
+        print('Copying database to', copyPath)
+        shutil.copyfile(database, copyPath)
+        database = copyPath
+    elif not query_yes_no('Create {} indexes in {}?'.format(len(statements), database), default="no"):
+        return database
+
+    conn = sqlite3.connect(database)
+    for statement in statements:
+        print(statement)
+        conn.execute(statement)
+
+    # Give the query planner the statistics it needs to choose the new indexes
+    conn.execute('ANALYZE')
+    conn.commit()
+
+    for description, table, detail in full_table_scans(conn, metricSchemaName):
+        print('Remaining full scan in {} query: {}'.format(description, detail))
+    conn.close()
+
+    return database
+
+
+def SitesOnNetworkProject(dirPath, metricSchemaName, shpPath, csvPath, parquetPath=None):
     """
     Create a Sites on Network riverscapes project file
     :param dirPath: Directory where the project file will get created. Must exist already.
     :param metricSchemaName: Name of the metric schema being downloaded.
     :param shpPath: Absolute path to the ShapeFile containing metrics
     :param csvPath: Absolute path to the CSV file containing metrics.
+    :param parquetPath: Optional absolute path to the Parquet file containing metrics.
     :return: None
     """
 
@@ -262,13 +1053,18 @@ def SitesOnNetworkProject(dirPath, metricSchemaName, shpPath, csvPath):
 
     nodOutputs = ET.SubElement(nodAnalysis, 'Outputs')
     nodVector = ET.SubElement(nodOutputs, 'Vector')
-    ET.SubElement(nodVector, 'Name').text = 'Topo Metrics ShapeFile'
+    ET.SubElement(nodVector, 'Name').text = 'Topo Metrics ' + outputFormat(shpPath)['name']
     ET.SubElement(nodVector, 'Path').text = shpPath.replace(dirPath + os.sep,'')
 
     nodCSV = ET.SubElement(nodOutputs, 'CSV')
     ET.SubElement(nodCSV, 'Name').text = 'Topo Metrics CSV'
     ET.SubElement(nodCSV, 'Path').text = csvPath.replace(dirPath + os.sep, '')
 
+    if parquetPath:
+        nodParquet = ET.SubElement(nodOutputs, 'File')
+        ET.SubElement(nodParquet, 'Name').text = 'Topo Metrics Parquet'
+        ET.SubElement(nodParquet, 'Path').text = parquetPath.replace(dirPath + os.sep, '')
+
     projectXMLPath = os.path.join(dirPath, 'project.rs.xml')
     rough_string = ET.tostring(tree.getroot(), 'utf-8')
     reparsed = xml.dom.minidom.parseString(rough_string)
@@ -277,23 +1073,37 @@ def SitesOnNetworkProject(dirPath, metricSchemaName, shpPath, csvPath):
     f.write(pretty)
     f.close()
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
-
 def main():
     # parse command line options
     parser = argparse.ArgumentParser()
     parser.add_argument('outdir', type=str, help='Riverscapes project output directory')
     parser.add_argument('database', type=argparse.FileType('r'), help='CHaMP workbench database path')
-    parser.add_argument('metricschema', type=str, help='metric schema name')
+    parser.add_argument('metricschema', type=str, nargs='+', help='metric schema name. Several names, or all, export a project for each schema')
     parser.add_argument('--logfile',  type=str,   help='write the output of this script to a file')
+    parser.add_argument('--engine', choices=['python', 'sql', 'partitioned'], default='python', help='pivot metrics in Python, stream them merged from SQLite or split the export by watershed across worker processes')
+    parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS.keys()), default='shp', help='point output format')
+    parser.add_argument('--parquet', action='store_true', help='also write the visit metrics as a Parquet file')
+    parser.add_argument('--incremental', action='store_true', help='only update the visits that changed since the last incremental export')
+    parser.add_argument('--workers', type=int, help='worker processes for several metric schemas or the partitioned engine')
+    parser.add_argument('--field-registry', type=str, help='folder of field name registries that keep metric field names the same from run to run')
+    parser.add_argument('--profile', type=str, help='write the time, rows and memory of each stage to this JSON file')
+    parser.add_argument('--cprofile', action='store_true', help='with --profile, also run cProfile and include the slowest functions')
+    parser.add_argument('--ensure-indexes', action='store_true', help='report full table scans and create the indexes that avoid them')
+    parser.add_argument('--index-copy', type=str, help='with --ensure-indexes, index a copy of the database at this path and export from it')
     args = parser.parse_args()
 
     try:
-        CreateSiteMetricsProject(args.outdir, args.database.name, args.metricschema)
+        if args.cprofile:
+            PROFILER.enableCProfile()
+
+        database = args.database.name
+        if args.ensure_indexes:
+            database = ensure_indexes(database, args.metricschema[0], args.index_copy)
+
+        if len(args.metricschema) > 1 or args.metricschema == ['all']:
+            CreateSiteMetricsProjects(args.outdir, database, args.metricschema, args.format, args.parquet, args.incremental, args.workers, args.field_registry)
+        else:
+            CreateSiteMetricsProject(args.outdir, database, args.metricschema[0], args.engine, args.format, args.parquet, args.incremental, workers=args.workers, registryDir=args.field_registry)
 
     except AssertionError as e:
         print("Assertion Error", e)
@@ -302,6 +1112,10 @@ def main():
         print('Unexpected error: {0}'.format(sys.exc_info()[0]), e)
         raise
         sys.exit(1)
+    finally:
+        # A failed or interrupted run is the one most worth profiling
+        if args.profile:
+            PROFILER.write(args.profile)
 
 if __name__ == '__main__':
     main()
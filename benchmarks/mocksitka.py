@@ -0,0 +1,627 @@
+"""
+Local stand-in for the Sitka API and the Keystone token service, serving generated data.
+
+It answers the calls SitesOnNetwork.py and lib/sitkaAPI.py make: the token, watersheds,
+sites, site detail, visits, the metrics of a schema, the listing and deletion of a
+schema's instances and each visit's field folders and files. Any schema name is accepted.
+Latency, bandwidth, error rates and payload sizes can be set so the API exporter's
+throughput, retries and memory can be measured offline. Runs on Python 2 and 3.
+
+    python benchmarks/mocksitka.py --port 8800 --sites 2000 --latency 0.05 --error-rate 0.01 --write-env mock.env
+    python2 SitesOnNetwork.py out "Some Schema" --env mock.env --workers 8 --profile profile.json
+"""
+import argparse
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlparse
+except ImportError:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlparse
+
+api_prefix = '/api'
+field_folder_names = ['Photos', 'Topo']
+token_path = '/keystone/connect/token'
+
+
+class MockConfig(object):
+    """
+    Size of the generated data and how badly the server behaves
+    """
+
+    def __init__(self, watersheds=12, sites=2000, visits_per_site=3, metrics=300, padding=0, latency=0.0, jitter=0.0,
+                 bandwidth=0, error_rate=0.0, throttle_rate=0.0, reset_rate=0.0, retry_after=1, token_ttl=3600, seed=1, drop_rate=0.0,
+                 field_files=2, field_file_size=65536, full_sites=False):
+        """
+        :param watersheds: Number of watersheds
+        :param sites: Number of sites
+        :param visits_per_site: Number of visits at each site
+        :param metrics: Number of metric values for each visit
+        :param padding: Extra bytes added to every site, visit and metric object
+        :param latency: Seconds before each response starts
+        :param jitter: Up to this many random extra seconds of latency
+        :param bandwidth: Bytes per second each response is sent at. 0 for no limit.
+        :param error_rate: Fraction of API calls that fail with a 500 or 503
+        :param throttle_rate: Fraction of API calls that get a 429 with a Retry-After header
+        :param reset_rate: Fraction of API calls where the connection is closed without a response
+        :param retry_after: Seconds sent in the Retry-After header of a 429
+        :param token_ttl: Seconds until a token expires. Calls with an unknown or expired token get a 401.
+        :param seed: Random seed. The same seed always gives the same data.
+        :param drop_rate: Fraction of metrics calls and file downloads where the connection is dropped part way through the body
+        :param field_files: Number of files in each of a visit's field folders
+        :param field_file_size: Size in bytes of each field file
+        :param full_sites: Include every site field in the sites call, not just the name, url and watershed
+        """
+        self.watersheds = watersheds
+        self.sites = sites
+        self.visits_per_site = visits_per_site
+        self.metrics = metrics
+        self.padding = padding
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.reset_rate = reset_rate
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.seed = seed
+        self.drop_rate = drop_rate
+        self.field_files = field_files
+        self.field_file_size = field_file_size
+        self.full_sites = full_sites
+
+
+class MockData(object):
+    """
+    The generated watersheds, sites and visits. Metric values are generated per visit as they are
+    sent so a production sized metrics call never has to be held in memory.
+    """
+
+    def __init__(self, config, base_url):
+        self.config = config
+        self.base_url = base_url
+        rnd = random.Random(config.seed)
+        pad = 'x' * config.padding
+
+        self.watersheds = []
+        for wid in range(1, config.watersheds + 1):
+            self.watersheds.append({'id': wid, 'name': 'Watershed {}'.format(wid), 'url': '{}/watersheds/{}'.format(base_url, wid)})
+
+        self.sites = []
+        self.visits = []
+        visitid = 1
+        for number in range(1, config.sites + 1):
+            watershed = rnd.choice(self.watersheds)
+            name = 'CBW05583-{:06d}'.format(number)
+            site = {
+                'name': name,
+                'url': '{}/sites/{}'.format(base_url, name),
+                'watershedName': watershed['name'],
+                'watershedUrl': watershed['url'],
+                'locale': 'Stream {}'.format(number % 300),
+                'latitude': round(rnd.uniform(43, 48), 6),
+                'longitude': round(rnd.uniform(-124, -111), 6),
+                'visits': []
+            }
+            for year in range(config.visits_per_site):
+                # A few visits have not been sampled yet
+                visit = {
+                    'id': visitid,
+                    'url': '{}/visits/{}'.format(base_url, visitid),
+                    'siteUrl': site['url'],
+                    'sampleYear': None if rnd.random() < 0.05 else 2011 + year,
+                    'hasMetrics': rnd.random() >= 0.1
+                }
+                if pad:
+                    visit['notes'] = pad
+                site['visits'].append(visit)
+                self.visits.append(visit)
+                visitid += 1
+            if pad:
+                site['notes'] = pad
+            self.sites.append(site)
+
+        self.site_index = dict((site['name'], site) for site in self.sites)
+        self.watershed_index = dict((str(watershed['id']), watershed) for watershed in self.watersheds)
+        self.visit_index = dict((str(visit['id']), visit) for visit in self.visits)
+
+        # Instance ids deleted from each schema, and the schemas that have been deleted
+        self._deleted = {}
+        self._deleted_schemas = set()
+        self._delete_lock = threading.Lock()
+
+    def site_summary(self, site):
+        if self.config.full_sites:
+            return dict((key, value) for key, value in site.items() if key != 'visits')
+        return dict((key, site[key]) for key in ('name', 'url', 'watershedName', 'watershedUrl'))
+
+    def site_detail(self, site):
+        detail = dict(site)
+        detail['visits'] = [self.visit_summary(visit) for visit in site['visits']]
+        return detail
+
+    def visit_summary(self, visit):
+        return dict((key, value) for key, value in visit.items() if key != 'hasMetrics')
+
+    def watershed_detail(self, watershed):
+        detail = dict(watershed)
+        detail['sites'] = [{'name': site['name'], 'url': site['url']} for site in self.sites if site['watershedUrl'] == watershed['url']]
+        return detail
+
+    def field_folders(self):
+        return [{'name': name} for name in field_folder_names]
+
+    def field_file(self, visit, folder, name):
+        """
+        :return: The contents of a field file, the same every time it is asked for
+        """
+        line = '{} {} {} {}\n'.format(self.config.seed, visit['id'], folder, name).encode('utf-8')
+        return (line * (self.config.field_file_size // len(line) + 1))[:self.config.field_file_size]
+
+    def field_files(self, visit, folder):
+        files = []
+        for index in range(1, self.config.field_files + 1):
+            name = 'file_{}.dat'.format(index)
+            files.append({
+                'name': name,
+                'url': '{}/files/{}/{}/{}'.format(self.base_url, visit['id'], folder, name),
+                'size': self.config.field_file_size,
+                'md5': hashlib.md5(self.field_file(visit, folder, name)).hexdigest()
+            })
+        return files
+
+    def metric_item(self, visit):
+        """
+        :return: The metrics object of one visit, the same every time it is asked for
+        """
+        rnd = random.Random(self.config.seed * 1000003 + visit['id'])
+        values = []
+        for index in range(self.config.metrics):
+            if index % 6 == 0:
+                values.append({'name': 'Metric_String_{}'.format(index), 'type': 'String', 'value': 'Class {}'.format(rnd.randint(1, 5))})
+            else:
+                value = None if rnd.random() < 0.02 else round(rnd.uniform(0, 100), 6)
+                values.append({'name': 'Metric_Value_{}'.format(index), 'type': 'Numeric', 'value': value})
+        item = {'itemUrl': visit['url'], 'values': values}
+        if self.config.padding:
+            item['notes'] = 'x' * self.config.padding
+        return item
+
+    def instances(self, schema):
+        """
+        :return: The schema with the instances that have not been deleted, or None if the schema was deleted
+        """
+        key = schema.lower()
+        with self._delete_lock:
+            if key in self._deleted_schemas:
+                return None
+            deleted = set(self._deleted.get(key, ()))
+        url = '{}/visit/metricschemas/{}'.format(self.base_url, schema)
+        return {'name': schema, 'url': url, 'instances': [
+            {'id': visit['id'], 'url': '{}/instances/{}'.format(url, visit['id'])}
+            for visit in self.visits if visit['hasMetrics'] and str(visit['id']) not in deleted]}
+
+    def delete_instance(self, schema, instance):
+        """
+        :return: False if there is no such instance
+        """
+        key = schema.lower()
+        visit = self.visit_index.get(instance)
+        with self._delete_lock:
+            deleted = self._deleted.setdefault(key, set())
+            if key in self._deleted_schemas or visit is None or not visit['hasMetrics'] or instance in deleted:
+                return False
+            deleted.add(instance)
+        return True
+
+    def delete_schema(self, schema):
+        with self._delete_lock:
+            if schema.lower() in self._deleted_schemas:
+                return False
+            self._deleted_schemas.add(schema.lower())
+        return True
+
+    def metric_items(self):
+        for visit in self.visits:
+            if visit['hasMetrics']:
+                yield self.metric_item(visit)
+
+
+class MockStats(object):
+    """
+    Counts of the calls and bytes served, by route and status
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.routes = {}
+        self.statuses = {}
+        self.bytes = 0
+        self.resets = 0
+
+    def record(self, route, status, nbytes):
+        with self._lock:
+            self.routes[route] = self.routes.get(route, 0) + 1
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            self.bytes += nbytes
+
+    def record_reset(self):
+        with self._lock:
+            self.resets += 1
+
+    def report(self):
+        with self._lock:
+            return {
+                'seconds': round(time.time() - self.started, 3),
+                'calls': sum(self.routes.values()),
+                'routes': dict(self.routes),
+                'statuses': dict(self.statuses),
+                'bytes': self.bytes,
+                'resets': self.resets
+            }
+
+
+class MockSitkaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately so don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+    def do_DELETE(self):
+        self.handle_call('DELETE')
+
+    def handle_call(self, method):
+        url = urlparse(self.path)
+        path = unquote(url.path).rstrip('/')
+        if method == 'POST':
+            self.read_body()
+
+        if method == 'POST' and path == token_path:
+            return self.issue_token()
+        if method == 'GET' and path == '/_stats':
+            return self.send_json('stats', self.server.stats.report())
+        if not path.startswith(api_prefix):
+            return self.send_error_json('unknown', 404, 'Not found')
+
+        if not self.simulate_trouble():
+            return
+        if not self.server.check_token(self.headers.get('Authorization')):
+            return self.send_error_json('unauthorized', 401, 'Invalid or expired token')
+
+        data = self.server.data
+        parts = path[len(api_prefix):].strip('/').split('/')
+        route = [part.lower() for part in parts]
+
+        if route == ['watersheds']:
+            return self.send_json('watersheds', data.watersheds)
+        if len(route) == 2 and route[0] == 'watersheds' and parts[1] in data.watershed_index:
+            return self.send_json('watershed', data.watershed_detail(data.watershed_index[parts[1]]))
+        if route == ['sites']:
+            return self.send_json('sites', [data.site_summary(site) for site in data.sites])
+        if len(route) == 2 and route[0] == 'sites' and parts[1] in data.site_index:
+            return self.send_json('site', data.site_detail(data.site_index[parts[1]]))
+        if route == ['visits']:
+            return self.send_json('visits', [data.visit_summary(visit) for visit in data.visits])
+        if len(route) >= 3 and route[0] == 'visits' and route[2] == 'fieldfolders' and parts[1] in data.visit_index:
+            visit = data.visit_index[parts[1]]
+            if len(route) == 3:
+                return self.send_json('field folders', data.field_folders())
+            if len(route) == 4 and parts[3] in field_folder_names:
+                return self.send_json('field files', data.field_files(visit, parts[3]))
+        if len(route) == 4 and route[0] == 'files' and parts[1] in data.visit_index and parts[2] in field_folder_names:
+            return self.send_file('file', data.field_file(data.visit_index[parts[1]], parts[2], parts[3]))
+        if method == 'GET' and len(route) == 4 and route[:2] == ['visit', 'metricschemas'] and route[3] == 'metrics':
+            return self.send_json_array('metrics', data.metric_items())
+        if len(route) == 3 and route[:2] == ['visit', 'metricschemas']:
+            if method == 'GET':
+                schema = data.instances(parts[2])
+                if schema is not None:
+                    return self.send_json('instances', schema, cacheable=False)
+            elif method == 'DELETE' and data.delete_schema(parts[2]):
+                return self.send_json('delete schema', {'name': parts[2]}, cacheable=False)
+        if method == 'DELETE' and len(route) == 5 and route[:2] == ['visit', 'metricschemas'] and route[3] == 'instances':
+            if data.delete_instance(parts[2], parts[4]):
+                return self.send_json('delete instance', {'id': int(parts[4])}, cacheable=False)
+
+        return self.send_error_json('unknown', 404, 'Not found')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def simulate_trouble(self):
+        """
+        Wait out the latency and maybe fail the call
+        :return: False if the call has already been answered with an error
+        """
+        config = self.server.config
+        delay = config.latency + (random.uniform(0, config.jitter) if config.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        roll = random.random()
+        if roll < config.reset_rate:
+            self.drop_connection()
+            return False
+        roll -= config.reset_rate
+        if roll < config.throttle_rate:
+            self.send_error_json('throttled', 429, 'Too many requests', {'Retry-After': str(config.retry_after)})
+            return False
+        roll -= config.throttle_rate
+        if roll < config.error_rate:
+            self.send_error_json('error', random.choice([500, 503]), 'Simulated server error')
+            return False
+        return True
+
+    def drop_connection(self):
+        self.server.stats.record_reset()
+        self.close_connection = True
+        try:
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def issue_token(self):
+        token, expires_in = self.server.new_token()
+        self.send_json('token', {'access_token': token, 'token_type': 'bearer', 'expires_in': expires_in})
+
+    def etag(self):
+        # The data only depends on the seed and the sizes so the path is enough to identify a response
+        config = self.server.config
+        key = '{} {} {} {} {} {} {}'.format(self.path, config.seed, config.watersheds, config.sites,
+                                            config.visits_per_site, config.metrics, config.padding)
+        return '"{}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def not_modified(self, route, etag):
+        if self.headers.get('If-None-Match') != etag:
+            return False
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.stats.record(route, 304, 0)
+        return True
+
+    def send_json(self, route, obj, status=200, headers=None, cacheable=True):
+        body = json.dumps(obj).encode('utf-8')
+        # Only responses that depend on nothing but the generated data get an ETag
+        etag = self.etag() if status == 200 and cacheable else None
+        if etag and self.not_modified(route, etag):
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.write_throttled(body)
+        self.server.stats.record(route, status, len(body))
+
+    def send_error_json(self, route, status, message, headers=None):
+        self.send_json(route, {'message': message}, status, headers)
+
+    def send_file(self, route, body):
+        """
+        Send a file, honouring a Range header of the form bytes=start-
+        """
+        status = 200
+        start = 0
+        ranged = self.headers.get('Range')
+        if ranged and ranged.startswith('bytes=') and ranged[6:].rstrip('-').isdigit():
+            start = int(ranged[6:].rstrip('-'))
+            if start >= len(body):
+                return self.send_error_json(route, 416, 'Range not satisfiable', {'Content-Range': 'bytes */{}'.format(len(body))})
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+        self.end_headers()
+
+        # Maybe drop the connection part way through
+        if random.random() < self.server.config.drop_rate:
+            cut = random.randint(start, len(body) - 1)
+            self.write_throttled(body[start:cut])
+            self.drop_connection()
+            self.server.stats.record(route, status, cut - start)
+            return
+        self.write_throttled(body[start:])
+        self.server.stats.record(route, status, len(body) - start)
+
+    def send_json_array(self, route, items):
+        """
+        Send a JSON array with chunked transfer encoding, generating the items as it goes
+        """
+        etag = self.etag()
+        if self.not_modified(route, etag):
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        # Maybe drop the connection somewhere in the first half of the body
+        drop_after = None
+        if random.random() < self.server.config.drop_rate:
+            drop_after = random.randint(0, len(self.server.data.visits) // 2)
+
+        total = 0
+        separator = b'['
+        for count, item in enumerate(items):
+            if count == drop_after:
+                self.drop_connection()
+                self.server.stats.record(route, 200, total)
+                return
+            total += self.write_chunk(separator + json.dumps(item).encode('utf-8'))
+            separator = b','
+        total += self.write_chunk(b'[]' if separator == b'[' else b']')
+        self.wfile.write(b'0\r\n\r\n')
+        self.server.stats.record(route, 200, total)
+
+    def write_chunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii'))
+        self.write_throttled(data)
+        self.wfile.write(b'\r\n')
+        return len(data)
+
+    def write_throttled(self, data):
+        bandwidth = self.server.config.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+
+        block = max(1024, bandwidth // 10)
+        for start in range(0, len(data), block):
+            piece = data[start:start + block]
+            self.wfile.write(piece)
+            time.sleep(len(piece) / float(bandwidth))
+
+
+class MockSitkaServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server holding the generated data, the issued tokens and the call statistics
+    """
+    daemon_threads = True
+
+    def __init__(self, address, config, verbose=False):
+        HTTPServer.__init__(self, address, MockSitkaHandler)
+        self.config = config
+        self.verbose = verbose
+        self.base_url = 'http://{}:{}{}'.format(address[0] or 'localhost', self.server_address[1], api_prefix)
+        self.token_url = 'http://{}:{}{}'.format(address[0] or 'localhost', self.server_address[1], token_path)
+        self.data = MockData(config, self.base_url)
+        self.stats = MockStats()
+        self._tokens = {}
+        self._token_lock = threading.Lock()
+
+    def new_token(self):
+        with self._token_lock:
+            # Unique across restarts so a token from an earlier server is never accepted
+            token = 'mock-{}'.format(uuid.uuid4().hex)
+            self._tokens[token] = time.time() + self.config.token_ttl
+        return token, self.config.token_ttl
+
+    def check_token(self, authorization):
+        if not authorization or not authorization.lower().startswith('bearer '):
+            return False
+        with self._token_lock:
+            expires = self._tokens.get(authorization[7:].strip())
+        return expires is not None and expires > time.time()
+
+    def environment(self):
+        """
+        :return: List of (name, value) tuples of the environment settings that point the API exporter at this server
+        """
+        return [
+            ('API_BASE_URL', self.base_url),
+            ('KEYSTONE_URL', self.token_url),
+            ('KEYSTONE_USER', 'mock'),
+            ('KEYSTONE_PASS', 'mock'),
+            ('KEYSTONE_CLIENT_ID', 'mock'),
+            ('KEYSTONE_CLIENT_SECRET', 'mock')
+        ]
+
+    def write_environment(self, path):
+        with open(path, 'w') as f:
+            for name, value in self.environment():
+                f.write('{}={}\n'.format(name, value))
+
+
+def start_server(config, host='localhost', port=0, verbose=False):
+    """
+    Start the mock server on a background thread
+    :param config: MockConfig
+    :param host: Interface to listen on
+    :param port: Port to listen on. 0 picks a free one.
+    :param verbose: Log every call
+    :return: The running MockSitkaServer. Call shutdown() to stop it.
+    """
+    server = MockSitkaServer((host, port), config, verbose)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve generated data as a local stand-in for the Sitka API')
+    parser.add_argument('--host', type=str, default='localhost', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8800, help='port to listen on. 0 picks a free one')
+    parser.add_argument('--watersheds', type=int, default=12, help='number of watersheds')
+    parser.add_argument('--sites', type=int, default=2000, help='number of sites')
+    parser.add_argument('--visits-per-site', type=int, default=3, help='number of visits at each site')
+    parser.add_argument('--metrics', type=int, default=300, help='number of metric values for each visit')
+    parser.add_argument('--padding', type=int, default=0, help='extra bytes added to every site, visit and metric object')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response starts')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many random extra seconds of latency')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second each response is sent at')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail with a 500 or 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls that get a 429 with Retry-After')
+    parser.add_argument('--reset-rate', type=float, default=0.0, help='fraction of calls where the connection is dropped')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of metrics calls and file downloads dropped part way through the body')
+    parser.add_argument('--field-files', type=int, default=2, help='number of files in each field folder of a visit')
+    parser.add_argument('--field-file-size', type=int, default=65536, help='size in bytes of each field file')
+    parser.add_argument('--full-sites', action='store_true', help='include every site field in the sites call, not just the name, url and watershed')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds sent in the Retry-After header of a 429')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='seconds until a token expires')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the generated data')
+    parser.add_argument('--write-env', type=str, help='write the settings that point the API exporter at this server to this file')
+    parser.add_argument('--verbose', action='store_true', help='log every call')
+    args = parser.parse_args()
+
+    config = MockConfig(args.watersheds, args.sites, args.visits_per_site, args.metrics, args.padding, args.latency, args.jitter,
+                        args.bandwidth, args.error_rate, args.throttle_rate, args.reset_rate, args.retry_after, args.token_ttl, args.seed,
+                        args.drop_rate, args.field_files, args.field_file_size, args.full_sites)
+    server = MockSitkaServer((args.host, args.port), config, args.verbose)
+
+    for name, value in server.environment():
+        print('{}={}'.format(name, value))
+    if args.write_env:
+        server.write_environment(args.write_env)
+        print('Settings written to {}'.format(args.write_env))
+    print('Serving {} sites and {} visits. Press Ctrl+C to stop.'.format(len(server.data.sites), len(server.data.visits)))
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats.report(), indent=1, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Time SitesOnNetworkDB exports of a synthetic Workbench database and keep a history of the results.
+
+Each run exports the first synthetic schema in a fresh process so the peak memory and the
+stage timings of one run don't leak into the next. The best and median of the repeated runs
+of each engine are appended to a JSON history along with the commit and machine they ran on,
+and compared to the last entry in the history that used the same parameters.
+
+    python benchmarks/run.py --sites 2000 --metrics 150 --engines python sql --repeat 3
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchmarkDir)
+sys.path.insert(0, repoDir)
+
+from workbench import create_workbench, schema_name
+
+engines = ['python', 'sql', 'partitioned']
+
+
+def workbench_path(dataDir, params):
+    """
+    Generated databases are kept and reused, named after the parameters that made them
+    :param dataDir: Folder of the generated databases
+    :param params: Dictionary of the create_workbench parameters
+    :return: Absolute path of the database
+    """
+    name = 'workbench_s{sites}_v{visits_per_site}_m{metrics}_c{schemas}_b{batches}_r{seed}.db'.format(**params)
+    return os.path.join(dataDir, name)
+
+
+def git_revision():
+    """
+    :return: Tuple of the commit hash of the checkout and whether it has uncommitted changes. (None, None) outside git.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repoDir).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repoDir).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def run_once(database, engine, vectorFormat, parquet, workers, resultPath):
+    """
+    Export the first synthetic schema once and write its timings as JSON. Runs in its own process.
+    """
+    from lib.shapefileloader import OUTPUT_FORMATS
+    from lib.profiler import PROFILER, peakRSS
+    import SitesOnNetworkDB
+
+    outDir = tempfile.mkdtemp(prefix='sitesonnetwork_benchmark_')
+    try:
+        shpPath = os.path.join(outDir, 'TopoMetrics' + OUTPUT_FORMATS[vectorFormat]['extension'])
+        csvPath = os.path.join(outDir, 'Metrics.csv')
+        parquetPath = os.path.join(outDir, 'Metrics.parquet') if parquet else None
+
+        PROFILER.reset()
+        started = time.time()
+        SitesOnNetworkDB.SitesOnANetwork(shpPath, csvPath, database, schema_name(0), engine, parquetPath, workers=workers)
+        wall = time.time() - started
+        report = PROFILER.report()
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
+
+    result = OrderedDict([
+        ('wall', round(wall, 4)),
+        ('cpu', report['cpu']),
+        ('childCpu', report['childCpu']),
+        ('peakRSS', peakRSS()),
+        ('stages', OrderedDict((stage['name'], stage['wall']) for stage in report['stages']))
+    ])
+    with open(resultPath, 'w') as f:
+        json.dump(result, f)
+
+
+def benchmark_engine(database, engine, args):
+    """
+    Run the export repeat times, each in a new process
+    :return: Dictionary of the runs with the best and median of each stage
+    """
+    runs = []
+    handle, resultPath = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        for repeat in range(args.repeat):
+            command = [sys.executable, os.path.abspath(__file__), '--run-once', database, '--engines', engine,
+                       '--format', args.format, '--result', resultPath]
+            if args.parquet:
+                command.append('--parquet')
+            if args.workers:
+                command += ['--workers', str(args.workers)]
+
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(command, cwd=repoDir, stdout=None if args.verbose else devnull)
+            with open(resultPath) as f:
+                runs.append(json.load(f, object_pairs_hook=OrderedDict))
+            print('{:<12} run {}: {:.3f}s'.format(engine, repeat + 1, runs[-1]['wall']))
+    finally:
+        os.remove(resultPath)
+
+    return summarise(runs)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarise(runs):
+    """
+    :param runs: Results of the repeated runs, each with wall, peakRSS and stages of stage name: seconds
+    :return: Dictionary of the best and median wall time and of each stage, with every run included
+    """
+    walls = [run['wall'] for run in runs]
+    stages = OrderedDict()
+    for name in runs[0]['stages']:
+        times = [run['stages'].get(name, 0.0) for run in runs]
+        stages[name] = OrderedDict([('best', min(times)), ('median', round(median(times), 4))])
+
+    return OrderedDict([
+        ('best', min(walls)),
+        ('median', round(median(walls), 4)),
+        ('peakRSS', max(run['peakRSS'] for run in runs) if runs[0]['peakRSS'] is not None else None),
+        ('stages', stages),
+        ('runs', runs)
+    ])
+
+
+def read_history(historyPath):
+    if not os.path.isfile(historyPath):
+        return []
+    with open(historyPath) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def write_history(historyPath, history):
+    tmpPath = historyPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmpPath, historyPath)
+
+
+def compare(entry, previous):
+    """
+    Print the change in the best time of each engine and stage since an earlier history entry
+    """
+    print('\nCompared to {} ({}):'.format((previous['commit'] or 'unknown commit')[:10], previous['timestamp']))
+    for engine, result in entry['engines'].items():
+        before = previous['engines'].get(engine)
+        if before is None:
+            continue
+
+        def change(now, then):
+            return '{:8.3f}s {:+7.1f}%'.format(now, 100.0 * (now - then) / then if then else 0.0)
+
+        print('  {:<24} {}'.format(engine, change(result['best'], before['best'])))
+        for name, stage in result['stages'].items():
+            if name in before['stages']:
+                print('    {:<22} {}'.format(name, change(stage['best'], before['stages'][name]['best'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SitesOnNetworkDB against a synthetic Workbench database')
+    parser.add_argument('--sites', type=int, default=1000, help='number of synthetic sites')
+    parser.add_argument('--visits-per-site', type=int, default=4, help='number of visits at each site')
+    parser.add_argument('--metrics', type=int, default=100, help='number of metrics in each schema')
+    parser.add_argument('--schemas', type=int, default=1, help='number of metric schemas. Only the first is exported.')
+    parser.add_argument('--batches', type=int, default=1, help='number of metric batches in each schema')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the synthetic database')
+    parser.add_argument('--engines', choices=engines, nargs='+', default=['python', 'sql'], help='exporter engines to time')
+    parser.add_argument('--format', type=str, default='shp', help='point output format')
+    parser.add_argument('--parquet', action='store_true', help='also write the Parquet file')
+    parser.add_argument('--workers', type=int, help='worker processes for the partitioned engine')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each engine')
+    parser.add_argument('--database', type=str, help='benchmark this Workbench database instead of a synthetic one')
+    parser.add_argument('--data-dir', type=str, default=os.path.join(benchmarkDir, 'data'), help='folder where synthetic databases are kept')
+    parser.add_argument('--history', type=str, default=os.path.join(benchmarkDir, 'history.json'), help='JSON file the results are appended to')
+    parser.add_argument('--label', type=str, help='note stored with the results')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the exporter')
+    parser.add_argument('--run-once', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--result', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once:
+        run_once(args.run_once, args.engines[0], args.format, args.parquet, args.workers, args.result)
+        return
+
+    params = OrderedDict([
+        ('sites', args.sites),
+        ('visits_per_site', args.visits_per_site),
+        ('metrics', args.metrics),
+        ('schemas', args.schemas),
+        ('batches', args.batches),
+        ('seed', args.seed)
+    ])
+
+    if args.database:
+        database = os.path.abspath(args.database)
+        params = OrderedDict([('database', database)])
+    else:
+        database = workbench_path(args.data_dir, params)
+        if not os.path.isfile(database):
+            if not os.path.isdir(args.data_dir):
+                os.makedirs(args.data_dir)
+            print('Generating', database)
+            counts = create_workbench(database, **params)
+            print(', '.join('{} {}'.format(count, name) for name, count in sorted(counts.items())))
+    params['format'] = args.format
+    params['parquet'] = args.parquet
+    params['workers'] = args.workers
+
+    commit, dirty = git_revision()
+    entry = OrderedDict([
+        ('timestamp', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        ('commit', commit),
+        ('dirty', dirty),
+        ('label', args.label),
+        ('python', platform.python_version()),
+        ('sqlite', sqlite3.sqlite_version),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('params', params),
+        ('engines', OrderedDict())
+    ])
+
+    for engine in args.engines:
+        entry['engines'][engine] = benchmark_engine(database, engine, args)
+
+    history = read_history(args.history)
+    previous = [item for item in history if item['params'] == params]
+    history.append(entry)
+    write_history(args.history, history)
+
+    print('\n{:<26} {:>9} {:>9} {:>10}'.format('', 'best', 'median', 'peak MB'))
+    for engine, result in entry['engines'].items():
+        peak = '{:.1f}'.format(result['peakRSS'] / 1048576.0) if result['peakRSS'] else '-'
+        print('{:<26} {:8.3f}s {:8.3f}s {:>10}'.format(engine, result['best'], result['median'], peak))
+        for name, stage in result['stages'].items():
+            print('  {:<24} {:8.3f}s {:8.3f}s'.format(name, stage['best'], stage['median']))
+
+    if previous:
+        compare(entry, previous[-1])
+    print('\nResults appended to', args.history)
+
+
+if __name__ == '__main__':
+    main()
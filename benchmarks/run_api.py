@@ -0,0 +1,157 @@
+"""
+Time SitesOnNetwork.py against the local mock Sitka API and keep a history of the results.
+
+The mock server runs in this process and the exporter runs under Python 2 in a child process,
+pointed at the server with an env file. Its --profile report gives the stage timings, API
+call latencies and peak memory, and the server adds how many calls of each kind it answered
+and with what status. Results are appended to the same kind of history as run.py.
+
+    python benchmarks/run_api.py --sites 2000 --metrics 300 --latency 0.05 --workers 1 8 --repeat 2
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+from mocksitka import MockConfig, start_server
+from run import repoDir, benchmarkDir, git_revision, read_history, write_history, compare, summarise
+
+
+def run_exporter(args, server, workers, envPath):
+    """
+    Export once under Python 2 against the mock server
+    :return: Dictionary of the profile report and the server statistics of the run
+    """
+    outDir = tempfile.mkdtemp(prefix='sitesonnetwork_api_benchmark_')
+    try:
+        profilePath = os.path.join(outDir, 'profile.json')
+        command = [args.python2, os.path.join(repoDir, 'SitesOnNetwork.py'), os.path.join(outDir, 'project'), 'Benchmark Metrics',
+                   '--env', envPath, '--workers', str(workers), '--format', args.format, '--profile', profilePath]
+        if args.stream_metrics:
+            command.append('--stream-metrics')
+        if args.prefetch:
+            command.append('--prefetch')
+        os.makedirs(os.path.join(outDir, 'project'))
+
+        before = server.stats.report()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, cwd=repoDir, stdout=None if args.verbose else devnull)
+        after = server.stats.report()
+
+        with open(profilePath) as f:
+            profile = json.load(f, object_pairs_hook=OrderedDict)
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
+
+    def difference(name):
+        return dict((key, after[name][key] - before[name].get(key, 0)) for key in after[name] if after[name][key] != before[name].get(key, 0))
+
+    return OrderedDict([
+        ('wall', profile['wall']),
+        ('cpu', profile['cpu']),
+        ('peakRSS', profile['peakRSS']),
+        ('stages', OrderedDict((stage['name'], stage['wall']) for stage in profile['stages'])),
+        ('api', profile['api']),
+        ('server', OrderedDict([
+            ('calls', after['calls'] - before['calls']),
+            ('bytes', after['bytes'] - before['bytes']),
+            ('resets', after['resets'] - before['resets']),
+            ('routes', difference('routes')),
+            ('statuses', difference('statuses'))
+        ]))
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SitesOnNetwork.py against the local mock Sitka API')
+    parser.add_argument('--sites', type=int, default=2000, help='number of sites')
+    parser.add_argument('--visits-per-site', type=int, default=3, help='number of visits at each site')
+    parser.add_argument('--metrics', type=int, default=300, help='number of metric values for each visit')
+    parser.add_argument('--padding', type=int, default=0, help='extra bytes added to every site, visit and metric object')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before each response starts')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many random extra seconds of latency')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second each response is sent at')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail with a 500 or 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls that get a 429 with Retry-After')
+    parser.add_argument('--reset-rate', type=float, default=0.0, help='fraction of calls where the connection is dropped')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of metrics calls dropped part way through the body')
+    parser.add_argument('--full-sites', action='store_true', help='include every site field in the sites call, not just the name, url and watershed')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the generated data')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8], help='values of the exporter --workers option to time')
+    parser.add_argument('--stream-metrics', action='store_true', help='run the exporter with --stream-metrics')
+    parser.add_argument('--prefetch', action='store_true', help='run the exporter with --prefetch')
+    parser.add_argument('--format', type=str, default='shp', help='point output format')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each worker count')
+    parser.add_argument('--python2', type=str, default='python2', help='Python 2 interpreter that runs the exporter')
+    parser.add_argument('--history', type=str, default=os.path.join(benchmarkDir, 'api_history.json'), help='JSON file the results are appended to')
+    parser.add_argument('--label', type=str, help='note stored with the results')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the exporter')
+    args = parser.parse_args()
+
+    config = MockConfig(sites=args.sites, visits_per_site=args.visits_per_site, metrics=args.metrics, padding=args.padding,
+                        latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                        throttle_rate=args.throttle_rate, reset_rate=args.reset_rate, seed=args.seed,
+                        drop_rate=args.drop_rate, full_sites=args.full_sites)
+    params = OrderedDict((key, value) for key, value in sorted(vars(config).items()))
+    params['stream_metrics'] = args.stream_metrics
+    params['prefetch'] = args.prefetch
+    params['format'] = args.format
+
+    server = start_server(config)
+    handle, envPath = tempfile.mkstemp(suffix='.env')
+    os.close(handle)
+    server.write_environment(envPath)
+
+    commit, dirty = git_revision()
+    entry = OrderedDict([
+        ('timestamp', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        ('commit', commit),
+        ('dirty', dirty),
+        ('label', args.label),
+        ('python', subprocess.check_output([args.python2, '-c', 'import platform; print(platform.python_version())']).decode().strip()),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('params', params),
+        ('engines', OrderedDict())
+    ])
+
+    try:
+        for workers in args.workers:
+            runs = []
+            for repeat in range(args.repeat):
+                runs.append(run_exporter(args, server, workers, envPath))
+                print('workers {:<4} run {}: {:.3f}s, {} calls'.format(workers, repeat + 1, runs[-1]['wall'], runs[-1]['server']['calls']))
+            entry['engines']['workers {}'.format(workers)] = summarise(runs)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(envPath)
+
+    history = read_history(args.history)
+    previous = [item for item in history if item['params'] == params]
+    history.append(entry)
+    write_history(args.history, history)
+
+    print('\n{:<26} {:>9} {:>9} {:>10} {:>8} {:>10}'.format('', 'best', 'median', 'peak MB', 'calls', 'p95 call'))
+    for name, result in entry['engines'].items():
+        last = result['runs'][-1]
+        peak = '{:.1f}'.format(result['peakRSS'] / 1048576.0) if result['peakRSS'] else '-'
+        p95 = '{:.3f}s'.format(last['api']['latency']['p95']) if last['api']['latency']['p95'] is not None else '-'
+        print('{:<26} {:8.3f}s {:8.3f}s {:>10} {:>8} {:>10}'.format(name, result['best'], result['median'], peak, last['server']['calls'], p95))
+        for stage, times in result['stages'].items():
+            print('  {:<24} {:8.3f}s {:8.3f}s'.format(stage, times['best'], times['median']))
+        if len(last['server']['statuses']) > 1 or last['server']['resets']:
+            print('  statuses {} resets {}'.format(json.dumps(last['server']['statuses'], sort_keys=True), last['server']['resets']))
+
+    if previous:
+        compare(entry, previous[-1])
+    print('\nResults appended to', args.history)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Generate synthetic CHaMP Workbench SQLite databases for benchmarking SitesOnNetworkDB.
+
+The databases have the tables and columns that the exporter queries, filled with random
+but reproducible values. A few sites have no location and some sites are in the watersheds
+the exporter leaves out, so the same filters get exercised as on a real Workbench.
+"""
+import argparse
+import os
+import random
+import sqlite3
+
+# Site columns with the kind of value each holds: 's' text, 'f' real, 'i' integer
+site_columns = [
+    ('UTMZone', 'i'), ('UC_Chin', 'i'), ('SN_Chin', 'i'), ('LC_Steel', 'i'), ('MC_Steel', 'i'),
+    ('UC_Steel', 'i'), ('SN_Steel', 'i'), ('Latitude', 'f'), ('Longitude', 'f'), ('ProgramSiteID', 's'),
+    ('Category', 's'), ('Panel', 's'), ('XAlbers', 'f'), ('YAlbers', 'f'), ('Elevation', 'f'),
+    ('Block', 's'), ('UseOrder', 'i'), ('Sample', 's'), ('OwnerType', 's'), ('Strah', 'i'),
+    ('HUC4', 's'), ('HUC5', 's'), ('HUC6', 's'), ('Level3NM', 's'), ('Level4NM', 's'),
+    ('CECL1', 's'), ('CECL2', 's'), ('ValleyClass', 's'), ('ChannelType', 's'), ('Ppt', 'f'),
+    ('DisturbedClassName', 's'), ('DisturbedClassCode', 's'), ('DistPrin1', 'f'), ('NatClassName', 's'),
+    ('NatClassCode', 's'), ('NatPrin1', 'f'), ('NatPrin2', 'f'), ('MeanU', 'f'),
+    ('PrimaryBedformClass', 's'), ('CUMDRAINAG', 'f')
+]
+
+visit_columns = [
+    ('VisitYear', 'i'), ('IsPrimary', 'i'), ('QCVisit', 'i'), ('PanelName', 's'), ('VisitPhase', 's'),
+    ('VisitStatus', 's'), ('HasFishData', 'i'), ('Discharge', 'f'), ('D84', 'f')
+]
+
+# Watersheds that SitesOnNetworkDB leaves out of the export
+excluded_watersheds = [99, 102, 104, 27]
+
+# DataTypeID of numeric metrics. Everything else is text.
+numeric_metric = 10023
+text_metric = 10022
+
+schema_sql = [
+    'CREATE TABLE CHaMP_Watersheds (WatershedID INTEGER PRIMARY KEY, WatershedName TEXT)',
+    'CREATE TABLE CHaMP_Sites (SiteID INTEGER PRIMARY KEY, SiteName TEXT, WatershedID INTEGER, StreamName TEXT, {})'.format(
+        ', '.join(name for name, kind in site_columns)),
+    'CREATE TABLE CHaMP_Visits (VisitID INTEGER PRIMARY KEY, SiteID INTEGER, {})'.format(
+        ', '.join(name for name, kind in visit_columns)),
+    'CREATE TABLE Metric_Definitions (MetricID INTEGER PRIMARY KEY, Title TEXT, DisplayNameShort TEXT, DataTypeID INTEGER)',
+    'CREATE TABLE Metric_Schemas (SchemaID INTEGER PRIMARY KEY, Title TEXT)',
+    'CREATE TABLE Metric_Schema_Definitions (SchemaID INTEGER, MetricID INTEGER)',
+    'CREATE TABLE Metric_Batches (BatchID INTEGER PRIMARY KEY, SchemaID INTEGER)',
+    'CREATE TABLE Metric_Instances (InstanceID INTEGER PRIMARY KEY, BatchID INTEGER, VisitID INTEGER)',
+    'CREATE TABLE Metric_VisitMetrics (InstanceID INTEGER, MetricID INTEGER, MetricValue)'
+]
+
+
+def schema_name(index):
+    """
+    :param index: Zero based schema number
+    :return: Title of the synthetic metric schema
+    """
+    return 'Benchmark Metrics {}'.format(index + 1)
+
+
+def random_value(rnd, kind, label):
+    if rnd.random() < 0.1:
+        return None
+    if kind == 's':
+        return '{}{}'.format(label, rnd.randint(1, 20))
+    if kind == 'i':
+        return rnd.randint(1, 500)
+    return round(rnd.uniform(0, 1000), 6)
+
+
+def create_workbench(path, sites=1000, visits_per_site=4, metrics=100, schemas=1, batches=1, watersheds=12, seed=1):
+    """
+    Create a synthetic Workbench database. Any existing file at path is replaced.
+    :param path: Path of the SQLite database to create
+    :param sites: Number of sites
+    :param visits_per_site: Number of visits at each site
+    :param metrics: Number of metrics in each schema
+    :param schemas: Number of metric schemas. See schema_name for their titles.
+    :param batches: Number of metric batches in each schema. Visits are spread across them.
+    :param watersheds: Number of watersheds, as well as the excluded ones
+    :param seed: Random seed. The same arguments and seed always give the same database.
+    :return: Dictionary of the row counts of each table
+    """
+    rnd = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+
+    conn = sqlite3.connect(path)
+    for statement in schema_sql:
+        conn.execute(statement)
+
+    watershed_ids = list(range(1, watersheds + 1))
+    conn.executemany('INSERT INTO CHaMP_Watersheds VALUES (?, ?)',
+                     [(wid, 'Watershed {}'.format(wid)) for wid in watershed_ids + excluded_watersheds])
+
+    site_rows = []
+    visit_rows = []
+    visitid = 1
+    for siteid in range(1, sites + 1):
+        # One site in twenty is in an excluded watershed and one in fifty has no location
+        watershedid = rnd.choice(excluded_watersheds) if siteid % 20 == 0 else rnd.choice(watershed_ids)
+        values = [random_value(rnd, kind, name[:3]) for name, kind in site_columns]
+        values[7] = None if siteid % 50 == 0 else round(rnd.uniform(43, 48), 6)
+        values[8] = round(rnd.uniform(-124, -111), 6)
+        site_rows.append([siteid, 'CBW05583-{:06d}'.format(siteid), watershedid, 'Stream {}'.format(siteid % 300)] + values)
+
+        for year in range(visits_per_site):
+            values = [random_value(rnd, kind, name[:3]) for name, kind in visit_columns]
+            values[0] = 2011 + year
+            visit_rows.append([visitid, siteid] + values)
+            visitid += 1
+
+    conn.executemany('INSERT INTO CHaMP_Sites VALUES ({})'.format(','.join('?' * len(site_rows[0]))), site_rows)
+    conn.executemany('INSERT INTO CHaMP_Visits VALUES ({})'.format(','.join('?' * len(visit_rows[0]))), visit_rows)
+
+    counts = {'sites': len(site_rows), 'visits': len(visit_rows), 'metric values': 0}
+    metricid = 1
+    batchid = 1
+    instanceid = 1
+    for schema in range(schemas):
+        schemaid = schema + 1
+        conn.execute('INSERT INTO Metric_Schemas VALUES (?, ?)', (schemaid, schema_name(schema)))
+
+        definitions = []
+        for index in range(metrics):
+            # Long display names that share prefixes so the 10 character field names collide
+            numeric = index % 6 != 0
+            definitions.append((metricid, 'Benchmark metric {} of schema {}'.format(index + 1, schemaid),
+                                'Metric_Value_{}'.format(index % 40 + 1), numeric_metric if numeric else text_metric))
+            metricid += 1
+        conn.executemany('INSERT INTO Metric_Definitions VALUES (?, ?, ?, ?)', definitions)
+        conn.executemany('INSERT INTO Metric_Schema_Definitions VALUES (?, ?)', [(schemaid, d[0]) for d in definitions])
+
+        batch_ids = list(range(batchid, batchid + batches))
+        conn.executemany('INSERT INTO Metric_Batches VALUES (?, ?)', [(bid, schemaid) for bid in batch_ids])
+        batchid += batches
+
+        # Most visits have metrics. Each one's instance is in one of the schema's batches.
+        for visit in visit_rows:
+            if rnd.random() < 0.1:
+                continue
+            conn.execute('INSERT INTO Metric_Instances VALUES (?, ?, ?)', (instanceid, rnd.choice(batch_ids), visit[0]))
+            values = [(instanceid, d[0], round(rnd.uniform(0, 100), 6) if d[3] == numeric_metric else 'Class {}'.format(rnd.randint(1, 5)))
+                      for d in definitions]
+            conn.executemany('INSERT INTO Metric_VisitMetrics VALUES (?, ?, ?)', values)
+            counts['metric values'] += len(values)
+            instanceid += 1
+
+    conn.commit()
+    conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a synthetic CHaMP Workbench database')
+    parser.add_argument('database', type=str, help='path of the SQLite database to create')
+    parser.add_argument('--sites', type=int, default=1000, help='number of sites')
+    parser.add_argument('--visits-per-site', type=int, default=4, help='number of visits at each site')
+    parser.add_argument('--metrics', type=int, default=100, help='number of metrics in each schema')
+    parser.add_argument('--schemas', type=int, default=1, help='number of metric schemas')
+    parser.add_argument('--batches', type=int, default=1, help='number of metric batches in each schema')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    counts = create_workbench(args.database, args.sites, args.visits_per_site, args.metrics, args.schemas, args.batches, seed=args.seed)
+    print('Created', args.database, 'with', ', '.join('{} {}'.format(count, name) for name, count in sorted(counts.items())))
+
+
+if __name__ == '__main__':
+    main()
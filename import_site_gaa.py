@@ -55,15 +55,14 @@ def import_gaa(csvfile, database):
         for row in reader:
             if not cols:
                 cols = row
+                site_index, indexes = column_indexes(cols)
             else:
-                site_name = row[cols.index('SiteName')]
+                site_name = row[site_index]
 
                 if site_name in site_values:
                     continue
 
-                values = []
-                for c, d in fields:
-                    values.append(row[cols.index(c)])
+                values = [row[i] for i in indexes]
                 values.append(site_name)
                 site_values[site_name] = values
 
@@ -82,15 +81,121 @@ def import_gaa(csvfile, database):
         print(e)
         conn.rollback()
 
+
+def column_indexes(cols):
+    """
+    Find the position of each GAA column in the CSV header
+    :param cols: CSV header row
+    :return: Tuple of the SiteName position and the list of positions of the fields, in the order of fields
+    """
+    missing = [c for c in ['SiteName'] + [c for c, d in fields] if c not in cols]
+    if missing:
+        raise Exception('The CSV file is missing the columns: {}'.format(', '.join(missing)))
+    return cols.index('SiteName'), [cols.index(c) for c, d in fields]
+
+
+def import_gaa_bulk(csvfile, database, chunk_size=1000, rejects_path=None):
+    """
+    Import the GAAs with set based SQL. The CSV rows are loaded into a temporary staging
+    table and CHaMP_Sites is updated from it with one UPDATE per chunk of sites. Each chunk
+    is committed on its own so the Workbench is only locked for writing briefly at a time.
+    Rows that can't be imported are written to a reject report instead of stopping the import.
+    :param csvfile: Tab delimited CSV file of site GAAs
+    :param database: CHaMP Workbench database
+    :param chunk_size: Number of sites updated in each transaction
+    :param rejects_path: CSV file listing the rejected rows. Defaults to _rejects.csv beside csvfile.
+    :return: Tuple of the number of sites updated and the number of rows rejected
+    """
+    db_cols = [d if d else c for c, d in fields]
+    rejects = []
+    rows = []
+    first_line = {}
+
+    with open(csvfile, 'r') as fieldCSVFile:
+        reader = csv.reader(fieldCSVFile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+        site_index, indexes = column_indexes(next(reader))
+        width = max([site_index] + indexes) + 1
+
+        for row in reader:
+            line = reader.line_num
+            if not any(row):
+                continue
+            if len(row) < width:
+                rejects.append((line, row[site_index] if len(row) > site_index else '', 'expected {} columns but found {}'.format(width, len(row))))
+                continue
+
+            site_name = row[site_index]
+            if not site_name:
+                rejects.append((line, '', 'no SiteName'))
+            elif site_name in first_line:
+                rejects.append((line, site_name, 'duplicate of line {}'.format(first_line[site_name])))
+            else:
+                first_line[site_name] = line
+                rows.append([site_name, line] + [row[i] for i in indexes])
+
+    conn = sqlite3.connect(database, timeout=60)
+    curs = conn.cursor()
+
+    # The staging table lives in the temp database so loading it doesn't lock the Workbench
+    curs.execute('CREATE TEMP TABLE gaa_staging (SiteName TEXT PRIMARY KEY, Line INTEGER, {})'.format(', '.join(db_cols)))
+    curs.executemany('INSERT INTO temp.gaa_staging VALUES ({})'.format(', '.join('?' * (len(db_cols) + 2))), rows)
+
+    curs.execute('SELECT G.Line, G.SiteName FROM temp.gaa_staging G'
+                 ' WHERE NOT EXISTS (SELECT 1 FROM CHaMP_Sites S WHERE S.SiteName = G.SiteName)')
+    rejects.extend((line, site_name, 'not in CHaMP_Sites') for line, site_name in curs.fetchall())
+    conn.commit()
+
+    chunk = '(SELECT * FROM temp.gaa_staging WHERE rowid > ? AND rowid <= ?)'
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        com = 'UPDATE CHaMP_Sites SET {} FROM {} AS G WHERE CHaMP_Sites.SiteName = G.SiteName'.format(
+            ', '.join('{0} = G.{0}'.format(col) for col in db_cols), chunk)
+    else:
+        # UPDATE ... FROM needs SQLite 3.33. Older versions look each column up with a correlated subquery.
+        com = 'UPDATE CHaMP_Sites SET {} WHERE SiteName IN (SELECT SiteName FROM {})'.format(
+            ', '.join('{0} = (SELECT G.{0} FROM temp.gaa_staging G WHERE G.SiteName = CHaMP_Sites.SiteName)'.format(col) for col in db_cols), chunk)
+
+    updated = 0
+    last_row = curs.execute('SELECT MAX(rowid) FROM temp.gaa_staging').fetchone()[0] or 0
+    try:
+        for start in range(0, last_row, chunk_size):
+            curs.execute(com, [start, start + chunk_size])
+            updated += curs.rowcount
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        print('Import stopped after updating {} sites'.format(updated))
+        raise
+    finally:
+        conn.close()
+
+    print('Updated {} sites from {} rows'.format(updated, len(rows)))
+    if rejects:
+        if rejects_path is None:
+            rejects_path = os.path.splitext(csvfile)[0] + '_rejects.csv'
+        with open(rejects_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Line', 'SiteName', 'Reason'])
+            writer.writerows(sorted(rejects))
+        print('Rejected {} rows. See {}'.format(len(rejects), rejects_path))
+
+    return updated, len(rejects)
+
+
 def main():
     # parse command line options
     parser = argparse.ArgumentParser()
     parser.add_argument('csv', type=argparse.FileType('r'),  help='CSV file containing site GAAs')
     parser.add_argument('database', type=argparse.FileType('r'),  help='CHaMP Workbench database')
+    parser.add_argument('--bulk', action='store_true', help='load the CSV into a staging table and update the sites with set based SQL')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='with --bulk, number of sites updated in each transaction')
+    parser.add_argument('--rejects', type=str, help='with --bulk, CSV file listing the rows that could not be imported')
     args = parser.parse_args()
 
     try:
-        import_gaa(args.csv.name, args.database.name)
+        if args.bulk:
+            import_gaa_bulk(args.csv.name, args.database.name, args.chunk_size, args.rejects)
+        else:
+            import_gaa(args.csv.name, args.database.name)
 
     except AssertionError as e:
         print ("Assertion Error", e)
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import sqlite3
+
+# Layout of the checkpoint database. Checkpoints with a different layout can't be resumed.
+CHECKPOINT_FORMAT = 1
+
+
+class Checkpoint:
+    """
+    SQLite store of the API responses an export has fetched so far, so that an export that
+    dies part way through can be resumed without downloading everything again. Whole calls,
+    like the list of sites, are stored by name. Site details are stored by url as they arrive
+    and streamed metrics one item at a time. Writes are committed every commitEvery records
+    or commitSeconds seconds, whichever comes first, so at most that much work is lost.
+    Use it from one thread only.
+    """
+
+    def __init__(self, path, metricSchemaName, resume=False, commitEvery=200, commitSeconds=30):
+        """
+        :param path: Path of the checkpoint database
+        :param metricSchemaName: Name of the metric schema being exported. A checkpoint for another schema can't be resumed.
+        :param resume: Carry on from an existing checkpoint at path. Otherwise any existing checkpoint is thrown away.
+        :param commitEvery: Number of records written between commits
+        :param commitSeconds: Longest time in seconds between commits
+        """
+        self.path = path
+        self.metricSchemaName = metricSchemaName
+        self.commitEvery = commitEvery
+        self.commitSeconds = commitSeconds
+        self._pending = 0
+        self._lastCommit = time.time()
+
+        if not resume and os.path.exists(path):
+            os.remove(path)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS calls (name TEXT PRIMARY KEY, body TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sites (url TEXT PRIMARY KEY, body TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS items (name TEXT, idx INTEGER, body TEXT, PRIMARY KEY (name, idx))')
+
+        meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+        if not meta:
+            self.conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', [
+                ('format', str(CHECKPOINT_FORMAT)),
+                ('schema', metricSchemaName),
+                ('created', time.strftime("%Y-%m-%d %H:%M:%S"))
+            ])
+            self.conn.commit()
+        elif meta.get('format') != str(CHECKPOINT_FORMAT) or meta.get('schema') != metricSchemaName:
+            self.conn.close()
+            raise Exception('Checkpoint {} is for a different metric schema or version. Delete it or run without --resume.'.format(path))
+        else:
+            print('Resuming from checkpoint {} created {}: {} sites fetched'.format(path, meta.get('created'), self.siteCount()))
+
+    def _written(self, count=1):
+        self._pending += count
+        if self._pending >= self.commitEvery or time.time() - self._lastCommit >= self.commitSeconds:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+        self._lastCommit = time.time()
+
+    def call(self, name):
+        """
+        :param name: Name the call was saved under
+        :return: The saved response or None if it hasn't been saved
+        """
+        row = self.conn.execute('SELECT body FROM calls WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def saveCall(self, name, obj):
+        """
+        Save the whole response of a call and commit straight away
+        :param name: Name to save it under
+        :param obj: The parsed response
+        :return: None
+        """
+        self.conn.execute('INSERT OR REPLACE INTO calls (name, body) VALUES (?, ?)', (name, json.dumps(obj)))
+        self.commit()
+
+    def siteUrls(self):
+        """
+        :return: Set of the urls of the site details that have been saved
+        """
+        return set(row[0] for row in self.conn.execute('SELECT url FROM sites'))
+
+    def siteCount(self):
+        return self.conn.execute('SELECT COUNT(*) FROM sites').fetchone()[0]
+
+    def site(self, url):
+        """
+        :param url: Url of the site detail call
+        :return: The saved site detail or None
+        """
+        row = self.conn.execute('SELECT body FROM sites WHERE url = ?', (url,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def saveSite(self, url, obj):
+        self.conn.execute('INSERT OR REPLACE INTO sites (url, body) VALUES (?, ?)', (url, json.dumps(obj)))
+        self._written()
+
+    def itemCount(self, name):
+        return self.conn.execute('SELECT COUNT(*) FROM items WHERE name = ?', (name,)).fetchone()[0]
+
+    def items(self, name):
+        """
+        :param name: Name of the streamed call
+        :return: Generator of the saved items in the order they arrived
+        """
+        for row in self.conn.execute('SELECT body FROM items WHERE name = ? ORDER BY idx', (name,)):
+            yield json.loads(row[0])
+
+    def saveItem(self, name, idx, obj):
+        self.conn.execute('INSERT OR REPLACE INTO items (name, idx, body) VALUES (?, ?, ?)', (name, idx, json.dumps(obj)))
+        self._written()
+
+    def itemsComplete(self, name):
+        """
+        :param name: Name of the streamed call
+        :return: True if every item of the call has been saved
+        """
+        return self.call(name + ' complete') is not None
+
+    def completeItems(self, name):
+        """
+        Record that the streamed call finished and commit
+        :param name: Name of the streamed call
+        :return: None
+        """
+        self.saveCall(name + ' complete', self.itemCount(name))
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def remove(self):
+        """
+        Throw the checkpoint away once the export has finished
+        :return: None
+        """
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,65 @@
+import os
+import threading
+
+
+class DeleteJournal:
+    """
+    Append-only record of the instance urls that have been deleted or failed to delete, so that
+    a deletion that is interrupted can carry on where it stopped. Each line is the outcome, a tab
+    and the url, followed by a tab and the reason for failures. Lines are flushed as they are
+    written and synced to disk every syncEvery lines. Safe to use from several threads.
+    """
+
+    def __init__(self, path, syncEvery=50):
+        """
+        :param path: Journal file. Created if it doesn't exist, otherwise read and added to.
+        :param syncEvery: Number of lines written between syncs to disk
+        """
+        self.path = path
+        self.syncEvery = syncEvery
+        self.deleted = set()
+        self.failed = {}
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) < 2:
+                        # Half written line from a crash
+                        continue
+                    if parts[0] == 'deleted':
+                        self.deleted.add(parts[1])
+                        self.failed.pop(parts[1], None)
+                    elif parts[0] == 'failed':
+                        self.failed[parts[1]] = parts[2] if len(parts) > 2 else ''
+
+        self._file = open(path, 'a')
+
+    def _write(self, line):
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.syncEvery:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def recordDeleted(self, url):
+        self._write('deleted\t{}\n'.format(url))
+        with self._lock:
+            self.deleted.add(url)
+            self.failed.pop(url, None)
+
+    def recordFailed(self, url, reason):
+        reason = ' '.join(str(reason).split())
+        self._write('failed\t{}\t{}\n'.format(url, reason))
+        with self._lock:
+            self.failed[url] = reason
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
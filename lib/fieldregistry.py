@@ -0,0 +1,121 @@
+import os
+import json
+from collections import OrderedDict
+from lib.filefolderutil import sanitizeFolderName
+
+# Layout of the registry file. Registries with a different layout are ignored and started again.
+REGISTRY_FORMAT = 1
+
+
+def registryPath(registryDir, source, metricSchemaName, maxFieldLength):
+    """
+    Path of the registry file for a schema. Each exporter keys its metrics differently and
+    formats with different field name limits get different names, so each has its own registry.
+    :param registryDir: Folder that holds the registries
+    :param source: Name of the exporter, e.g. 'api' or 'workbench'
+    :param metricSchemaName: Name of the metric schema
+    :param maxFieldLength: Longest field name the output format can store. None for no limit.
+    :return: Absolute path to the JSON registry file
+    """
+    suffix = str(maxFieldLength) if maxFieldLength else 'full'
+    return os.path.join(registryDir, '{}_{}_{}.json'.format(source, sanitizeFolderName(metricSchemaName), suffix))
+
+
+class FieldRegistry:
+    """
+    Persistent mapping of metric keys to output field names for one metric schema.
+    Once a metric has a field name it keeps it on every later run, whatever order the
+    metrics arrive in. Names that were ever handed out stay taken, even if their metric
+    leaves the schema, so a name never changes meaning between exports.
+    """
+
+    def __init__(self, path=None, metricSchemaName=None, maxFieldLength=10):
+        """
+        :param path: JSON file the registry is loaded from and saved to. None keeps it in memory only.
+        :param metricSchemaName: Name of the metric schema, recorded in the file
+        :param maxFieldLength: Longest field name the output format can store. None for no limit.
+        """
+        self.path = path
+        self.metricSchemaName = metricSchemaName
+        self.maxFieldLength = maxFieldLength
+        self.version = 0
+        self.fields = OrderedDict()
+        self.names = set()
+        self.active = []
+        self.changed = False
+
+        if path and os.path.isfile(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            registry = json.load(f, object_pairs_hook=OrderedDict)
+
+        if registry.get('format') != REGISTRY_FORMAT:
+            print('Ignoring field registry {} with an unknown format'.format(self.path))
+            return
+        if registry['maxFieldLength'] != self.maxFieldLength:
+            raise Exception('Field registry {} is for {} character field names'.format(self.path, registry['maxFieldLength']))
+
+        self.version = registry['version']
+        for key, fieldName in registry['fields'].items():
+            self.fields[key] = fieldName
+            self.names.add(fieldName)
+
+    def fieldName(self, key, candidates):
+        """
+        Look up the field name for a metric, registering a new one if it doesn't have one yet
+        :param key: Stable identifier of the metric, e.g. its name or ID
+        :param candidates: Iterable of field names to try in order of preference. The first one
+        that is not taken is registered. Can be an endless generator.
+        :return: Field name
+        """
+        key = u'{}'.format(key)
+        fieldName = self.fields.get(key)
+        if fieldName is None:
+            for fieldName in candidates:
+                if fieldName not in self.names:
+                    break
+            self.fields[key] = fieldName
+            self.names.add(fieldName)
+            self.changed = True
+
+        self.active.append(key)
+        return fieldName
+
+    def activeFields(self):
+        """
+        :return: List of (key, field name) tuples for the metrics looked up during this run, in lookup order
+        """
+        return [(key, self.fields[key]) for key in self.active]
+
+    def save(self):
+        """
+        Write the registry if any field names were added, bumping its version
+        :return: None
+        """
+        if not self.path or not self.changed:
+            return
+
+        self.version += 1
+        registry = OrderedDict([
+            ('format', REGISTRY_FORMAT),
+            ('version', self.version),
+            ('schema', self.metricSchemaName),
+            ('maxFieldLength', self.maxFieldLength),
+            ('fields', self.fields)
+        ])
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # Write to a temporary file first so an interrupted run never leaves half a registry
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(registry, f, indent=1)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmpPath, self.path)
+        self.changed = False
+        print('Field registry version {} written to {}'.format(self.version, self.path))
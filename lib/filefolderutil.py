@@ -12,4 +12,7 @@ def clearfolder(folder):
 
 def sanitizeFolderName(name):
     name = name.replace(" ", "")
+    # Characters that are not allowed in folder names on Windows, plus the path separators
+    for char in '<>:"/\\|?*':
+        name = name.replace(char, "_")
     return name
\ No newline at end of file
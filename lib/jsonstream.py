@@ -0,0 +1,58 @@
+import re
+import json
+import codecs
+
+# Whitespace and the commas that separate array items
+SEPARATOR = re.compile(r'[\s,]*')
+WHITESPACE = re.compile(r'\s*')
+
+
+def iterJsonArray(chunks):
+    """
+    Incrementally parse a JSON array, yielding one item at a time.
+    Only the item currently being parsed is held in memory, never the whole array.
+    :param chunks: Iterable of raw bytes making up the JSON document (e.g. response.iter_content())
+    :return: Generator of the parsed array items
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    started = False
+
+    for chunk in chunks:
+        buf += utf8.decode(chunk)
+        pos = 0
+
+        if not started:
+            pos = SEPARATOR.match(buf, pos).end()
+            if pos == len(buf):
+                buf = u''
+                continue
+            if buf[pos] != u'[':
+                raise ValueError("Expected a JSON array but got: {}".format(buf[pos:pos + 20]))
+            started = True
+            pos += 1
+
+        while True:
+            pos = SEPARATOR.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == u']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Item is not complete yet. Wait for the next chunk
+                break
+
+            # A number can parse before all of it has arrived, e.g. the 1 of 1.5. Only take
+            # a scalar once the comma or bracket after it is in the buffer.
+            if not isinstance(item, (dict, list)):
+                after = WHITESPACE.match(buf, end).end()
+                if after == len(buf) or buf[after] not in u',]':
+                    break
+
+            yield item
+            pos = end
+
+        buf = buf[pos:]
+
+    raise ValueError("Unexpected end of JSON array")
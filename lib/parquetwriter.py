@@ -0,0 +1,116 @@
+from lib.visittable import REAL, INTEGER, STRING
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+
+def _checkArrow():
+    if pa is None:
+        raise Exception("Writing Parquet files requires the pyarrow package")
+
+
+def _arrowType(kind):
+    # Strings are dictionary encoded so both writers produce the same schema as the VisitTable codes
+    if kind == STRING:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.int64() if kind == INTEGER else pa.float64()
+
+
+def _schema(columns):
+    return pa.schema([pa.field(name, _arrowType(kind)) for name, kind in columns])
+
+
+def writeParquet(table, path, names=None, compression='snappy'):
+    """
+    Write a VisitTable to a Parquet file straight from its column arrays.
+    String columns are written dictionary encoded, the same way they are held in the table.
+    :param table: VisitTable
+    :param path: Absolute path of the Parquet file
+    :param names: Columns to write. All columns when not provided.
+    :param compression: Parquet compression codec
+    :return: None
+    """
+    _checkArrow()
+    names = table.columnNames if names is None else names
+
+    arrays = []
+    for name in names:
+        column = table.columns[name]
+        nulls = table.isNull(name)
+        if column['kind'] == STRING:
+            indices = pa.array(column['codes'], mask=nulls, type=pa.int32())
+            dictionary = pa.array([u'{}'.format(value) for value in column['categories']], type=pa.string())
+            arrays.append(pa.DictionaryArray.from_arrays(indices, dictionary))
+        elif column['kind'] == INTEGER:
+            values = column['values'].copy()
+            values[nulls] = 0
+            arrays.append(pa.array(values.astype('int64'), mask=nulls, type=pa.int64()))
+        else:
+            arrays.append(pa.array(column['values'], mask=nulls, type=pa.float64()))
+
+    pq.write_table(pa.Table.from_arrays(arrays, names=list(names)), path, compression=compression)
+
+
+class ParquetRecordWriter:
+    """
+    Write a Parquet file one record at a time for exporters that stream their rows.
+    Records are buffered and written as a row group every batchSize rows.
+    """
+
+    def __init__(self, path, columns, compression='snappy', batchSize=10000):
+        """
+        :param path: Absolute path of the Parquet file
+        :param columns: List of (column name, kind) tuples where kind is REAL, INTEGER or STRING
+        :param compression: Parquet compression codec
+        :param batchSize: Number of records in each row group
+        """
+        _checkArrow()
+        self.columns = columns
+        self.schema = _schema(columns)
+        self.batchSize = batchSize
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        self._buffer = dict((name, []) for name, kind in columns)
+        self._count = 0
+
+    def write(self, record):
+        """
+        :param record: Dictionary of column name to value. Missing columns are written as null.
+        :return: None
+        """
+        for name, kind in self.columns:
+            value = record.get(name)
+            if value is not None:
+                if kind == STRING:
+                    value = u'{}'.format(value)
+                else:
+                    try:
+                        value = float(value) if kind == REAL else int(value)
+                    except (TypeError, ValueError):
+                        value = None
+            self._buffer[name].append(value)
+
+        self._count += 1
+        if self._count >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self._count == 0:
+            return
+        arrays = []
+        for name, kind in self.columns:
+            if kind == STRING:
+                arrays.append(pa.array(self._buffer[name], type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(self._buffer[name], type=self.schema.field(name).type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self._buffer = dict((name, []) for name, kind in self.columns)
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
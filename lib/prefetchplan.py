@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+# Fields the exporter needs from each site and each visit
+SITE_FIELDS = ('name', 'locale', 'watershedUrl', 'latitude', 'longitude')
+VISIT_FIELDS = ('id', 'sampleYear')
+
+
+class PrefetchPlan:
+    """
+    Builds the site to visit to watershed graph from the bulk "sites", "visits" and
+    "watersheds" calls, and works out which sites still need their detail call because the
+    bulk payloads lack something. When the bulk calls carry everything the export needs, the
+    number of API calls no longer grows with the number of sites.
+    """
+
+    def __init__(self, sites, visits=None, watersheds=None, siteFields=SITE_FIELDS, visitFields=VISIT_FIELDS):
+        """
+        :param sites: List of site objects from the "sites" API call
+        :param visits: List of visit objects from the "visits" API call. None if it wasn't made.
+        :param watersheds: List of watershed objects from the "watersheds" API call
+        :param siteFields: Fields every site object must have
+        :param visitFields: Fields every visit object must have
+        """
+        self.sites = sites
+        self.siteFields = siteFields
+        self.details = {}
+
+        # The visits can only replace the site details if every one of them can be tied to a site
+        self.visitsBySite = None
+        if visits is not None:
+            siteUrls = dict((site['name'], site['url']) for site in sites if 'name' in site)
+            grouped = OrderedDict((site['url'], []) for site in sites)
+            for visit in visits:
+                url = visit.get('siteUrl') or siteUrls.get(visit.get('siteName'))
+                if url not in grouped or any(field not in visit for field in visitFields):
+                    grouped = None
+                    break
+                grouped[url].append(visit)
+            self.visitsBySite = grouped
+
+        self.shedNames = dict((ws['url'], ws['name']) for ws in watersheds or [])
+        self.detailSites = [site for site in sites if self.needsDetail(site)]
+
+    def needsDetail(self, site):
+        """
+        :param site: Site object from the "sites" API call
+        :return: True if the site's detail call has to be made
+        """
+        return self.visitsBySite is None or any(field not in site for field in self.siteFields)
+
+    def addDetail(self, site, siteobj):
+        """
+        Add the result of a site detail call
+        :param site: Site object from the "sites" API call
+        :param siteobj: The site's detail object
+        :return: None
+        """
+        self.details[site['url']] = siteobj
+
+    def siteObjects(self):
+        """
+        :return: Generator of (site, siteobj) tuples in the order of the sites, like fetchSites. Each siteobj
+        has the site fields and visits, from the detail call where one was made and the bulk calls otherwise.
+        """
+        for site in self.sites:
+            siteobj = dict(site)
+            siteobj.update(self.details.get(site['url'], {}))
+            if self.visitsBySite is not None:
+                siteobj['visits'] = self.visitsBySite[site['url']]
+            yield site, siteobj
+
+    def watershedSites(self):
+        """
+        :return: Dictionary of watershed name: list of site names, or None if some sites don't say which watershed they are in
+        """
+        watersheds = OrderedDict((name, []) for name in self.shedNames.values())
+        for site in self.sites:
+            name = self.shedNames.get(site.get('watershedUrl'), site.get('watershedName'))
+            if name is None:
+                return None
+            watersheds.setdefault(name, []).append(site['name'])
+        return watersheds
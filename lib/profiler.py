@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows. Peak memory is not reported.
+    resource = None
+
+
+def cpuTime():
+    """
+    :return: User plus system CPU seconds used by this process
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def childCpuTime():
+    """
+    :return: User plus system CPU seconds used by finished worker processes
+    """
+    times = os.times()
+    return times[2] + times[3]
+
+
+def peakRSS():
+    """
+    :return: Peak resident memory of this process in bytes, or None where it can't be measured
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def currentRSS():
+    """
+    :return: Resident memory of this process right now in bytes, or None where it can't be measured cheaply (only Linux)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Stage:
+    """
+    Totals for one named stage of an export. A stage that runs more than once adds up.
+    Memory is reported as what the stage itself added: rssGrowth is how much resident memory
+    grew from its start to its end, and peakRSSGrowth how far it raised the process's peak.
+    processPeakRSS is the peak of the whole process so far when the stage ended, so it
+    includes every stage before it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows = 0
+        self.rssGrowth = None
+        self.peakRSSGrowth = None
+        self.processPeakRSS = None
+
+    def report(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('calls', self.calls),
+            ('wall', round(self.wall, 4)),
+            ('cpu', round(self.cpu, 4)),
+            ('rows', self.rows),
+            ('rowsPerSecond', round(self.rows / self.wall, 1) if self.wall else None),
+            ('rssGrowth', self.rssGrowth),
+            ('peakRSSGrowth', self.peakRSSGrowth),
+            ('processPeakRSS', self.processPeakRSS)
+        ])
+
+
+class APIStats:
+    """
+    Counts and latencies of the API calls. Safe to update from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.cached = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.cachedBytes = 0
+        self.latencies = []
+
+    def record(self, seconds, nbytes=0, error=False):
+        """
+        Record a call that went to the server
+        :param seconds: Time until the response headers arrived
+        :param nbytes: Size of the response body, if it was read
+        :param error: True if the call failed or returned an error status
+        :return: None
+        """
+        with self._lock:
+            self.calls += 1
+            self.latencies.append(seconds)
+            self.bytes += nbytes
+            if error:
+                self.errors += 1
+
+    def addBytes(self, nbytes):
+        """
+        Add to the bytes downloaded by a streamed call as the body is read
+        :param nbytes:
+        :return: None
+        """
+        with self._lock:
+            self.bytes += nbytes
+
+    def recordRetry(self):
+        """
+        Record that a failed call is about to be tried again
+        :return: None
+        """
+        with self._lock:
+            self.retries += 1
+
+    def recordCached(self, nbytes=0):
+        """
+        Record a call that was answered from the response cache
+        :param nbytes: Size of the cached body
+        :return: None
+        """
+        with self._lock:
+            self.cached += 1
+            self.cachedBytes += nbytes
+
+    def report(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else None
+
+        return OrderedDict([
+            ('calls', self.calls),
+            ('cached', self.cached),
+            ('errors', self.errors),
+            ('retries', self.retries),
+            ('bytes', self.bytes),
+            ('cachedBytes', self.cachedBytes),
+            ('latency', OrderedDict([
+                ('total', round(sum(latencies), 4)),
+                ('mean', round(sum(latencies) / len(latencies), 4) if latencies else None),
+                ('p50', percentile(0.5)),
+                ('p95', percentile(0.95)),
+                ('max', round(latencies[-1], 4) if latencies else None)
+            ]))
+        ])
+
+
+class Profiler:
+    """
+    Collects the time, row counts and memory of each stage of an export and the API call
+    statistics, and writes them as JSON. Timing is cheap enough to always be on.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all the stages and API calls recorded so far, e.g. between benchmark runs in one process
+        :return: None
+        """
+        self.started = time.time()
+        self.startedCpu = cpuTime()
+        self.stages = OrderedDict()
+        self.api = APIStats()
+        self._cprofile = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the export. Set the rows attribute of the yielded Stage to record how many rows it handled.
+        :param name: Stage name
+        :return: Context manager that yields the Stage
+        """
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name)
+
+        wall = time.time()
+        cpu = cpuTime()
+        rss = currentRSS()
+        peak = peakRSS()
+        try:
+            yield stage
+        finally:
+            stage.calls += 1
+            stage.wall += time.time() - wall
+            stage.cpu += cpuTime() - cpu
+            stage.processPeakRSS = peakRSS()
+            if peak is not None:
+                stage.peakRSSGrowth = (stage.peakRSSGrowth or 0) + stage.processPeakRSS - peak
+            endRSS = currentRSS()
+            if rss is not None and endRSS is not None:
+                # A stage that runs more than once reports its largest growth
+                stage.rssGrowth = max(stage.rssGrowth, endRSS - rss) if stage.rssGrowth is not None else endRSS - rss
+
+    def enableCProfile(self):
+        """
+        Run the Python profiler from now on. Its results are included when the report is written.
+        :return: None
+        """
+        import cProfile
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def report(self, top=30):
+        """
+        :param top: Number of functions to include from cProfile, by cumulative time
+        :return: Dictionary of the whole profile
+        """
+        report = OrderedDict([
+            ('command', sys.argv),
+            ('started', datetime.datetime.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S")),
+            ('wall', round(time.time() - self.started, 4)),
+            ('cpu', round(cpuTime() - self.startedCpu, 4)),
+            ('childCpu', round(childCpuTime(), 4)),
+            ('peakRSS', peakRSS()),
+            ('stages', [stage.report() for stage in self.stages.values()]),
+            ('api', self.api.report())
+        ])
+
+        if self._cprofile:
+            import pstats
+            self._cprofile.disable()
+            stats = pstats.Stats(self._cprofile).stats
+            functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            report['cprofile'] = [OrderedDict([
+                ('function', '{}:{}({})'.format(*key)),
+                ('calls', value[1]),
+                ('tottime', round(value[2], 4)),
+                ('cumtime', round(value[3], 4))
+            ]) for key, value in functions]
+
+        return report
+
+    def write(self, path):
+        """
+        Write the profile as JSON. With cProfile running the raw statistics also get written
+        beside it with a .pstats extension for use with pstats or snakeviz.
+        :param path: Path of the JSON file
+        :return: None
+        """
+        report = self.report()
+        if self._cprofile:
+            self._cprofile.dump_stats(os.path.splitext(path)[0] + '.pstats')
+
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Profile written to {}'.format(path))
+
+
+PROFILER = Profiler()
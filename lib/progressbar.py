@@ -120,16 +120,77 @@ class AnimatedProgressBar(ProgressBar):
 
 import threading
 class ProgressPercentage(object):
-    def __init__(self, filename):
+    """
+    Callback for the bytes of a download or upload. It can be shared by several threads
+    downloading parts of one job, in which case filename names the whole job and size is
+    the total of all of them. With interval the line is redrawn at most that often.
+    """
+    def __init__(self, filename, size=None, interval=0):
         self._filename = filename
+        self._size = size
+        self._interval = interval
         self._seen_so_far = 0
+        self._started = time.time()
+        self._last_draw = 0
         self._lock = threading.Lock()
     def __call__(self, bytes_amount):
-        # To simplify we'll assume this is hooked up
-        # to a single filename.
         with self._lock:
             self._seen_so_far += bytes_amount
-            sys.stdout.write(
-                "\r%s --> %s bytes transferred" % (
-                    self._filename, self._seen_so_far))
+            now = time.time()
+            if now - self._last_draw < self._interval:
+                return
+            self._last_draw = now
+            elapsed = now - self._started
+            rate = self._seen_so_far / elapsed / 1048576.0 if elapsed > 0 else 0
+            if self._size:
+                sys.stdout.write(
+                    "\r%s --> %s of %s bytes transferred (%.2f%%) %.2f MB/s" % (
+                        self._filename, self._seen_so_far, self._size,
+                        100.0 * self._seen_so_far / self._size, rate))
+            else:
+                sys.stdout.write(
+                    "\r%s --> %s bytes transferred %.2f MB/s" % (
+                        self._filename, self._seen_so_far, rate))
             sys.stdout.flush()
+
+class ThrottledProgress(object):
+    """
+    Progress of many items shared by several worker threads. Workers call add() as each item
+    finishes and the line is redrawn at most once every interval seconds so a fast loop
+    doesn't spend its time writing to the terminal.
+    """
+    def __init__(self, total, done=0, label='', interval=1.0, stdout=None):
+        self.total = total
+        self.done = done
+        self.failed = 0
+        self.label = label
+        self.interval = interval
+        self.stdout = stdout or sys.stdout
+        self.started = time.time()
+        self._lastDraw = 0
+        self._startDone = done
+        self._lock = threading.Lock()
+        self._bar = ProgressBar(end=100, width=40, fill='#', blank='_', format='%(progress)s%% [%(fill)s%(blank)s]')
+
+    def add(self, done=1, failed=0):
+        with self._lock:
+            self.done += done
+            self.failed += failed
+            now = time.time()
+            if now - self._lastDraw >= self.interval:
+                self._lastDraw = now
+                self._draw(now)
+
+    def _draw(self, now):
+        finished = self.done + self.failed
+        self._bar.set(100.0 * finished / self.total if self.total else 100)
+        elapsed = now - self.started
+        rate = (finished - self._startDone) / elapsed if elapsed > 0 else 0
+        self.stdout.write('\r {} {} {} of {}, {} failed, {:.1f}/s'.format(self.label, self._bar, finished, self.total, self.failed, rate))
+        self.stdout.flush()
+
+    def finish(self):
+        with self._lock:
+            self._draw(time.time())
+            self.stdout.write('\n')
+            self.stdout.flush()
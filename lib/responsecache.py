@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class OfflineCacheMiss(Exception):
+    """
+    Raised when running offline and a url has never been downloaded
+    """
+    pass
+
+
+class ResponseCache:
+    """
+    On-disk cache of API responses keyed by URL. Each response is stored as two
+    files: the raw body and a small JSON file with the url, ETag, Last-Modified
+    and the time it was fetched. With a size limit the sizes are kept in memory in
+    least recently used order, so storing a response doesn't have to look at the
+    whole folder. The folder is read again every rescanEvery puts to pick up what
+    other processes sharing it have stored or removed.
+    """
+
+    def __init__(self, cacheDir, ttl=86400, maxBytes=None, offline=False, rescanEvery=1000):
+        """
+        :param cacheDir: Folder where responses get stored. Created if it does not exist.
+        :param ttl: Seconds a response is considered fresh without asking the server.
+        :param maxBytes: Evict the least recently used responses once the cache is bigger than this. None means no limit.
+        :param offline: Never call the server. Serve everything from the cache regardless of age.
+        :param rescanEvery: Number of puts between reading the folder again. Only used with maxBytes.
+        """
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.offline = offline
+        self.rescanEvery = rescanEvery
+        self._lock = threading.Lock()
+        # Body size of each cached key, least recently used first, and their total
+        self._sizes = OrderedDict()
+        self._total = 0
+        self._puts = 0
+
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        if self.maxBytes:
+            with self._lock:
+                self._rescan()
+
+    def _key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _paths(self, url):
+        key = self._key(url)
+        return os.path.join(self.cacheDir, key + '.body'), os.path.join(self.cacheDir, key + '.meta')
+
+    def _used(self, key):
+        """
+        Move a key to the most recently used end of the index. Call with the lock held.
+        """
+        if key in self._sizes:
+            self._sizes[key] = self._sizes.pop(key)
+
+    def get(self, url):
+        """
+        Look up a cached response
+        :param url: Absolute url of the call
+        :return: (body, meta) tuple or None if the url is not in the cache
+        """
+        bodyPath, metaPath = self._paths(url)
+        try:
+            with open(metaPath, 'rb') as f:
+                meta = json.load(f)
+            with open(bodyPath, 'rb') as f:
+                body = f.read()
+        except (IOError, ValueError):
+            return None
+
+        # Record the access so eviction removes the least recently used responses first.
+        # Another thread may have just evicted it, but we already have the response.
+        # The file time carries the order over to later runs.
+        try:
+            os.utime(metaPath, None)
+        except OSError:
+            pass
+        if self.maxBytes:
+            with self._lock:
+                self._used(self._key(url))
+        return body, meta
+
+    def isFresh(self, meta):
+        return self.offline or time.time() - meta['fetched'] < self.ttl
+
+    def validators(self, meta):
+        """
+        Conditional request headers for revalidating a cached response
+        :param meta:
+        :return: Dictionary of headers. Empty if the server gave us nothing to revalidate with.
+        """
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('lastModified'):
+            headers['If-Modified-Since'] = meta['lastModified']
+        return headers
+
+    def put(self, url, body, etag=None, lastModified=None):
+        """
+        Store a response, replacing any previous version
+        :param url: Absolute url of the call
+        :param body: Raw response content
+        :param etag: ETag header returned by the server
+        :param lastModified: Last-Modified header returned by the server
+        :return: None
+        """
+        bodyPath, metaPath = self._paths(url)
+        self._write(bodyPath, body)
+        self._write(metaPath, json.dumps({
+            'url': url,
+            'etag': etag,
+            'lastModified': lastModified,
+            'fetched': time.time(),
+            'size': len(body)
+        }))
+
+        if self.maxBytes:
+            with self._lock:
+                key = self._key(url)
+                self._total += len(body) - self._sizes.pop(key, 0)
+                self._sizes[key] = len(body)
+                self._puts += 1
+                if self._puts % self.rescanEvery == 0:
+                    self._rescan()
+                self._evict()
+
+    def touch(self, url, meta):
+        """
+        Mark a cached response as fresh again after the server said it has not changed
+        :param url:
+        :param meta:
+        :return: None
+        """
+        meta['fetched'] = time.time()
+        self._write(self._paths(url)[1], json.dumps(meta))
+        if self.maxBytes:
+            with self._lock:
+                self._used(self._key(url))
+
+    def evict(self):
+        """
+        Remove the least recently used responses until the cache fits in maxBytes
+        :return: None
+        """
+        if not self.maxBytes:
+            return
+
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """
+        Evict from the in-memory index. Call with the lock held.
+        """
+        while self._total > self.maxBytes and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            for ext in ('.meta', '.body'):
+                try:
+                    os.remove(os.path.join(self.cacheDir, key + ext))
+                except OSError:
+                    pass
+            self._total -= size
+
+    def _rescan(self):
+        """
+        Rebuild the index from the folder, oldest access first. Call with the lock held.
+        """
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.meta'):
+                continue
+            key = name[:-len('.meta')]
+            try:
+                size = os.path.getsize(os.path.join(self.cacheDir, key + '.body'))
+                entries.append((os.path.getmtime(os.path.join(self.cacheDir, name)), key, size))
+            except OSError:
+                continue
+
+        self._sizes = OrderedDict((key, size) for accessed, key, size in sorted(entries))
+        self._total = sum(self._sizes.values())
+
+    def _write(self, path, content):
+        # Write to a temporary file first so other threads and processes never see half a response
+        tmpPath = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmpPath, 'wb') as f:
+            f.write(content)
+        os.rename(tmpPath, path)
@@ -0,0 +1,173 @@
+import time
+import random
+import threading
+import email.utils
+
+# Statuses worth trying again. Everything else at 400 or above is the request's fault and won't get better.
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+
+
+class APIError(Exception):
+    """
+    Raised when an API call fails for good, either with a status that won't get better or
+    after running out of retries
+    """
+
+    def __init__(self, message, url=None, status=None):
+        Exception.__init__(self, message)
+        self.url = url
+        self.status = status
+
+
+class CircuitOpenError(APIError):
+    """
+    Raised when a host has been failing for longer than the circuit breaker is willing to wait
+    """
+    pass
+
+
+def classifyStatus(status):
+    """
+    :param status: HTTP status code
+    :return: 'ok' for success and 304, 'retry' for statuses worth trying again, otherwise 'fail'
+    """
+    if status < 400:
+        return 'ok'
+    return 'retry' if status in RETRY_STATUSES else 'fail'
+
+
+def retryAfterSeconds(value, now=None):
+    """
+    Parse a Retry-After header
+    :param value: Header value, either a number of seconds or an HTTP date
+    :param now: Current time. Defaults to time.time()
+    :return: Seconds to wait or None if there is no usable value
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - (time.time() if now is None else now))
+
+
+class RetryPolicy:
+    """
+    How many times to try a call and how long to wait in between. The waits grow exponentially
+    and are spread randomly over the whole interval ("full jitter") so that many threads that
+    failed together don't all come back at the same moment.
+    """
+
+    def __init__(self, maxAttempts=6, baseDelay=0.5, maxDelay=60.0, maxRetryAfter=300.0):
+        """
+        :param maxAttempts: Total number of tries, including the first one
+        :param baseDelay: Longest wait after the first failure. Each later failure doubles it.
+        :param maxDelay: Cap on the exponential wait
+        :param maxRetryAfter: Cap on a wait requested by the server with Retry-After
+        """
+        self.maxAttempts = max(1, maxAttempts)
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.maxRetryAfter = maxRetryAfter
+
+    def delay(self, attempt, retryAfter=None):
+        """
+        :param attempt: Number of the attempt that just failed, starting at 1
+        :param retryAfter: Seconds the server asked us to wait, if it did
+        :return: Seconds to wait before the next attempt
+        """
+        if retryAfter is not None:
+            return min(retryAfter, self.maxRetryAfter)
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    Stops calling a host that keeps failing. After failureThreshold failures in a row the
+    circuit opens and calls wait for resetTimeout seconds. Then a single trial call goes
+    through and the circuit closes again if it works. Calls wait rather than fail while the
+    circuit is open so a long run rides out an outage, up to maxWait seconds.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, failureThreshold=5, resetTimeout=30.0, maxWait=600.0):
+        """
+        :param failureThreshold: Failures in a row that open the circuit. 0 turns the breaker off.
+        :param resetTimeout: Seconds the circuit stays open before a trial call
+        :param maxWait: Most seconds a call waits for the circuit before CircuitOpenError is raised
+        """
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.maxWait = maxWait
+        self.trips = 0
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {'failures': 0, 'openUntil': None, 'trial': False}
+        return state
+
+    def _wait(self, host):
+        """
+        :return: Seconds until this call may go ahead, or 0 if it may go now
+        """
+        with self._lock:
+            state = self._host(host)
+            if state['openUntil'] is None:
+                return 0
+            now = time.time()
+            if now < state['openUntil']:
+                return state['openUntil'] - now
+            if state['trial']:
+                # Someone else is making the trial call. Check again shortly.
+                return min(1.0, self.resetTimeout)
+            state['trial'] = True
+            return 0
+
+    def acquire(self, host, url=None):
+        """
+        Block until a call to the host is allowed
+        :param host: Host name of the call
+        :param url: Url of the call, for the error message
+        :return: None
+        """
+        if not self.failureThreshold:
+            return
+        waited = 0.0
+        wait = self._wait(host)
+        while wait > 0:
+            if waited + wait > self.maxWait:
+                raise CircuitOpenError("{} has been failing for too long".format(host), url)
+            if waited == 0:
+                print("Circuit open for {}. Waiting {:.0f}s before trying again".format(host, wait))
+            time.sleep(wait)
+            waited += wait
+            wait = self._wait(host)
+
+    def success(self, host):
+        if not self.failureThreshold:
+            return
+        with self._lock:
+            state = self._host(host)
+            state['failures'] = 0
+            state['openUntil'] = None
+            state['trial'] = False
+
+    def failure(self, host):
+        if not self.failureThreshold:
+            return
+        with self._lock:
+            state = self._host(host)
+            state['failures'] += 1
+            if state['trial'] or state['failures'] >= self.failureThreshold:
+                if state['openUntil'] is None:
+                    self.trips += 1
+                state['openUntil'] = time.time() + self.resetTimeout
+                state['trial'] = False
@@ -3,7 +3,29 @@ import json
 import os
 from shapely.geometry import *
 
+# Vector formats that can be written, keyed by file extension.
+# maxFieldLength is the longest field name the format can store.
+# updatable is whether features can be changed in an existing file.
+OUTPUT_FORMATS = {
+    'shp': {'driver': 'ESRI Shapefile', 'extension': '.shp', 'name': 'ShapeFile', 'maxFieldLength': 10, 'layerOptions': [], 'updatable': True},
+    'gpkg': {'driver': 'GPKG', 'extension': '.gpkg', 'name': 'GeoPackage', 'maxFieldLength': None, 'layerOptions': [], 'updatable': True},
+    'fgb': {'driver': 'FlatGeobuf', 'extension': '.fgb', 'name': 'FlatGeobuf', 'maxFieldLength': None, 'layerOptions': ['SPATIAL_INDEX=YES'], 'updatable': False}
+}
+
+def outputFormat(sFilename):
+    """
+    Look up the output format for a file path from its extension
+    :param sFilename: Path to a vector file
+    :return: Dictionary from OUTPUT_FORMATS. ShapeFile when the extension is not recognised.
+    """
+    extension = os.path.splitext(sFilename)[1].lower().lstrip('.')
+    return OUTPUT_FORMATS.get(extension, OUTPUT_FORMATS['shp'])
+
 class Shapefile:
+    """
+    A single point, line or polygon layer. Despite the name this can be any of the
+    OUTPUT_FORMATS, chosen by the extension of the file name.
+    """
 
     def __init__(self, sFilename=None):
         self.driver = ogr.GetDriverByName("ESRI Shapefile")
@@ -12,20 +34,41 @@ class Shapefile:
             self.load(sFilename)
 
     def load(self, sFilename):
-        dataSource = self.driver.Open(sFilename, 0)
-        self.layer = dataSource.GetLayer()
+        self.driver = ogr.GetDriverByName(outputFormat(sFilename)['driver'])
+        self.datasource = self.driver.Open(sFilename, 0)
+        self.layer = self.datasource.GetLayer()
         self.spatialRef = self.layer.GetSpatialRef()
 
         self.getFieldDef()
         self.getFeatures()
 
+    def openForUpdate(self, sFilename):
+        """
+        Open an existing file so its features can be changed. Unlike load the features are not read.
+        :param sFilename: Path to the vector file
+        :return: None
+        """
+        self.driver = ogr.GetDriverByName(outputFormat(sFilename)['driver'])
+        self.datasource = self.driver.Open(sFilename, 1)
+        if self.datasource is None:
+            raise Exception("Unable to open {} for update".format(sFilename))
+        self.layer = self.datasource.GetLayer()
+        self.spatialRef = self.layer.GetSpatialRef()
+        self.getFieldDef()
+
     def create(self, sFilename, spatialRef=None, geoType=ogr.wkbMultiLineString):
+        fmt = outputFormat(sFilename)
+        self.driver = ogr.GetDriverByName(fmt['driver'])
+        if self.driver is None:
+            raise Exception("This version of GDAL does not have the {} driver".format(fmt['driver']))
+
         if os.path.exists(sFilename):
             self.driver.DeleteDataSource(sFilename)
-        self.driver = None
-        self.driver = ogr.GetDriverByName("ESRI Shapefile")
         self.datasource = self.driver.CreateDataSource(sFilename)
-        self.layer = self.datasource.CreateLayer(sFilename, spatialRef, geom_type=geoType)
+
+        # The ShapeFile driver names the layer after the file. Other formats need a proper layer name.
+        layerName = sFilename if fmt['driver'] == "ESRI Shapefile" else os.path.splitext(os.path.basename(sFilename))[0]
+        self.layer = self.datasource.CreateLayer(layerName, spatialRef, geom_type=geoType, options=fmt['layerOptions'])
 
     def createField(self, fieldName, ogrOFT):
         """
@@ -37,6 +80,115 @@ class Shapefile:
         aField = ogr.FieldDefn(fieldName, ogrOFT)
         self.layer.CreateField(aField)
 
+    def writePoints(self, xs, ys, attrs):
+        """
+        Write point features in bulk
+        :param xs: Sequence of x coordinates
+        :param ys: Sequence of y coordinates
+        :param attrs: Sequence of dictionaries of field name to value, one per point. None values are left unset.
+        :return: Number of features written
+        """
+        return self.writePointFeatures(zip(xs, ys, attrs))
+
+    def writePointFeatures(self, points):
+        """
+        Write point features in bulk, building the OGR geometries directly and setting
+        fields by index. All the features are written inside a single transaction.
+        :param points: Iterable of (x, y, attrs) tuples. Can be a generator.
+        :return: Number of features written
+        """
+        featureDefn = self.layer.GetLayerDefn()
+        fieldIndexes = {}
+        count = 0
+
+        self.layer.StartTransaction()
+        try:
+            for x, y, fields in points:
+                self.layer.CreateFeature(self._pointFeature(featureDefn, fieldIndexes, x, y, fields))
+                count += 1
+        except Exception:
+            self.layer.RollbackTransaction()
+            raise
+
+        self.layer.CommitTransaction()
+        return count
+
+    def updatePointFeatures(self, points, deleteFIDs=()):
+        """
+        Replace, add and delete point features in a single transaction. Replaced features
+        keep their FID and have every field reset, so values that are now None get cleared.
+        :param points: Iterable of (FID, x, y, attrs) tuples. A FID of None adds a new feature.
+        :param deleteFIDs: FIDs of the features to delete
+        :return: Number of features replaced or added
+        """
+        featureDefn = self.layer.GetLayerDefn()
+        fieldIndexes = {}
+        count = 0
+
+        self.layer.StartTransaction()
+        try:
+            for fid in deleteFIDs:
+                self.layer.DeleteFeature(fid)
+
+            for fid, x, y, fields in points:
+                feature = self._pointFeature(featureDefn, fieldIndexes, x, y, fields)
+                if fid is None:
+                    self.layer.CreateFeature(feature)
+                else:
+                    feature.SetFID(fid)
+                    self.layer.SetFeature(feature)
+                count += 1
+        except Exception:
+            self.layer.RollbackTransaction()
+            raise
+
+        self.layer.CommitTransaction()
+
+        # ShapeFiles only flag deleted records. Repack to remove them from the file.
+        if deleteFIDs and self.driver.GetName() == "ESRI Shapefile":
+            self.datasource.ExecuteSQL('REPACK "{}"'.format(self.layer.GetName()))
+        return count
+
+    def findFeatures(self, fieldName, values, chunkSize=500):
+        """
+        Find the features whose field has one of a set of integer values
+        :param fieldName: Name of an integer field, e.g. an ID
+        :param values: Integer values to look for
+        :param chunkSize: Number of values in each attribute filter
+        :return: Dictionary of field value to FID
+        """
+        values = sorted(set(int(value) for value in values))
+        found = {}
+        for start in range(0, len(values), chunkSize):
+            chunk = values[start:start + chunkSize]
+            self.layer.SetAttributeFilter('"{}" IN ({})'.format(fieldName, ','.join(str(value) for value in chunk)))
+            self.layer.ResetReading()
+            lookup = set(chunk)
+            for feature in self.layer:
+                value = feature.GetField(fieldName)
+                if value is not None and int(value) in lookup:
+                    found[int(value)] = feature.GetFID()
+
+        self.layer.SetAttributeFilter(None)
+        self.layer.ResetReading()
+        return found
+
+    def _pointFeature(self, featureDefn, fieldIndexes, x, y, fields):
+        # Build the geometry directly and set fields by index, caching the index of each field name
+        feature = ogr.Feature(featureDefn)
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(float(x), float(y))
+        feature.SetGeometryDirectly(point)
+
+        for fieldName, fieldValue in fields.items():
+            if fieldValue is None:
+                continue
+            idx = fieldIndexes.get(fieldName)
+            if idx is None:
+                idx = fieldIndexes[fieldName] = featureDefn.GetFieldIndex(fieldName)
+            feature.SetField(idx, fieldValue)
+        return feature
+
     def getFieldDef(self):
         self.fields = {}
         lyrDefn = self.layer.GetLayerDefn()
@@ -1,33 +1,408 @@
 import requests
 import os
-import math
-import sys
 import json
-from progressbar import ProgressBar
+import time
+import hashlib
+import threading
+import urlparse
+
+from progressbar import ThrottledProgress, ProgressPercentage
 from userinput import query_yes_no
+from responsecache import ResponseCache, OfflineCacheMiss
+from jsonstream import iterJsonArray
+from profiler import PROFILER
+from retrypolicy import RetryPolicy, CircuitBreaker, APIError, classifyStatus, retryAfterSeconds
+from deletejournal import DeleteJournal
+from prefetchplan import PrefetchPlan
+from filefolderutil import sanitizeFolderName
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import fcntl
+except ImportError:
+    # Windows. The token cache is only locked between threads.
+    fcntl = None
+
+class APIClient:
+    """
+    Owns a single requests Session so that every API call reuses the same
+    pool of keep-alive connections instead of doing a fresh TCP+TLS handshake.
+    """
+
+    def __init__(self, poolSize=10, timeout=60):
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a call on the shared session and record its latency and size with the profiler
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            PROFILER.api.record(time.time() - start, error=True)
+            raise
+
+        # Streamed bodies are counted as they are read
+        nbytes = 0 if kwargs.get('stream') else len(response.content)
+        PROFILER.api.record(time.time() - start, nbytes, response.status_code >= 400)
+        return response
 
-class Tokenator:
+CLIENT = None
+
+def configureClient(poolSize=None, timeout=None):
+    """
+    Create the shared API client. Values that are not provided come from the
+    API_POOL_SIZE and API_TIMEOUT environment variables
+    :param poolSize: Maximum number of keep-alive connections per host
+    :param timeout: Seconds to wait for the server before giving up on a call
+    :return: The shared APIClient
     """
+    global CLIENT
+    if poolSize is None:
+        poolSize = int(os.environ.get('API_POOL_SIZE', 10))
+    if timeout is None:
+        timeout = float(os.environ.get('API_TIMEOUT', 60))
+    CLIENT = APIClient(poolSize, timeout)
+    return CLIENT
+
+def getClient():
+    """
+    Get the shared API client, creating it with the default settings if need be
+    :return: The shared APIClient
+    """
+    if CLIENT is None:
+        configureClient()
+    return CLIENT
 
+CACHE = None
+
+def configureCache(cacheDir, ttl=86400, maxBytes=None, offline=False):
+    """
+    Turn on the on-disk response cache used by rawCall
+    :param cacheDir: Folder where responses get stored. None turns the cache off.
+    :param ttl: Seconds a cached response is used without revalidating it with the server
+    :param maxBytes: Maximum size of the cache on disk. None means no limit.
+    :param offline: Never call the server. Everything must come from the cache.
+    :return: The ResponseCache or None
     """
-    TOKEN = None
+    global CACHE
+    if cacheDir is None:
+        if offline:
+            raise OfflineCacheMiss("Running offline requires a cache directory")
+        CACHE = None
+    else:
+        CACHE = ResponseCache(cacheDir, ttl, maxBytes, offline)
+    return CACHE
+
+class Tokenator(object):
+    """
+    The Keystone bearer token, shared by every thread. Read TOKEN whenever a call is made:
+    the token is fetched on first use and again ahead of expiry, with only one thread
+    fetching while the rest wait for it. With a token cache file, set with configureTokenCache
+    or KEYSTONE_TOKEN_CACHE, the token is also shared with other processes and later runs.
+    """
+    _token = None
+    _refreshAt = 0
+    _lock = threading.Lock()
+    cachePath = None
 
     def __init__(self):
-        if self.TOKEN is None:
+        if Tokenator._token is None:
             print "Getting security token"
-            response = requests.post(os.environ.get('KEYSTONE_URL'), data={
-                "username": os.environ.get('KEYSTONE_USER'),
-                "password": os.environ.get('KEYSTONE_PASS'),
-                "grant_type": "password",
-                "client_id": os.environ.get('KEYSTONE_CLIENT_ID'),
-                "client_secret": os.environ.get('KEYSTONE_CLIENT_SECRET'),
-                "scope": 'keystone openid profile'
-            })
-            respObj = json.loads(response.content)
-            Tokenator.TOKEN = "bearer " + respObj['access_token']
+            Tokenator.current()
         else:
             print "reusing security token"
 
+    @property
+    def TOKEN(self):
+        return Tokenator.current()
+
+    @classmethod
+    def current(cls):
+        """
+        :return: A token that is not about to expire, fetching a new one if need be
+        """
+        if cls._token is not None and time.time() < cls._refreshAt:
+            return cls._token
+        with cls._lock:
+            # Another thread may have refreshed it while we waited for the lock
+            if cls._token is None or time.time() >= cls._refreshAt:
+                cls._token, cls._refreshAt = cls._sharedToken()
+            return cls._token
+
+    @classmethod
+    def invalidate(cls, token):
+        """
+        Throw away a token the server rejected so the next call fetches a new one
+        :param token: The rejected token. Nothing happens if it has already been replaced.
+        :return: None
+        """
+        with cls._lock:
+            if cls._token == token:
+                cls._refreshAt = 0
+                path = cls._cacheFile()
+                if path:
+                    with TokenCacheLock(path):
+                        cached = readTokenCache(path)
+                        if cached and cached['token'] == token:
+                            os.remove(path)
+
+    @classmethod
+    def _cacheFile(cls):
+        return cls.cachePath or os.environ.get('KEYSTONE_TOKEN_CACHE')
+
+    @classmethod
+    def _sharedToken(cls):
+        """
+        Use the token in the cache file if it is still good, otherwise fetch one and save it there
+        :return: Tuple of the token and the time to refresh it
+        """
+        path = cls._cacheFile()
+        if not path:
+            return fetchToken()
+
+        with TokenCacheLock(path):
+            cached = readTokenCache(path)
+            if cached and cached['token'] != cls._token and time.time() < cached['refreshAt']:
+                return cached['token'], cached['refreshAt']
+            token, refreshAt = fetchToken()
+            writeTokenCache(path, token, refreshAt)
+            return token, refreshAt
+
+def fetchToken():
+    """
+    Ask Keystone for a new token with the password grant
+    :return: Tuple of the token and the time to refresh it, a while before it expires
+    """
+    response = _request('POST', os.environ.get('KEYSTONE_URL'), data={
+        "username": os.environ.get('KEYSTONE_USER'),
+        "password": os.environ.get('KEYSTONE_PASS'),
+        "grant_type": "password",
+        "client_id": os.environ.get('KEYSTONE_CLIENT_ID'),
+        "client_secret": os.environ.get('KEYSTONE_CLIENT_SECRET'),
+        "scope": 'keystone openid profile'
+    })
+    respObj = json.loads(response.content)
+    lifetime = respObj.get('expires_in')
+    if lifetime:
+        # Refresh five minutes early, or a quarter of the lifetime for short lived tokens
+        refreshAt = time.time() + max(float(lifetime) - 300, float(lifetime) * 0.75)
+    else:
+        # No expiry given. Keep it until the server rejects it.
+        refreshAt = float('inf')
+    return "bearer " + respObj['access_token'], refreshAt
+
+class TokenCacheLock:
+    """
+    Exclusive lock on a token cache file, held across processes with a .lock file beside it
+    so only one process fetches a token at a time. Without fcntl (Windows) only threads are locked out.
+    """
+
+    def __init__(self, path):
+        self.lockPath = path + '.lock'
+        self.handle = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.handle = open(self.lockPath, 'a')
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self.handle:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+            self.handle.close()
+
+def readTokenCache(path):
+    """
+    :param path: Token cache file
+    :return: Dictionary of the cached token and its refresh time, or None if there isn't a usable one for these settings
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return None
+    # A token for another server or user is no use
+    if cached.get('url') != os.environ.get('KEYSTONE_URL') or cached.get('user') != os.environ.get('KEYSTONE_USER'):
+        return None
+    return cached
+
+def writeTokenCache(path, token, refreshAt):
+    """
+    Save a token where only this user can read it. It is written to a temporary file first so
+    other processes never see half of it.
+    :return: None
+    """
+    tmpPath = path + '.tmp'
+    handle = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(handle, 'w') as f:
+        json.dump({
+            'url': os.environ.get('KEYSTONE_URL'),
+            'user': os.environ.get('KEYSTONE_USER'),
+            'token': token,
+            'refreshAt': refreshAt if refreshAt != float('inf') else time.time() + 86400
+        }, f)
+    # os.rename won't replace an existing file on Windows
+    if os.name == 'nt' and os.path.isfile(path):
+        os.remove(path)
+    os.rename(tmpPath, path)
+
+def configureTokenCache(path):
+    """
+    Share the Keystone token with other processes and later runs through a file. Without
+    this the KEYSTONE_TOKEN_CACHE environment variable is used, if it is set.
+    :param path: Token cache file. None leaves it to KEYSTONE_TOKEN_CACHE.
+    :return: None
+    """
+    Tokenator.cachePath = path
+
+class RateLimiter:
+    """
+    Simple per-host rate limiter. Spaces calls to the same host at least
+    1/callsPerSecond seconds apart, no matter how many threads are calling.
+    """
+
+    def __init__(self, callsPerSecond=None):
+        self.interval = 1.0 / callsPerSecond if callsPerSecond else 0
+        self._lock = threading.Lock()
+        self._nextCall = {}
+
+    def wait(self, url):
+        """
+        Block until a call to the host of this url is allowed
+        :param url: Absolute url that is about to be called
+        :return: None
+        """
+        if not self.interval:
+            return
+
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            callTime = max(now, self._nextCall.get(host, now))
+            self._nextCall[host] = callTime + self.interval
+
+        if callTime > now:
+            time.sleep(callTime - now)
+
+RATELIMITER = RateLimiter()
+
+def setRateLimit(callsPerSecond):
+    """
+    Limit the number of calls per second made to any one host. None or 0 means no limit
+    :param callsPerSecond:
+    :return: None
+    """
+    global RATELIMITER
+    RATELIMITER = RateLimiter(callsPerSecond)
+
+RETRYPOLICY = RetryPolicy()
+BREAKER = CircuitBreaker()
+
+def configureRetry(maxAttempts=None, baseDelay=None, maxDelay=None, failureThreshold=None, resetTimeout=None):
+    """
+    Set how API calls are retried. Values that are not provided come from the API_RETRIES,
+    API_RETRY_DELAY, API_RETRY_MAX_DELAY, API_BREAKER_FAILURES and API_BREAKER_RESET environment variables
+    :param maxAttempts: Total number of tries for each call
+    :param baseDelay: Longest wait in seconds after the first failure. It doubles with each failure after that.
+    :param maxDelay: Longest wait in seconds between two tries
+    :param failureThreshold: Failures in a row that make every call to the host wait. 0 turns the circuit breaker off.
+    :param resetTimeout: Seconds calls wait once the circuit breaker has opened
+    :return: None
+    """
+    global RETRYPOLICY, BREAKER
+    if maxAttempts is None:
+        maxAttempts = int(os.environ.get('API_RETRIES', 6))
+    if baseDelay is None:
+        baseDelay = float(os.environ.get('API_RETRY_DELAY', 0.5))
+    if maxDelay is None:
+        maxDelay = float(os.environ.get('API_RETRY_MAX_DELAY', 60))
+    if failureThreshold is None:
+        failureThreshold = int(os.environ.get('API_BREAKER_FAILURES', 5))
+    if resetTimeout is None:
+        resetTimeout = float(os.environ.get('API_BREAKER_RESET', 30))
+    RETRYPOLICY = RetryPolicy(maxAttempts, baseDelay, maxDelay)
+    BREAKER = CircuitBreaker(failureThreshold, resetTimeout)
+
+def _retryWait(url, problem, attempt, retryAfter=None):
+    """
+    Wait before trying a failed call again
+    :return: None
+    """
+    delay = RETRYPOLICY.delay(attempt, retryAfter)
+    print "ERROR: Problem with API Call: {} ({}). Retrying in {:.1f}s... {}".format(url, problem, delay, attempt)
+    PROFILER.api.recordRetry()
+    time.sleep(delay)
+
+def _request(method, url, **kwargs):
+    """
+    Make an API call through the rate limiter and circuit breaker. Connection errors and
+    statuses that might get better, like 429 and 503, are tried again after a backoff.
+    A 401 on a call with a token fetches a new token and tries once more.
+    :param method: HTTP method
+    :param url: Absolute url
+    :param kwargs: Passed on to requests
+    :return: The response, which always has a status below 400
+    """
+    host = urlparse.urlparse(url).netloc
+    attempt = 0
+    refreshed = False
+    while True:
+        attempt += 1
+        BREAKER.acquire(host, url)
+        RATELIMITER.wait(url)
+
+        status = None
+        retryAfter = None
+        try:
+            response = getClient().request(method, url, **kwargs)
+        except requests.exceptions.RequestException, e:
+            problem = str(e)
+        else:
+            status = response.status_code
+            outcome = classifyStatus(status)
+            if outcome == 'ok':
+                BREAKER.success(host)
+                return response
+            if outcome == 'fail':
+                # The server answered properly. Asking again won't change its mind.
+                BREAKER.success(host)
+                authorization = (kwargs.get('headers') or {}).get('Authorization')
+                if status == 401 and authorization and not refreshed:
+                    # The token expired or was revoked early. Get a new one and try once more.
+                    response.close()
+                    Tokenator.invalidate(authorization)
+                    kwargs['headers'] = dict(kwargs['headers'], Authorization=Tokenator.current())
+                    refreshed = True
+                    attempt -= 1
+                    continue
+                raise APIError("{} {} failed with status {}: {}".format(method, url, status, response.text[:200]), url, status)
+            problem = "status {}".format(status)
+            retryAfter = retryAfterSeconds(response.headers.get('Retry-After'))
+            response.close()
+
+        BREAKER.failure(host)
+        if attempt >= RETRYPOLICY.maxAttempts:
+            raise APIError("{} {} failed after {} attempts: {}".format(method, url, attempt, problem), url, status)
+        _retryWait(url, problem, attempt, retryAfter)
+
 def getVisits():
     """
     Get all the instances we need to delete
@@ -37,7 +412,7 @@ def getVisits():
     tokenator = Tokenator()
     print "Getting visit data"
     url = "{0}/visits".format(os.environ.get('API_BASE_URL'))
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
     respObj = json.loads(response.content)
 
     visits = {}
@@ -47,32 +422,100 @@ def getVisits():
     return visits
 
 def rawCall(url, absolute=False):
-    tokenator = Tokenator()
-    print "Making Call: {}".format(url)
     if absolute == False:
         url = "{0}/{1}".format(os.environ.get('API_BASE_URL'), url)
 
-    retry = True
-    retries = 0
-    # Really basic retry functionality.
-    # TODO: This catches "connection reset by peer" but not error status codes like 404 or 500
-    while retry and retries < 10:
-        try:
-            retries += 1
-            response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
-            retry = False
-        except Exception, e:
-            print "ERROR: Problem with API Call: {}. retrying... {}".format(url, retries)
+    # Serve the call from the response cache if we can
+    cached = CACHE.get(url) if CACHE else None
+    headers = {}
+    if cached:
+        body, meta = cached
+        if CACHE.isFresh(meta):
+            print "Cached Call: {}".format(url)
+            PROFILER.api.recordCached(len(body))
+            return json.loads(body)
+        headers = CACHE.validators(meta)
+    elif CACHE and CACHE.offline:
+        raise OfflineCacheMiss("Offline and no cached response for: {}".format(url))
+
+    tokenator = Tokenator()
+    print "Making Call: {}".format(url)
+    headers["Authorization"] = tokenator.TOKEN
+    response = _request('GET', url, headers=headers)
+
+    if cached and response.status_code == 304:
+        # Not modified since we cached it
+        CACHE.touch(url, meta)
+        return json.loads(body)
+
+    if CACHE and response.status_code == 200:
+        CACHE.put(url, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
     respObj = json.loads(response.content)
 
     return respObj
 
+def streamCall(url, absolute=False, chunkSize=65536):
+    """
+    Like rawCall but for calls that return a very large JSON array. The response is
+    parsed as it downloads and the items are yielded one at a time so the whole
+    payload is never in memory at once. Streamed responses are read from the
+    cache if they are there, but are not written to it.
+    :param url:
+    :param absolute:
+    :param chunkSize: Number of bytes to read from the connection at a time
+    :return: Generator of the items in the JSON array
+    """
+    if absolute == False:
+        url = "{0}/{1}".format(os.environ.get('API_BASE_URL'), url)
+
+    cached = CACHE.get(url) if CACHE else None
+    if cached and CACHE.isFresh(cached[1]):
+        print "Cached Call: {}".format(url)
+        PROFILER.api.recordCached(len(cached[0]))
+        for item in json.loads(cached[0]):
+            yield item
+        return
+    elif CACHE and CACHE.offline:
+        raise OfflineCacheMiss("Offline and no cached response for: {}".format(url))
+
+    tokenator = Tokenator()
+    print "Streaming Call: {}".format(url)
+
+    def chunks(response):
+        for chunk in response.iter_content(chunkSize):
+            PROFILER.api.addBytes(len(chunk))
+            yield chunk
+
+    # If the connection drops part way through, call again and skip the items we already have.
+    # A call that got further than the last one starts its count of attempts again.
+    yielded = 0
+    attempt = 1
+    while True:
+        response = _request('GET', url, headers={"Authorization": tokenator.TOKEN}, stream=True)
+        progress = yielded
+        try:
+            for idx, item in enumerate(iterJsonArray(chunks(response))):
+                if idx >= yielded:
+                    yielded += 1
+                    yield item
+            return
+        except requests.exceptions.RequestException, e:
+            if yielded > progress:
+                attempt = 1
+            if attempt >= RETRYPOLICY.maxAttempts:
+                raise APIError("GET {} failed after {} items: {}".format(url, yielded, e), url)
+            _retryWait(url, "dropped after {} items".format(yielded), attempt)
+            attempt += 1
+        finally:
+            response.close()
+
 
 def getSites():
     tokenator = Tokenator()
     print "Getting sites"
     url = "{0}/metricschemas".format(os.environ.get('API_BASE_URL'))
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
     respObj = json.loads(response.content)
 
     return respObj
@@ -81,59 +524,223 @@ def getMetricSchema(SchemaName):
     tokenator = Tokenator()
     print "Getting sites"
     url = "{0}/sites".format(os.environ.get('API_BASE_URL'))
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
     respObj = json.loads(response.content)
 
     return respObj
 
 def getWatersheds():
+    """
+    Get the names of the sites in each watershed. The sites say which watershed they are in,
+    so this takes two calls. Each watershed is only asked for its sites if some site doesn't say.
+    :return: Dictionary of watershed name: list of site names
+    """
     tokenator = Tokenator()
     print "Getting watersheds"
     url = "{0}/watersheds".format(os.environ.get('API_BASE_URL'))
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
     respObj = json.loads(response.content)
 
+    print "Getting sites"
+    url = "{0}/sites".format(os.environ.get('API_BASE_URL'))
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
+    watersheds = PrefetchPlan(json.loads(response.content), watersheds=respObj).watershedSites()
+    if watersheds is not None:
+        return dict(watersheds)
+
     watersheds = {}
     for obj in respObj:
-        response = requests.get(obj['url'], headers={"Authorization": tokenator.TOKEN})
+        response = _request('GET', obj['url'], headers={"Authorization": tokenator.TOKEN})
         respObj = json.loads(response.content)
         watersheds[obj['name']] = [site['name'] for site in respObj['sites']]
         print "     Getting sites for watershed: {}".format(obj['name'])
 
     return watersheds
 
-def downloadFile(url, localpath):
-    tokenator = Tokenator()
-    print "Getting visit file data"
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
-    with open(localpath, 'wb') as f:
-        f.write(response.content)
-        print "Downloaded file: {} to: {}".format(url, localpath)
+def fileMD5(path, chunkSize=1048576):
+    """
+    :param path: Local file
+    :return: Hex MD5 of the file's contents
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-def getVisitFieldFiles(visitID):
+def fileUnchanged(localpath, size=None, md5=None):
     """
-    Get all the instances we need to delete
-    :param schemaName:
-    :return:
+    Check a local copy against what the API says about a file
+    :param localpath: Local file
+    :param size: Size in bytes of the remote file, if known
+    :param md5: Hex MD5 of the remote file, if known
+    :return: True if the local file exists and matches everything that is known
+    """
+    if (size is None and md5 is None) or not os.path.isfile(localpath):
+        return False
+    if size is not None and os.path.getsize(localpath) != int(size):
+        return False
+    return md5 is None or fileMD5(localpath) == md5.strip('"').lower()
+
+def downloadFile(url, localpath, size=None, md5=None, callback=None, chunkSize=65536):
+    """
+    Stream a file to disk. It is written to localpath.part and renamed when it is complete.
+    If an earlier attempt left a .part file, or the connection drops, the download carries on
+    from where it got to with a Range request. A file that is already there with the same size
+    and MD5 is not downloaded again.
+    :param url: Absolute url of the file
+    :param localpath: Where to save it
+    :param size: Size in bytes of the file, if known, to skip unchanged files and check the download
+    :param md5: Hex MD5 of the file, if known, to skip unchanged files and check the download
+    :param callback: Called with the number of bytes of each chunk as it arrives, e.g. a ProgressPercentage
+    :param chunkSize: Number of bytes to read from the connection at a time
+    :return: True if the file was downloaded, False if the local copy was already up to date
+    """
+    if fileUnchanged(localpath, size, md5):
+        print "Unchanged file: {}".format(localpath)
+        if callback:
+            callback(os.path.getsize(localpath))
+        return False
+
+    tokenator = Tokenator()
+    partpath = localpath + '.part'
+    resumed = os.path.isfile(partpath)
+    # Bytes of this file already passed to the callback. Bytes on disk from before are
+    # credited once, and a download that has to start again doesn't count them twice.
+    credited = 0
+    attempt = 1
+    while True:
+        offset = os.path.getsize(partpath) if os.path.isfile(partpath) else 0
+        headers = {"Authorization": tokenator.TOKEN}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            response = _request('GET', url, headers=headers, stream=True)
+        except APIError, e:
+            if e.status != 416:
+                raise
+            # The partial file is no use. Start again from nothing.
+            os.remove(partpath)
+            continue
+
+        # A server that ignores Range sends the whole file again
+        mode = 'ab' if offset and response.status_code == 206 else 'wb'
+        received = offset if mode == 'ab' else 0
+        length = response.headers.get('Content-Length')
+        expected = received + int(length) if length else None
+        try:
+            if callback and received > credited:
+                callback(received - credited)
+                credited = received
+            with open(partpath, mode) as f:
+                for chunk in response.iter_content(chunkSize):
+                    f.write(chunk)
+                    received += len(chunk)
+                    PROFILER.api.addBytes(len(chunk))
+                    if callback and received > credited:
+                        callback(received - credited)
+                        credited = received
+            if expected is not None and received < expected:
+                raise requests.exceptions.ConnectionError("connection closed with {} of {} bytes".format(received, expected))
+        except requests.exceptions.RequestException, e:
+            if received > offset:
+                attempt = 1
+            if attempt >= RETRYPOLICY.maxAttempts:
+                raise APIError("GET {} failed after {} bytes: {}".format(url, received, e), url)
+            _retryWait(url, "dropped after {} bytes".format(received), attempt)
+            attempt += 1
+            continue
+        finally:
+            response.close()
+
+        if (size is not None and os.path.getsize(partpath) != int(size)) or (md5 is not None and fileMD5(partpath) != md5.strip('"').lower()):
+            os.remove(partpath)
+            if not resumed:
+                raise APIError("Downloaded file {} does not match the size or MD5 the API gave".format(url), url)
+            # The .part file left from before was not the start of this file
+            print "Partial download of {} was not usable. Downloading it again.".format(url)
+            resumed = False
+            continue
+        break
+
+    # os.rename won't replace an existing file on Windows
+    if os.path.isfile(localpath):
+        os.remove(localpath)
+    os.rename(partpath, localpath)
+    print "Downloaded file: {} to: {}".format(url, localpath)
+    return True
+
+def getVisitFieldFiles(visitID, workers=8):
+    """
+    List the files in each of a visit's field folders. The folders are listed concurrently.
+    :param visitID: Visit ID
+    :param workers: Number of folders listed at once
+    :return: Dictionary of folder name: list of file objects
     """
     tokenator = Tokenator()
     print "Getting visit file data"
     url = "{0}/visits/{1}/fieldFolders".format(os.environ.get('API_BASE_URL'), visitID)
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
-    respObj = json.loads(response.content)
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
+    folders = [folder['name'] for folder in json.loads(response.content)]
 
-    files = {}
-    counter = 0
-    for folder in respObj:
-        url = "{0}/visits/{1}/fieldFolders/{2}".format(os.environ.get('API_BASE_URL'), visitID, folder['name'])
-        response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
-        respObj = json.loads(response.content)
-        files[folder['name']] = respObj
-        counter += len(respObj)
+    def listFolder(name):
+        url = "{0}/visits/{1}/fieldFolders/{2}".format(os.environ.get('API_BASE_URL'), visitID, name)
+        response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
+        return json.loads(response.content)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        files = dict(zip(folders, executor.map(listFolder, folders)))
+    finally:
+        executor.shutdown(wait=True)
 
-    print "  -- Found {} field files for the visit {}".format(counter, visitID)
+    print "  -- Found {} field files for the visit {}".format(sum(len(f) for f in files.values()), visitID)
     return files
 
+def downloadVisitFieldFiles(visitID, dirPath, workers=4):
+    """
+    Download all of a visit's field files into dirPath/<field folder>/, several at a time.
+    Files that are already there and match the size and MD5 the API lists are skipped,
+    and interrupted downloads carry on from their .part files.
+    :param visitID: Visit ID
+    :param dirPath: Folder to download into
+    :param workers: Number of folders listed and files downloaded at once
+    :return: Tuple of the number of files downloaded, skipped because they were unchanged, and failed
+    """
+    folders = getVisitFieldFiles(visitID, workers)
+
+    downloads = []
+    for folder, files in folders.items():
+        folderPath = os.path.join(dirPath, sanitizeFolderName(folder))
+        if not os.path.isdir(folderPath):
+            os.makedirs(folderPath)
+        for fileObj in files:
+            url = fileObj.get('downloadUrl') or fileObj['url']
+            downloads.append((url, os.path.join(folderPath, os.path.basename(fileObj['name'])), fileObj.get('size'), fileObj.get('md5')))
+
+    total = sum(int(size) for url, path, size, md5 in downloads if size is not None)
+    progress = ProgressPercentage('Visit {} field files'.format(visitID), total or None, interval=0.5)
+    failed = []
+
+    def download(item):
+        url, localpath, size, md5 = item
+        try:
+            return downloadFile(url, localpath, size, md5, progress)
+        except APIError, e:
+            print "ERROR: could not download {}: {}".format(url, e)
+            failed.append(url)
+            return False
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        downloaded = sum(1 for result in executor.map(download, downloads) if result)
+    finally:
+        executor.shutdown(wait=True)
+
+    skipped = len(downloads) - downloaded - len(failed)
+    print "\n  -- Downloaded {} field files for the visit {}, {} unchanged, {} failed".format(downloaded, visitID, skipped, len(failed))
+    return downloaded, skipped, len(failed)
+
 
 def getInstances(schemaName):
     """
@@ -144,67 +751,104 @@ def getInstances(schemaName):
     tokenator = Tokenator()
     print "Getting instances"
     url = "{0}/visit/metricschemas/{1}".format(os.environ.get('API_BASE_URL'), schemaName)
-    response = requests.get(url, headers={"Authorization": tokenator.TOKEN})
+    response = _request('GET', url, headers={"Authorization": tokenator.TOKEN})
     respObj = json.loads(response.content)
     print "  -- Found {} instances for the schema {}".format(len(respObj['instances']), schemaName)
     return [inst['url'] for inst in respObj['instances']]
 
-def deleteInstances(instances):
+def deleteInstances(instances, workers=8, journalPath=None):
     """
-
-    :param instances:
-    :return:
+    Delete instances on several threads at once. Each deletion is written to the journal as it
+    happens so that if the run is interrupted, running it again with the same journal skips
+    the instances that are already gone. Instances that fail are recorded and tried again on
+    the next run instead of stopping the others.
+    :param instances: List of instance urls
+    :param workers: Number of deletions in flight at once
+    :param journalPath: Journal file. Without one nothing is remembered between runs.
+    :return: Dictionary of url: reason for the instances that could not be deleted
     """
     tokenator = Tokenator()
-    counter = 0
+    journal = DeleteJournal(journalPath) if journalPath else None
+    todo = [url for url in instances if journal is None or url not in journal.deleted]
     print "Deleting all {} existing instances:".format(len(instances))
+    if len(todo) < len(instances):
+        print "  -- {} already deleted according to {}".format(len(instances) - len(todo), journalPath)
 
-    custom_options = {
-        'start': 0,
-        'end': 100,
-        'width': 60,
-        'blank': '_',
-        'fill': '#',
-        'format': '%(progress)s%% [%(fill)s%(blank)s]'
-    }
-    progbar = ProgressBar(**custom_options)
-
-    try:
-        for url in instances:
-            response = requests.delete(url, headers={"Authorization": tokenator.TOKEN})
-            respObj = json.loads(response.content)
-            if response.status_code != 200:
-                raise "FAILED with code: {} and error: '{}'".format(response.status_code, response.text)
-            counter += 1
-            progbar.progress = math.floor(float(counter) / float(len(instances)) * 100)
-            sys.stdout.write("\r {} {} of {}".format(str(progbar), counter, len(instances)))
-
-    except Exception, e:
-        print " FAILED after deleting {} instances".format(counter)
-        raise "FAIL"
-
-
-    print "  -- deleted {} instances".format(len(instances))
-    return [inst['url'] for inst in respObj['instances']]
-
-def deleteSchema(schemaName):
+    progress = ThrottledProgress(len(instances), done=len(instances) - len(todo), interval=0.5)
+    failed = {}
+    failedLock = threading.Lock()
 
+    def delete(url):
+        try:
+            _request('DELETE', url, headers={"Authorization": tokenator.TOKEN})
+        except APIError as e:
+            # Already gone, e.g. deleted before an interruption but not journaled
+            if e.status != 404:
+                with failedLock:
+                    failed[url] = str(e)
+                if journal:
+                    journal.recordFailed(url, e)
+                progress.add(done=0, failed=1)
+                return
+        if journal:
+            journal.recordDeleted(url)
+        progress.add()
+
+    # Only a couple of batches are queued at a time so an interruption stops promptly
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = set()
+    interrupted = False
     try:
-        tokenator = Tokenator()
-        instances = getInstances(schemaName)
+        for url in todo:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(delete, url))
+        for future in wait(pending)[0]:
+            future.result()
+    except BaseException:
+        interrupted = True
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        progress.finish()
+        if journal:
+            journal.close()
+        if interrupted:
+            print "  -- interrupted after deleting {} instances. Run again to carry on.".format(progress.done)
+
+    print "  -- deleted {} instances, {} failed".format(len(instances) - len(failed), len(failed))
+    return failed
+
+def deleteSchema(schemaName, workers=8, journalPath=None, confirm=True):
+    """
+    Delete every instance of a metric schema and then the schema itself. The schema is only
+    deleted once all of its instances are, so a run that leaves failures can simply be repeated.
+    :param schemaName: Name of the metric schema
+    :param workers: Number of deletions in flight at once
+    :param journalPath: Deletion journal. Defaults to delete_<schema>.journal in the current folder.
+    :param confirm: Ask before deleting anything
+    :return: True if the schema was deleted
+    """
+    tokenator = Tokenator()
+    instances = getInstances(schemaName)
 
-        if not query_yes_no("\nIt's still not too late. Are you sure?"):
-            return
+    if confirm and not query_yes_no("\nIt's still not too late. Are you sure?"):
+        return False
 
-        success = deleteInstances(instances)
+    if journalPath is None:
+        journalPath = os.path.abspath('delete_{}.journal'.format(sanitizeFolderName(schemaName)))
 
-        url = "{0}/visit/metricschemas/{1}".format(os.environ.get('API_BASE_URL'), schemaName)
-        response = requests.delete(url, headers={"Authorization": tokenator.TOKEN})
-        respObj = json.loads(response.content)
-        print "Schema Deleted"
-        return [inst['url'] for inst in respObj['instances']]
+    if CLIENT is None or CLIENT.poolSize < workers:
+        configureClient(poolSize=workers)
 
-    except Exception, e:
-        print "whoops"
+    failed = deleteInstances(instances, workers, journalPath)
+    if failed:
+        print "  -- {} instances could not be deleted so the schema was kept. Run again to retry them. See {}".format(len(failed), journalPath)
+        return False
 
-    print "boop"
+    url = "{0}/visit/metricschemas/{1}".format(os.environ.get('API_BASE_URL'), schemaName)
+    _request('DELETE', url, headers={"Authorization": tokenator.TOKEN})
+    print "Schema Deleted"
+    return True
@@ -1,3 +1,9 @@
+try:
+    input = raw_input
+except NameError:
+    # Python 3
+    pass
+
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
 
@@ -21,7 +27,7 @@ def query_yes_no(question, default="yes"):
 
     while True:
         print(question + prompt)
-        choice = raw_input().lower()
+        choice = input().lower()
         if default is not None and choice == '':
             return valid[default]
         elif choice in valid:
@@ -39,7 +45,7 @@ def querychoices(title, options, question):
 
     while True:
         print(question + " [Choose One] ")
-        choice = raw_input()
+        choice = input()
 
         try:
             nchoice = int(choice.strip())
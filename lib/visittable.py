@@ -0,0 +1,186 @@
+import numpy as np
+
+REAL = 'real'
+INTEGER = 'integer'
+STRING = 'string'
+
+try:
+    stringTypes = (basestring,)
+    integerTypes = (int, long, np.integer)
+except NameError:
+    # Python 3
+    stringTypes = (str, bytes)
+    integerTypes = (int, np.integer)
+
+
+def inferKind(values):
+    """
+    Work out the column kind for a list of values. Strings win over reals, reals win over integers.
+    :param values: List of values. None, empty strings and zeros are ignored.
+    :return: REAL, INTEGER, STRING or None when there are no values to go on
+    """
+    arr = np.array(values, dtype=object)
+    if len(arr) == 0:
+        return None
+
+    present = arr[np.not_equal(arr, None)]
+    present = present[np.not_equal(present, '') & np.not_equal(present, 0)]
+    if len(present) == 0:
+        return None
+
+    isString = np.frompyfunc(lambda v: isinstance(v, stringTypes), 1, 1)(present).astype(bool)
+    if isString.any():
+        return STRING
+
+    isInteger = np.frompyfunc(lambda v: isinstance(v, integerTypes), 1, 1)(present).astype(bool)
+    return INTEGER if isInteger.all() else REAL
+
+
+class VisitTable(object):
+    """
+    Columnar store of the site, visit and metric values with one row per visit.
+    Numbers are held in float arrays with NaN for nulls. Strings are held as integer
+    codes into a list of the distinct values, with -1 for nulls.
+    """
+
+    def __init__(self, visitIds):
+        """
+        :param visitIds: The visit IDs, one per row, in the order they should be written.
+        """
+        self.visitIds = np.array(visitIds, dtype=np.int64)
+        self.index = {int(visitId): row for row, visitId in enumerate(self.visitIds)}
+        self.columns = {}
+        self.columnNames = []
+
+    def __len__(self):
+        return len(self.visitIds)
+
+    def addColumn(self, name, kind):
+        """
+        Add an empty column. Nothing happens if the column already exists.
+        :param name: Column name
+        :param kind: REAL, INTEGER or STRING
+        :return: None
+        """
+        if name in self.columns:
+            return
+
+        if kind == STRING:
+            column = {'kind': kind, 'codes': np.full(len(self), -1, dtype=np.int32), 'categories': [], 'lookup': {}}
+        else:
+            column = {'kind': kind, 'values': np.full(len(self), np.nan, dtype=np.float64)}
+        self.columns[name] = column
+        self.columnNames.append(name)
+
+    def addColumnFromValues(self, name, values, kind=None):
+        """
+        Add a column and fill it with one value per row
+        :param name: Column name
+        :param values: List of values in row order
+        :param kind: REAL, INTEGER or STRING. Inferred from the values if not provided.
+        :return: The column kind, or None if no kind was given and the values are all empty
+        """
+        if kind is None:
+            kind = inferKind(values)
+            if kind is None:
+                return None
+
+        self.addColumn(name, kind)
+        for row, value in enumerate(values):
+            self._set(self.columns[name], row, value)
+        return kind
+
+    def copy(self):
+        """
+        :return: A new VisitTable with copies of all the columns, so columns can be added to either independently
+        """
+        table = VisitTable([])
+        table.visitIds = self.visitIds.copy()
+        table.index = dict(self.index)
+        table.columnNames = list(self.columnNames)
+        for name, column in self.columns.items():
+            if column['kind'] == STRING:
+                table.columns[name] = {'kind': column['kind'], 'codes': column['codes'].copy(),
+                                       'categories': list(column['categories']), 'lookup': dict(column['lookup'])}
+            else:
+                table.columns[name] = {'kind': column['kind'], 'values': column['values'].copy()}
+        return table
+
+    def kind(self, name):
+        return self.columns[name]['kind']
+
+    def setValue(self, visitId, name, value, kind=REAL):
+        """
+        Set the value for a visit. The column is created if it does not exist yet.
+        :param visitId: Visit ID
+        :param name: Column name
+        :param value: The value. Numbers that can't be parsed are stored as null.
+        :param kind: Column kind used if the column has to be created
+        :return: False if the visit is not in the table
+        """
+        row = self.index.get(visitId)
+        if row is None:
+            return False
+
+        if name not in self.columns:
+            self.addColumn(name, kind)
+        self._set(self.columns[name], row, value)
+        return True
+
+    def _set(self, column, row, value):
+        if column['kind'] == STRING:
+            if value is None:
+                column['codes'][row] = -1
+                return
+            code = column['lookup'].get(value)
+            if code is None:
+                code = column['lookup'][value] = len(column['categories'])
+                column['categories'].append(value)
+            column['codes'][row] = code
+        else:
+            try:
+                column['values'][row] = np.nan if value is None else float(value)
+            except (TypeError, ValueError):
+                column['values'][row] = np.nan
+
+    def isNull(self, name):
+        """
+        :param name: Column name
+        :return: Boolean array that is True for each row where the column is null
+        """
+        column = self.columns[name]
+        if column['kind'] == STRING:
+            return column['codes'] < 0
+        return np.isnan(column['values'])
+
+    def records(self, names=None):
+        """
+        Iterate over the rows as dictionaries
+        :param names: Columns to include. All columns when not provided.
+        :return: Generator of dictionaries of column name to value, with None for nulls
+        """
+        names = self.columnNames if names is None else names
+        columns = [(name, self.columns[name]) for name in names]
+        nulls = dict((name, self.isNull(name)) for name in names)
+
+        for row in range(len(self)):
+            record = {}
+            for name, column in columns:
+                if nulls[name][row]:
+                    record[name] = None
+                elif column['kind'] == STRING:
+                    record[name] = column['categories'][column['codes'][row]]
+                elif column['kind'] == INTEGER:
+                    record[name] = int(column['values'][row])
+                else:
+                    record[name] = float(column['values'][row])
+            yield record
+
+    def nbytes(self):
+        """
+        :return: Approximate number of bytes used by the arrays
+        """
+        total = self.visitIds.nbytes
+        for column in self.columns.values():
+            total += column['codes'].nbytes if column['kind'] == STRING else column['values'].nbytes
+        return total
@@ -0,0 +1,45 @@
+import json
+import unittest
+
+from lib.jsonstream import iterJsonArray
+
+
+def chunked(text, size):
+    data = text.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    documents = [
+        '[]',
+        '[1.5]',
+        '[1, 2.5]',
+        '[1e10]',
+        '[-0.125, 1E-3, 42]',
+        '[{"a": 1.25}, 3.75, true]',
+        '[ "text" , null , false , [1, 2.5] , {"b": [3.5, "\\u00e9"]} ]',
+        '[\n  {"itemUrl": "visits/1", "values": [{"value": 12.345}]},\n  123456789.25\n]',
+    ]
+
+    def test_chunk_sizes(self):
+        # Every way of splitting the document must give the same items as parsing it whole
+        for document in self.documents:
+            expected = json.loads(document)
+            for size in range(1, len(document) + 1):
+                self.assertEqual(list(iterJsonArray(chunked(document, size))), expected,
+                                 '{} in chunks of {}'.format(document, size))
+
+    def test_truncated(self):
+        for document in ['[1.5', '[1, 2', '[{"a": 1}']:
+            for size in (1, 3):
+                with self.assertRaises(ValueError):
+                    list(iterJsonArray(chunked(document, size)))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iterJsonArray(chunked('{"a": 1}', 2)))
+
+
+if __name__ == '__main__':
+    unittest.main()